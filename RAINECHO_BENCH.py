@@ -0,0 +1,467 @@
+# %%
+# -*- coding: utf-8 -*-
+# RainEcho ベンチマーク
+# 使い方:
+#   python RAINECHO_BENCH.py vad [--seconds 60] [--json out.json]
+#   python RAINECHO_BENCH.py resample [--seconds 30] [--json out.json]
+#   python RAINECHO_BENCH.py soak [--days 7] [--wakes-per-hour 4] [--ambient-per-hour 30] [--trace-alloc]
+#   python RAINECHO_BENCH.py canvas [--size 1280x720] [--frames 600] [--json out.json] [--baseline old.json] [--tier auto|high|...]
+
+import os, sys, time, json, argparse, tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+os.environ.setdefault("RAINECHO_HISTORY", "0")   # ベンチの状態遷移を実際の履歴 DB に書かない
+
+import numpy as np
+
+import RAINECHO_GUI as app
+
+
+# ----------------- テスト信号 -----------------
+def synth_speechlike(sr: int, seconds: float, seed: int = 1):
+    """背景ノイズの上に 有声音っぽい区間（倍音列＋音節AM）を散らした信号と 正解区間を返す"""
+    rng = np.random.default_rng(seed)
+    n = int(sr * seconds)
+    x = rng.normal(0.0, 10 ** (-60 / 20), n).astype(np.float32)
+    spans = []
+    t = 1.0
+    while t < seconds - 2.5:
+        dur = rng.uniform(0.8, 2.0)
+        i0, i1 = int(t * sr), int((t + dur) * sr)
+        tt = np.arange(i1 - i0) / sr
+        f0 = rng.uniform(110, 230)
+        voice = sum(np.sin(2 * np.pi * f0 * k * tt) / k for k in range(1, 8))
+        am = 0.55 + 0.45 * np.sin(2 * np.pi * 4.0 * tt)
+        x[i0:i1] += (0.12 * voice * am).astype(np.float32)
+        spans.append((t, t + dur))
+        t += dur + rng.uniform(1.0, 3.0)
+    return (np.clip(x, -1, 1) * 32767).astype(np.int16), spans
+
+
+def _report(rows, cols):
+    w = [max(len(c), *(len(f"{r[c]}") for r in rows)) for c in cols]
+    print("  ".join(c.ljust(k) for c, k in zip(cols, w)))
+    for r in rows:
+        print("  ".join(f"{r[c]}".ljust(k) for c, k in zip(cols, w)))
+
+
+# ----------------- VAD -----------------
+def bench_vad(seconds: float = 60.0, block_ms: int = 10):
+    rows = []
+    for sr in (16000, 48000):
+        pcm, spans = synth_speechlike(sr, seconds)
+        blk = sr * block_ms // 1000
+        for frame_ms in (10, 20, 30):
+            vad = app.StreamingVAD(sr=sr, frame_ms=frame_ms, aggressiveness=1,
+                                   stop_silence_ms=500, min_voiced_ms=200)
+            events = []
+            c0 = time.process_time(); w0 = time.perf_counter()
+            for i in range(0, len(pcm), blk):
+                events += vad.feed(pcm[i:i + blk])
+            cpu = time.process_time() - c0; wall = time.perf_counter() - w0
+            starts = [t for k, t in events if k == "start"]
+            hit = sum(any(a - 0.3 <= s <= b for s in starts) for a, b in spans)
+            rows.append({
+                "sr": sr, "frame_ms": frame_ms,
+                "cpu_ms_per_audio_s": round(1000.0 * cpu / seconds, 3),
+                "realtime_factor": round(wall / seconds, 5),
+                "speech_spans": len(spans), "detected": hit, "starts": len(starts),
+            })
+    return rows
+
+
+# ----------------- リサンプラ -----------------
+RESAMPLE_CASES = [(48000, 16000, 2, 1), (44100, 16000, 2, 1), (32000, 16000, 1, 1), (16000, 16000, 2, 1),
+                  (16000, 48000, 1, 2), (44100, 48000, 2, 2), (32000, 48000, 1, 2), (24000, 48000, 1, 2),
+                  (48000, 44100, 2, 2)]
+
+def bench_resample(seconds: float = 30.0, block_ms: int = 10):
+    """AudioConverter をブロックごとに回したときのスループット（入力サンプル/秒 1ch あたり）と 1kHz 正弦の SNR"""
+    rows = []
+    for in_sr, out_sr, in_ch, out_ch in RESAMPLE_CASES:
+        n = int(in_sr * seconds)
+        x = (np.random.default_rng(0).normal(0, 0.1, n * in_ch) * 32767).astype(np.int16)
+        blk = in_sr * block_ms // 1000 * in_ch
+        conv = app.AudioConverter(in_sr, in_ch, out_sr, out_ch, np.float32 if out_ch == 1 else np.int16)
+        conv.process(x[:blk])
+        tracemalloc.start()
+        c0 = time.process_time(); w0 = time.perf_counter()
+        for i in range(0, len(x), blk):
+            conv.process(x[i:i + blk])
+        cpu = time.process_time() - c0; wall = time.perf_counter() - w0
+        _, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+        t = np.arange(in_sr) / in_sr
+        y = app.resample(np.sin(2 * np.pi * 1000.0 * t).astype(np.float32), in_sr, out_sr)
+        ref = np.sin(2 * np.pi * 1000.0 * np.arange(len(y)) / out_sr)
+        mid = slice(len(y) // 4, 3 * len(y) // 4)
+        snr = 10 * np.log10(np.mean(ref[mid] ** 2) / max(1e-30, np.mean((y[mid] - ref[mid]) ** 2)))
+        rs = conv.rs
+        rows.append({
+            "ratio": f"{in_sr}->{out_sr}", "ch": f"{in_ch}->{out_ch}",
+            "taps": f"{rs.L}x{rs.K}" if rs is not None else "-",
+            "msamples_per_s": round(n / cpu / 1e6, 2),
+            "realtime_x": round(seconds / wall),
+            "us_per_block": round(1e6 * cpu / -(-len(x) // blk), 1),
+            "peak_kb": round(peak / 1024, 1),
+            "snr_db": round(float(snr), 1),
+        })
+    return rows
+
+
+# ----------------- RainCanvas（オフスクリーン描画） -----------------
+# タイマーは使わず _on_frame(dt) とスポーンを台本どおりに直接呼び QImage に描く
+# update = _on_frame の所要 paint = 直近の再描画領域で QImage に描く所要
+FRAME_DT = app.FRAME_INTERVAL_MS / 1000.0
+CANVAS_CAPS = (10, 50, 200, 500)
+
+def _qapp():
+    from PySide6.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
+class CanvasRig:
+    def __init__(self, size=(1280, 720), tier="high"):
+        from PySide6.QtGui import QImage, QPainter
+        self._QPainter = QPainter
+        _qapp()
+        self.canvas = app.RainCanvas()
+        self.canvas.resize(*size)
+        # 見えていないと部分再描画の領域計算が省かれるので 画面に出さずに表示状態にする
+        self.canvas.setAttribute(app.Qt.WA_DontShowOnScreen, True); self.canvas.show()
+        self.canvas.set_quality_pin(tier)    # 既定は high 固定（自動だと途中で品質が変わり比較にならない）
+        self.image = QImage(size[0], size[1], QImage.Format_ARGB32_Premultiplied)
+        self.frames = 0
+        self.samples = []      # (update_ms, paint_ms, alloc_bytes)
+        self.trace_alloc = False
+
+    def frame(self):
+        c = self.canvas
+        if self.trace_alloc: tracemalloc.reset_peak(); base = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        c._on_frame(FRAME_DT)
+        t1 = time.perf_counter()
+        p = self._QPainter(self.image)
+        if c.last_dirty is not None:
+            p.setClipRegion(c.last_dirty)
+        if c.render_scale < 1.0: c._paint_lowres(p)
+        else: c.paint_scene(p)
+        p.end()
+        t2 = time.perf_counter()
+        c.quality.observe((t2 - t1) * 1000.0)
+        alloc = tracemalloc.get_traced_memory()[1] - base if self.trace_alloc else 0
+        self.samples.append(((t1 - t0) * 1000.0, (t2 - t1) * 1000.0, alloc))
+        self.frames += 1
+
+    def run_until(self, cond, max_frames: int):
+        for _ in range(max_frames):
+            if cond(): return
+            self.frame()
+
+    def run(self, n: int, every=None, action=None):
+        for i in range(n):
+            if action is not None and i % every == 0: action()
+            self.frame()
+
+
+def _set_caps(c, drops: int, ripples: int):
+    c.max_drops = drops
+    c.max_ripples = ripples
+
+
+# 台本: rig を受け取って進めるだけ（時間経過は壁時計なのでフェードや入場演出は実時間ぶん回す）
+def scn_idle_fades(rig, frames):
+    c = rig.canvas
+    for st in (app.LinoState.SLEEPING, app.LinoState.IDLE) * 2:
+        c.set_state(st)
+        rig.run_until(lambda: not c._bg_fading, frames)
+
+
+def scn_entry(rig, frames):
+    c = rig.canvas
+    for _ in range(2):
+        c.set_state(app.LinoState.IDLE); rig.run_until(lambda: not c._bg_fading, frames)
+        c.set_state(app.LinoState.LISTENING)
+        rig.run_until(lambda: c._entry_phase == 3, frames)
+        rig.run(30)
+
+
+def _scn_listen(cap):
+    def scn(rig, frames):
+        c = rig.canvas
+        _set_caps(c, cap, cap)
+        c.state = app.LinoState.LISTENING; c._allow_spawns = True; c._entry_phase = 3
+        per_tick = max(1, cap // 8)
+        interval = max(1, c.spawn_interval_ms // app.FRAME_INTERVAL_MS)
+        rig.run(frames, every=interval, action=lambda: [c._spawn_during_listen() for _ in range(per_tick)])
+    return scn
+
+
+def _scn_finish_burst(cap):
+    def scn(rig, frames):
+        c = rig.canvas
+        _set_caps(c, cap, cap)
+        c.state = app.LinoState.LISTENING; c._allow_spawns = False; c._entry_phase = 3
+        for _ in range(3):
+            w, h = c.width(), c.height()
+            for _ in range(cap):
+                c.particles.reserve(cap, cap)
+                c.particles.add_drop(np.random.uniform(w*0.18, w*0.82), np.random.uniform(0, h*0.5),
+                                     h*0.7, 7.0, 200)
+            c.finish_drops_to_ripples()
+            rig.run_until(lambda: c.particles.ripple_count == 0, frames)
+    return scn
+
+
+SCENARIOS = [("idle_fades", scn_idle_fades), ("entry", scn_entry)] + \
+            [(f"listen_cap{n}", _scn_listen(n)) for n in CANVAS_CAPS] + \
+            [(f"finish_burst{n}", _scn_finish_burst(n)) for n in CANVAS_CAPS]
+
+
+def _pct(a, q): return round(float(np.percentile(a, q)), 3) if len(a) else 0.0
+
+
+def bench_canvas(size=(1280, 720), frames=600, only=None, tier="high"):
+    rows = []
+    for name, scn in SCENARIOS:
+        if only and name not in only: continue
+        np.random.seed(0); app.random.seed(0)
+        # 1回目: 時間計測のみ  2回目: tracemalloc で1フレームあたりの確保量
+        rig = CanvasRig(size, tier); scn(rig, frames)
+        t = np.array([s[:2] for s in rig.samples]) if rig.samples else np.zeros((0, 2))
+        np.random.seed(0); app.random.seed(0)
+        rig2 = CanvasRig(size, tier); rig2.trace_alloc = True
+        tracemalloc.start()
+        try: scn(rig2, frames)
+        finally: tracemalloc.stop()
+        alloc = np.array([s[2] for s in rig2.samples]) if rig2.samples else np.zeros(0)
+        total = t.sum(axis=1) if len(t) else np.zeros(0)
+        rows.append({
+            "scenario": name, "frames": len(t),
+            "update_ms_mean": round(float(t[:, 0].mean()), 3) if len(t) else 0.0,
+            "paint_ms_mean": round(float(t[:, 1].mean()), 3) if len(t) else 0.0,
+            "frame_p50": _pct(total, 50), "frame_p95": _pct(total, 95), "frame_p99": _pct(total, 99),
+            "alloc_kb_per_frame": round(float(alloc.mean()) / 1024.0, 1) if len(alloc) else 0.0,
+            "over_budget": int((total > app.FRAME_INTERVAL_MS).sum()),
+            "tier": rig.canvas.quality.tier.name,
+        })
+    return rows
+
+
+# ----------------- 早送りソーク -----------------
+# VirtualClock を差した MainWindow をイベントループ無しで回す
+# 次に何かが起きる時刻（台本/デッドライン/フレーム/スポーン）まで時計を飛ばし その処理だけを直接呼ぶ
+# 何も動いていない間は一気に飛ぶので 1 日分の台本が数秒で終わる
+SOAK_EVENTS = {"wake": "on_wake_start_detected", "ambient": "on_ambient_detected",
+               "speech_start": "on_speech_start", "speech_end": "on_speech_end"}
+
+def day_script(days: float, wakes_per_hour: float = 4.0, ambient_per_hour: float = 30.0, seed: int = 0):
+    """[(t_sec, name)]  ウェイクの後には発話の開始/終了を付ける"""
+    rng = np.random.default_rng(seed)
+    total = days * 86400.0
+    ev = []
+    for name, per_hour in (("wake", wakes_per_hour), ("ambient", ambient_per_hour)):
+        n = rng.poisson(per_hour * total / 3600.0)
+        for t in np.sort(rng.uniform(0.0, total, n)).tolist():
+            ev.append((t, name))
+            if name == "wake":
+                t1 = t + rng.uniform(1.0, 4.0)
+                ev += [(t1, "speech_start"), (t1 + rng.uniform(0.5, 6.0), "speech_end")]
+    ev.sort()
+    return ev
+
+
+class VirtualTimeDriver:
+    def __init__(self, size=(760, 500), paint_every: int = 0, frame_stride: int = int(app.FRAME_MAX_STEPS)):
+        from PySide6.QtGui import QImage, QPainter
+        self._QPainter = QPainter
+        _qapp()
+        app.LAZY_STARTUP = True      # 遅延初期化はイベントループでしか進まないので マイクも SE も作られない
+        self.clock = app.VirtualClock()
+        self.w = app.MainWindow(clock=self.clock)
+        self.w.play_entry_se = lambda: None     # 早送り中は鳴らさない
+        self.w.resize(*size); self.w.canvas.resize(size[0], size[1] - self.w.header.sizeHint().height())
+        self.paint_every = paint_every
+        self.frame_stride = max(1, frame_stride)   # 1 回の _on_frame で進めるフレーム数（FRAME_MAX_STEPS まで）
+        self.image = QImage(self.w.canvas.width(), self.w.canvas.height(), QImage.Format_ARGB32_Premultiplied)
+        self.script = []
+        self.frames = 0
+        self.fired = {k: 0 for k in SOAK_EVENTS}
+        self.transitions = 0
+        self.peak = {"drops": 0, "ripples": 0}
+        st = self.w.set_state
+        def counted(s, *a):
+            if self.w.canvas.state != s: self.transitions += 1
+            st(s, *a)
+        self.w.set_state = counted
+
+    def add_script(self, events):
+        t0 = self.clock()
+        self.script += [(t0 + t, name) for t, name in events]
+        self.script.sort(reverse=True)       # 末尾から取り出す
+
+    def _paint(self):
+        p = self._QPainter(self.image)
+        self.w.canvas.paint_scene(p)
+        p.end()
+
+    def run(self, seconds: float, on_sample=None, sample_every: float = 3600.0):
+        c = self.w.canvas; sch = self.w.scheduler; clk = self.clock
+        end = clk() + seconds
+        next_frame = next_spawn = None
+        next_sample = clk() + sample_every
+        while True:
+            now = clk()
+            if c.frame.isActive():
+                if next_frame is None: next_frame = now + self.frame_stride * c.frame.interval_ms / 1000.0
+            else:
+                next_frame = None
+            if c.spawn_timer.isActive():
+                if next_spawn is None: next_spawn = now + c.spawn_timer.interval() / 1000.0
+            else:
+                next_spawn = None
+            t = min(x for x in (end, next_sample, next_frame, next_spawn, sch.next_deadline(),
+                                self.script[-1][0] if self.script else None) if x is not None)
+            if t >= end:
+                clk.set(end)
+                if on_sample is not None and end > next_sample - sample_every: on_sample(self)   # 端数の区間も最後に1行
+                break
+            clk.set(t)
+            if next_spawn is not None and t >= next_spawn:
+                c._spawn_during_listen(); next_spawn += c.spawn_timer.interval() / 1000.0
+            if next_frame is not None and t >= next_frame:
+                iv = self.frame_stride * c.frame.interval_ms / 1000.0
+                c._on_frame(iv); next_frame += iv
+                self.frames += 1
+                if self.paint_every and self.frames % self.paint_every == 0: self._paint()
+                pe = c.particles
+                self.peak["drops"] = max(self.peak["drops"], pe.drop_count)
+                self.peak["ripples"] = max(self.peak["ripples"], pe.ripple_count)
+            sch.run_due()
+            while self.script and self.script[-1][0] <= t:
+                _, name = self.script.pop()
+                getattr(self.w, SOAK_EVENTS[name])(); self.fired[name] += 1
+            if t >= next_sample:
+                next_sample += sample_every
+                if on_sample is not None: on_sample(self)
+
+    def snapshot(self) -> dict:
+        c = self.w.canvas; pe = c.particles
+        return {
+            "t_h": round(self.clock() / 3600.0, 2), "state": c.state.name if hasattr(c.state, "name") else str(c.state),
+            "frames": self.frames, "transitions": self.transitions,
+            "wakes": self.fired["wake"], "ambient": self.fired["ambient"],
+            "peak_drops": self.peak["drops"], "peak_ripples": self.peak["ripples"],
+            "cap_drops": pe.drp.shape[1], "cap_ripples": pe.rip.shape[1],
+            "sprite_kb": c.sprites.nbytes // 1024, "sched_heap": len(self.w.scheduler._heap),
+            "py_kb": tracemalloc.get_traced_memory()[0] // 1024 if tracemalloc.is_tracing() else -1,
+        }
+
+
+def soak(days: float = 1.0, wakes_per_hour: float = 4.0, ambient_per_hour: float = 30.0,
+         paint_every: int = 0, trace_alloc: bool = False, seed: int = 0, frame_stride: int = int(app.FRAME_MAX_STEPS)):
+    """1 日ごとのスナップショット行と 実時間/仮想時間の倍率を返す"""
+    np.random.seed(seed); app.random.seed(seed)
+    drv = VirtualTimeDriver(paint_every=paint_every, frame_stride=frame_stride)
+    drv.add_script(day_script(days, wakes_per_hour, ambient_per_hour, seed))
+    rows = []
+    if trace_alloc: tracemalloc.start()
+    w0 = time.perf_counter()
+    try:
+        drv.run(days * 86400.0, on_sample=lambda d: rows.append(d.snapshot()), sample_every=86400.0)
+    finally:
+        wall = time.perf_counter() - w0
+        if trace_alloc: tracemalloc.stop()
+    return rows, wall, days * 86400.0 / max(wall, 1e-9)
+
+
+def compare_baseline(rows, baseline_path: str, tolerance: float):
+    """p95 が基準より tolerance 以上悪化したシナリオを返す"""
+    with open(baseline_path, encoding="utf-8") as f:
+        base = {r["scenario"]: r for r in json.load(f)["results"]}
+    bad = []
+    for r in rows:
+        b = base.get(r["scenario"])
+        if b and b["frame_p95"] > 0 and r["frame_p95"] > b["frame_p95"] * (1.0 + tolerance):
+            bad.append((r["scenario"], b["frame_p95"], r["frame_p95"]))
+    return bad
+
+
+CANVAS_COLS = ["scenario", "frames", "update_ms_mean", "paint_ms_mean",
+               "frame_p50", "frame_p95", "frame_p99", "alloc_kb_per_frame", "over_budget", "tier"]
+SOAK_COLS = ["t_h", "state", "frames", "transitions", "wakes", "ambient", "peak_drops", "peak_ripples",
+             "cap_drops", "cap_ripples", "sprite_kb", "sched_heap", "py_kb"]
+VAD_COLS = ["sr", "frame_ms", "cpu_ms_per_audio_s", "realtime_factor", "speech_spans", "detected", "starts"]
+RESAMPLE_COLS = ["ratio", "ch", "taps", "msamples_per_s", "realtime_x", "us_per_block", "peak_kb", "snr_db"]
+
+
+def _write_json(path, bench, rows, **meta):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"bench": bench, "meta": meta, "results": rows}, f, ensure_ascii=False, indent=2)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="RainEcho benchmarks")
+    sub = ap.add_subparsers(dest="bench", required=True)
+    p = sub.add_parser("vad")
+    p.add_argument("--seconds", type=float, default=60.0)
+    p.add_argument("--json", help="結果を JSON で書き出すパス")
+    p = sub.add_parser("resample")
+    p.add_argument("--seconds", type=float, default=30.0)
+    p.add_argument("--json", help="結果を JSON で書き出すパス")
+    p = sub.add_parser("canvas")
+    p.add_argument("--size", default="1280x720")
+    p.add_argument("--frames", type=int, default=600, help="シナリオあたりの最大フレーム数")
+    p.add_argument("--only", nargs="*", help="実行するシナリオ名")
+    p.add_argument("--json", help="結果を JSON で書き出すパス")
+    p.add_argument("--baseline", help="比較する過去の JSON（p95 の悪化で終了コード 1）")
+    p.add_argument("--tolerance", type=float, default=0.15)
+    p.add_argument("--tier", default="high", choices=["auto"] + [t.name for t in app.QUALITY_TIERS],
+                   help="品質ティア（auto で適応制御をそのまま動かす 表の tier は終了時点）")
+    p = sub.add_parser("soak")
+    p.add_argument("--days", type=float, default=1.0, help="仮想時間で回す日数")
+    p.add_argument("--wakes-per-hour", type=float, default=4.0)
+    p.add_argument("--ambient-per-hour", type=float, default=30.0)
+    p.add_argument("--paint-every", type=int, default=0, help="N フレームごとに QImage へ描く（0 = 描かない）")
+    p.add_argument("--trace-alloc", action="store_true", help="tracemalloc で Python 側の使用量も記録する")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--frame-stride", type=int, default=int(app.FRAME_MAX_STEPS),
+                   help="1 回の更新で進めるフレーム数（1 = 実機と同じ刻み）")
+    p.add_argument("--json", help="結果を JSON で書き出すパス")
+    a = ap.parse_args(argv)
+
+    if a.bench == "soak":
+        rows, wall, speedup = soak(a.days, a.wakes_per_hour, a.ambient_per_hour,
+                                   a.paint_every, a.trace_alloc, a.seed, a.frame_stride)
+        _report(rows, SOAK_COLS)
+        print(f"wall {wall:.1f}s  x{speedup:.0f} realtime")
+        if a.json: _write_json(a.json, "soak", rows, days=a.days, wall_s=round(wall, 2), speedup=round(speedup))
+        return 0
+
+    if a.bench == "resample":
+        rows = bench_resample(seconds=a.seconds)
+        _report(rows, RESAMPLE_COLS)
+        if a.json: _write_json(a.json, "resample", rows, seconds=a.seconds)
+        return 0
+
+    if a.bench == "vad":
+        rows = bench_vad(seconds=a.seconds)
+        _report(rows, VAD_COLS)
+        if a.json: _write_json(a.json, "vad", rows, seconds=a.seconds)
+        return 0
+
+    size = tuple(int(v) for v in a.size.lower().split("x"))
+    rows = bench_canvas(size=size, frames=a.frames, only=a.only, tier=a.tier)
+    _report(rows, CANVAS_COLS)
+    if a.json: _write_json(a.json, "canvas", rows, size=list(size), frames=a.frames, tier=a.tier)
+    if a.baseline:
+        bad = compare_baseline(rows, a.baseline, a.tolerance)
+        for name, old, new in bad:
+            print(f"REGRESSION {name}: p95 {old} -> {new} ms")
+        return 1 if bad else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
@@ -8,25 +8,78 @@
 # - 固定テキストは背景なし 文字色は黒 入力系のみ薄い背景と枠で強調
 # - それ以外は改訂版8と同等（雨SE 画面遷移 演出 中央固定オーバーレイ等）
 
-import sys, random, time
+import sys, os, random, time, math, hashlib, mmap, threading, heapq, json, functools, sqlite3, struct, bisect
+_T_START = time.perf_counter()
+from collections import OrderedDict, deque
+import unicodedata
 from enum import Enum, auto
 
-from PySide6.QtCore import Qt, QTimer, QRectF, QPointF, QSize, QByteArray, QEvent
+import numpy as np
+
+from PySide6.QtCore import (Qt, QTimer, QRect, QRectF, QPointF, QSize, QByteArray, QEvent, QIODevice,
+                            QObject, QThread, Signal, Slot)
 from PySide6.QtGui import (QPainter, QPen, QBrush, QColor, QPainterPath,
-                           QIcon, QPixmap, QAction, QFont)
+                           QIcon, QPixmap, QImage, QAction, QFont, QRegion)
 from PySide6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout,
                                QPushButton, QSystemTrayIcon, QMenu, QLabel,
                                QSlider, QCheckBox, QFormLayout, QGroupBox,
                                QComboBox, QPlainTextEdit, QMessageBox,
                                QScrollArea, QFrame, QSizePolicy, QLineEdit, QSpinBox, QDoubleSpinBox)
 
-# === オーディオ（QtMultimedia） ===
-HAVE_QTMEDIA = True
-try:
-    from PySide6.QtMultimedia import (QMediaDevices, QAudioFormat, QAudioSink)
-    from PySide6.QtCore import QBuffer
-except Exception:
-    HAVE_QTMEDIA = False
+# === オーディオ（QtMultimedia） 読み込みは初回使用時（起動を軽くするため） ===
+HAVE_QTMEDIA = None     # None = まだ確認していない
+QMediaDevices = QAudioFormat = QAudioSink = QAudioSource = QAudio = QBuffer = None
+
+def _ensure_qtmedia() -> bool:
+    global HAVE_QTMEDIA, QMediaDevices, QAudioFormat, QAudioSink, QAudioSource, QAudio, QBuffer
+    if HAVE_QTMEDIA is None:
+        try:
+            from PySide6.QtMultimedia import (QMediaDevices, QAudioFormat, QAudioSink, QAudioSource, QAudio)
+            from PySide6.QtCore import QBuffer
+            HAVE_QTMEDIA = True
+        except Exception:
+            HAVE_QTMEDIA = False
+    return HAVE_QTMEDIA
+
+
+# === 起動時間の内訳 ===
+# RAINECHO_STARTUP_REPORT=1 で 遅延初期化が終わった時点でフェーズごとの所要を標準エラーに出す
+class StartupTimer:
+    def __init__(self, t0: float):
+        self.t0 = t0
+        self.marks = []          # (name, perf_counter)
+
+    def mark(self, name: str):
+        self.marks.append((name, time.perf_counter()))
+
+    def since_start_ms(self, name: str):
+        for n, t in self.marks:
+            if n == name: return (t - self.t0) * 1000.0
+        return None
+
+    def report(self):
+        rows = []; prev = self.t0
+        for name, t in self.marks:
+            rows.append({"phase": name, "ms": round((t - prev) * 1000.0, 2),
+                         "at_ms": round((t - self.t0) * 1000.0, 2)})
+            prev = t
+        return rows
+
+    def format(self) -> str:
+        lines = [f"{'phase':<22}{'ms':>10}{'at_ms':>10}"]
+        for r in self.report():
+            lines.append(f"{r['phase']:<22}{r['ms']:>10.1f}{r['at_ms']:>10.1f}")
+        ttfp = self.since_start_ms("first_paint")
+        if ttfp is not None:
+            lines.append(f"time-to-first-paint: {ttfp:.1f} ms")
+        return "\n".join(lines)
+
+
+STARTUP = StartupTimer(_T_START)
+STARTUP.mark("import")
+STARTUP_REPORT = os.environ.get("RAINECHO_STARTUP_REPORT", "0") not in ("", "0")
+LAZY_STARTUP = os.environ.get("RAINECHO_LAZY", "1") not in ("", "0")
+STARTUP_IDLE_MS = 1500   # 初回描画が来なくてもこの時間で遅延初期化を始める
 
 APP_TITLE = "RainEcho"
 
@@ -66,6 +119,27 @@ LISTEN_SPAWN_INTERVAL_MS = 650
 LISTEN_MAX_DROPS   = 18
 LISTEN_MAX_RIPPLES = 10
 
+# フレーム間隔（粒子の速度は FRAME_INTERVAL_MS あたりの移動量で定義）
+FRAME_INTERVAL_MS       = 16
+FRAME_INTERVAL_SLEEP_MS = 33
+FRAME_MAX_STEPS         = 4.0   # 長い停止明けに一気に進めすぎない
+# 1 にするとシミュレーションと描画を別スレッドで回し paintEvent は出来上がった QImage を貼るだけになる
+RENDER_THREADED         = os.environ.get("RAINECHO_RENDER_THREAD", "0") not in ("", "0")
+
+# 波紋/雨粒スプライトのキャッシュ（半径/線幅/α をバケット化して QPixmap を使い回す）
+SPRITE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SPRITE_CACHE_MAX_ITEMS = 512
+SPRITE_RADIUS_STEP = 2.0     # 小さい半径は 2px 刻み
+SPRITE_RADIUS_REL  = 0.02    # 64px 超は半径の 2% 刻み（対数バケット）
+SPRITE_WIDTH_STEP  = 0.2
+SPRITE_ALPHA_STEP  = 32      # αはバケット上端で焼き 差分は不透明度で合わせる
+SPRITE_MAX_RADIUS  = 480.0   # これより大きい波紋はベクタで直接描く
+
+# 部分再描画（前フレームと今フレームで粒子が占める領域の和だけ update する）
+DIRTY_PAD_PX     = 3.0
+DIRTY_MAX_RECTS  = 96     # 矩形がこれより多ければ外接矩形1枚にまとめる
+DIRTY_FULL_RATIO = 0.6    # 汚れ面積がキャンバスのこの割合を超えたら全面再描画
+
 ICON_CLOUD_IDLE   = QColor("#BFC6D1")
 ICON_CLOUD_LISTEN = QColor("#8FA3B8")
 ICON_CLOUD_SLEEP  = QColor("#A9AFB7")
@@ -76,6 +150,16 @@ DEFAULT_SYSTEM_PROMPT = (
     "セリフは改行せずインデントを使わずつなげてください 記号は？ ！ 。のみを使いそれ以外は使わないでください"
 )
 
+# 設定の既定値（設定オーバーレイを作る前もこれで動く）
+DEFAULT_CONFIG = {
+    "wake": {"threshold": 0.60, "allow_short": True, "allow_similar": True},
+    "api": {"model": "gpt-4o-realtime-preview", "realtime_only": True,
+            "tts_emotion": "tsun", "system_prompt": DEFAULT_SYSTEM_PROMPT},
+    "audio": {"device_id": None, "samplerate": 48000, "channels": 1},
+    "vad": {"frame_ms": 20, "aggressiveness": 0, "stop_silence_ms": 500, "min_voiced_ms": 200},
+    "render": {"quality": "auto"},
+}
+
 # ----------------- 状態 -----------------
 class LinoState(Enum):
     IDLE = auto()
@@ -153,117 +237,2502 @@ class CloudHeader(QWidget):
         lay.addWidget(self.btn_sleep,  0, Qt.AlignCenter)
         lay.addStretch(1)
 
-    def paintEvent(self, e):
-        p = QPainter(self)
-        p.setRenderHint(QPainter.Antialiasing, True)
-        p.fillRect(self.rect(), Qt.white)
-        p.end()
+    def paintEvent(self, e):
+        p = QPainter(self)
+        p.setRenderHint(QPainter.Antialiasing, True)
+        p.fillRect(self.rect(), Qt.white)
+        p.end()
+
+
+# ----------------- 雨粒/波紋（SoA パーティクルエンジン） -----------------
+# 粒子ごとのオブジェクトをやめ 状態を事前確保した NumPy 配列（行=フィールド 列=粒子 古い順）に持つ
+# 1フレーム分をまとめて進め 消滅した粒子はマスクで前詰めする（リストの作り直しはしない）
+RIPPLE_ALPHA0 = 200.0
+
+_RP_X, _RP_Y, _RP_R, _RP_MAXR, _RP_GROW, _RP_ALPHA, _RP_FADE, _RP_W = range(8)
+_DR_X, _DR_Y, _DR_Y1, _DR_V, _DR_ALPHA = range(5)
+
+
+class ParticleEngine:
+    def __init__(self, max_drops: int = LISTEN_MAX_DROPS, max_ripples: int = LISTEN_MAX_RIPPLES):
+        self.rip = np.zeros((8, 0), np.float64)
+        self.drp = np.zeros((5, 0), np.float64)
+        self.n_rip = 0
+        self.n_drp = 0
+        self.reserve(max_drops, max_ripples)
+
+    # 容量: 雨粒は上限ちょうど 波紋は着地/収束で一時的に上限を超えるぶん余裕を持たせる
+    def reserve(self, max_drops: int, max_ripples: int):
+        drop_cap = max(1, int(max_drops))
+        rip_cap = max(1, int(max_ripples) + 2 * drop_cap + 8)
+        if drop_cap > self.drp.shape[1]:
+            a = np.zeros((5, drop_cap), np.float64); a[:, :self.n_drp] = self.drp[:, :self.n_drp]; self.drp = a
+        if rip_cap > self.rip.shape[1]:
+            a = np.zeros((8, rip_cap), np.float64); a[:, :self.n_rip] = self.rip[:, :self.n_rip]; self.rip = a
+
+    @property
+    def drop_count(self) -> int: return self.n_drp
+
+    @property
+    def ripple_count(self) -> int: return self.n_rip
+
+    # --- 追加（満杯なら古い順に押し出す） ---
+    def _make_room(self, arr, n: int, k: int) -> int:
+        cap = arr.shape[1]
+        over = n + k - cap
+        if over > 0:
+            over = min(over, n)
+            arr[:, :n - over] = arr[:, over:n]
+            n -= over
+        return n
+
+    def add_drop(self, x: float, y0: float, y1: float, speed: float, alpha: float):
+        n = self._make_room(self.drp, self.n_drp, 1)
+        self.drp[:, n] = (x, y0, y1, speed, alpha)
+        self.n_drp = n + 1
+
+    def add_ripple(self, x: float, y: float, max_radius: float, grow: float, fade: float, width: float):
+        n = self._make_room(self.rip, self.n_rip, 1)
+        self.rip[:, n] = (x, y, 1.0, max_radius, grow, RIPPLE_ALPHA0, fade, width)
+        self.n_rip = n + 1
+
+    def add_ripples(self, xs, ys, max_radius: float, grow: float, fade: float, width: float):
+        xs = np.asarray(xs, np.float64); ys = np.asarray(ys, np.float64)
+        cap = self.rip.shape[1]
+        k = len(xs)
+        if k == 0: return
+        if k > cap:
+            xs = xs[-cap:]; ys = ys[-cap:]; k = cap
+        n = self._make_room(self.rip, self.n_rip, k)
+        blk = self.rip[:, n:n + k]
+        blk[_RP_X] = xs; blk[_RP_Y] = ys; blk[_RP_R] = 1.0
+        blk[_RP_MAXR] = max_radius; blk[_RP_GROW] = grow
+        blk[_RP_ALPHA] = RIPPLE_ALPHA0; blk[_RP_FADE] = fade; blk[_RP_W] = width
+        self.n_rip = n + k
+
+    def trim(self, max_drops: int, max_ripples: int):
+        # 新しいほうを残す（旧実装の lst[-MAX:] と同じ）
+        if self.n_drp > max_drops:
+            self.n_drp = self._make_room(self.drp, self.n_drp, self.drp.shape[1] - max_drops)
+        if self.n_rip > max_ripples:
+            self.n_rip = self._make_room(self.rip, self.n_rip, self.rip.shape[1] - max_ripples)
+
+    def clear_drops(self):
+        self.n_drp = 0
+
+    def clear(self):
+        self.n_drp = 0; self.n_rip = 0
+
+    # --- 1ステップ進める ---
+    # steps: 進めるフレーム数（経過時間から算出 端数可）
+    def step_drops(self, steps: float = 1.0):
+        """雨粒を落とし 着地したものを取り除いて (x, y1) を返す"""
+        n = self.n_drp
+        if n == 0: return None
+        d = self.drp[:, :n]
+        d[_DR_Y] += d[_DR_V] * steps
+        alive = d[_DR_Y] < d[_DR_Y1]
+        k = int(np.count_nonzero(alive))
+        if k == n: return None
+        landed = ~alive
+        out = (d[_DR_X, landed], d[_DR_Y1, landed])
+        self.drp[:, :k] = d[:, alive]
+        self.n_drp = k
+        return out
+
+    def step_ripples(self, steps: float = 1.0):
+        n = self.n_rip
+        if n == 0: return
+        r = self.rip[:, :n]
+        r[_RP_R] += r[_RP_GROW] * steps
+        r[_RP_ALPHA] -= r[_RP_FADE] * steps
+        alive = (r[_RP_ALPHA] > 0) & (r[_RP_R] < r[_RP_MAXR])
+        k = int(np.count_nonzero(alive))
+        if k != n:
+            self.rip[:, :k] = r[:, alive]
+            self.n_rip = k
+
+    # --- 描画用ビュー（コピーなし） ---
+    def drops_view(self):
+        return self.drp[:, :self.n_drp]
+
+    def ripples_view(self):
+        return self.rip[:, :self.n_rip]
+
+    def dirty_rects(self, pad: float = DIRTY_PAD_PX):
+        """今の粒子が占める領域を (x, y, w, h) の int 配列 (k, 4) で返す
+        波紋は外接正方形から 内側の円に収まる正方形をくり抜いた 4 枚で覆う"""
+        parts = []
+        n = self.n_rip
+        if n:
+            r = self.rip[:, :n]
+            cx, cy, rad, hw = r[_RP_X], r[_RP_Y], r[_RP_R], r[_RP_W] * 0.5
+            extra = pad + rad * SPRITE_RADIUS_REL          # スプライトの半径バケット誤差ぶん
+            outer = rad + hw + extra
+            inner = np.maximum(0.0, rad - hw - extra) * 0.7071
+            x0 = np.floor(cx - outer); x1 = np.ceil(cx + outer)
+            y0 = np.floor(cy - outer); y1 = np.ceil(cy + outer)
+            ix0 = np.ceil(cx - inner); ix1 = np.floor(cx + inner)
+            iy0 = np.ceil(cy - inner); iy1 = np.floor(cy + inner)
+            parts += [np.stack((x0, y0, x1 - x0, iy0 - y0), 1),      # 上
+                      np.stack((x0, iy1, x1 - x0, y1 - iy1), 1),     # 下
+                      np.stack((x0, iy0, ix0 - x0, iy1 - iy0), 1),   # 左
+                      np.stack((ix1, iy0, x1 - ix1, iy1 - iy0), 1)]  # 右
+        n = self.n_drp
+        if n:
+            d = self.drp[:, :n]
+            x = np.floor(d[_DR_X]) - 3; y = np.floor(d[_DR_Y]) - 9
+            parts.append(np.stack((x, y, np.full(n, 7.0), np.full(n, 12.0)), 1))
+        if not parts:
+            return np.zeros((0, 4), np.int64)
+        rects = np.concatenate(parts).astype(np.int64)
+        return rects[(rects[:, 2] > 0) & (rects[:, 3] > 0)]
+
+
+# ----------------- フレームスケジューラ -----------------
+# アニメーションがある間だけ tick し 静止したらタイマーを止める
+# tick ごとに前回からの経過秒を渡すので 動きはタイマーの揺らぎに左右されない
+class FrameScheduler:
+    def __init__(self, parent, on_tick, clock=time.monotonic):
+        self._on_tick = on_tick
+        self.clock = clock
+        self.timer = QTimer(parent)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self._tick)
+        self.interval_ms = FRAME_INTERVAL_MS
+        self._last = 0.0
+
+    def isActive(self) -> bool:
+        return self.timer.isActive()
+
+    def wake(self, interval_ms: int = None):
+        if interval_ms is not None and interval_ms != self.interval_ms:
+            self.interval_ms = interval_ms
+            if self.timer.isActive():
+                self.timer.setInterval(interval_ms)
+        if not self.timer.isActive():
+            self._last = self.clock()
+            self.timer.start(self.interval_ms)
+
+    def stop(self):
+        self.timer.stop()
+
+    def _tick(self):
+        now = self.clock()
+        dt = now - self._last
+        self._last = now
+        self._on_tick(dt)
+
+
+# ----------------- 品質ティア -----------------
+# 1 フレームの所要（更新+描画）が予算を超え続けたら効果を落として刻みを守る
+# 上げるのは余裕が QUALITY_UP_HOLD_SEC 続いてから 上げた直後にまた落ちたら次に上げるまでの待ちを倍にする
+class QualityTier:
+    __slots__ = ("name", "antialias", "max_drops", "max_ripples", "spawn_interval_ms", "scale")
+
+    def __init__(self, name, antialias, max_drops, max_ripples, spawn_interval_ms, scale):
+        self.name = name; self.antialias = antialias
+        self.max_drops = max_drops; self.max_ripples = max_ripples
+        self.spawn_interval_ms = spawn_interval_ms
+        self.scale = scale      # 内部解像度（1 未満なら縮小して描いて拡大表示）
+
+
+QUALITY_TIERS = (
+    QualityTier("high",    True,  LISTEN_MAX_DROPS, LISTEN_MAX_RIPPLES, LISTEN_SPAWN_INTERVAL_MS, 1.0),
+    QualityTier("medium",  False, 14, 8, 800, 1.0),
+    QualityTier("low",     False, 10, 6, 1000, 0.75),
+    QualityTier("minimal", False, 6, 4, 1400, 0.5),
+)
+QUALITY_WINDOW          = 30     # 判定に使う直近フレーム数
+QUALITY_DOWN_FRAC       = 0.9    # 窓の p90 が予算のこの割合を超えたら一段下げる
+QUALITY_UP_FRAC         = 0.45   # 窓の p90 がこれを下回り続けたら一段上げる
+QUALITY_UP_HOLD_SEC     = 4.0
+QUALITY_UP_HOLD_MAX_SEC = 64.0
+
+
+class QualityController:
+    def __init__(self, budget_ms: float = FRAME_INTERVAL_MS, on_change=None, clock=time.monotonic):
+        self.budget_ms = budget_ms
+        self.on_change = on_change      # on_change(tier)
+        self.clock = clock
+        self.level = 0
+        self.pinned = None              # 固定中のティア番号（None = 自動）
+        self.changes = 0
+        self._win = np.zeros(QUALITY_WINDOW, np.float32)
+        self._n = 0
+        self._acc = 0.0
+        self._hold = QUALITY_UP_HOLD_SEC
+        self._headroom_since = None
+        self._last_up = self._last_down = -1e9
+
+    @property
+    def tier(self) -> QualityTier:
+        return QUALITY_TIERS[self.level]
+
+    @staticmethod
+    def level_of(name: str):
+        for i, t in enumerate(QUALITY_TIERS):
+            if t.name == name: return i
+        return None
+
+    def pin(self, level):
+        """level を固定（None で自動に戻す）"""
+        self.pinned = None if level is None else max(0, min(len(QUALITY_TIERS) - 1, int(level)))
+        self._n = 0; self._acc = 0.0; self._headroom_since = None
+        if self.pinned is not None: self._set(self.pinned)
+
+    def observe(self, ms: float):
+        self._acc += ms
+
+    def discard(self):
+        """まだ締めていない分を捨てる（フレームが止まっている間の再描画を次のフレームに付けない）"""
+        self._acc = 0.0
+
+    def end_frame(self):
+        ms, self._acc = self._acc, 0.0
+        self._win[self._n % QUALITY_WINDOW] = ms
+        self._n += 1
+        if self.pinned is not None or self._n < QUALITY_WINDOW: return
+        p90 = float(np.partition(self._win, int(QUALITY_WINDOW * 0.9))[int(QUALITY_WINDOW * 0.9)])
+        now = self.clock()
+        if p90 > self.budget_ms * QUALITY_DOWN_FRAC:
+            if self.level < len(QUALITY_TIERS) - 1:
+                # 上げてすぐ落ちたなら振動している 次の上げを待たせる
+                if self._last_up > self._last_down and now - self._last_up < 2.0 * self._hold:
+                    self._hold = min(QUALITY_UP_HOLD_MAX_SEC, self._hold * 2.0)
+                self._last_down = now
+                self._set(self.level + 1)
+            return
+        if p90 < self.budget_ms * QUALITY_UP_FRAC and self.level > 0:
+            if self._headroom_since is None:
+                self._headroom_since = now
+            elif now - self._headroom_since >= self._hold:
+                self._last_up = now
+                self._set(self.level - 1)
+        else:
+            self._headroom_since = None
+
+    def _set(self, level: int):
+        self._n = 0; self._headroom_since = None
+        if level == self.level: return
+        self.level = level
+        self.changes += 1
+        if self.on_change: self.on_change(self.tier)
+
+
+# ----------------- 描画スレッド -----------------
+# RainCanvas の粒子を進めて QImage の裏バッファに描き 描けたら表と入れ替えて frame_ready を出す
+# 動くものが無くなったら止まり _wake_frames で起きる（GUI スレッドが詰まっても刻みは崩れない）
+class _RenderThread(QThread):
+    frame_ready = Signal()
+
+    def __init__(self, canvas):
+        super().__init__(canvas)
+        self.setObjectName("rainecho-render")
+        self.canvas = canvas
+        self.interval_ms = FRAME_INTERVAL_MS
+        self._wake = threading.Event()
+        self._quit = False
+
+    def wake(self, interval_ms: int = None):
+        if interval_ms is not None: self.interval_ms = interval_ms
+        self._wake.set()
+
+    def idle(self):
+        # canvas の _sim_lock の中から呼ぶ（起こす側はロックを出てから wake する）
+        self._wake.clear()
+
+    def stop(self):
+        # 描きかけのフレームが終わるまで待つ（戻った後は canvas に触らない）
+        self._quit = True
+        self._wake.set()
+        self.wait()
+
+    def run(self):
+        last = time.monotonic(); nxt = last
+        while not self._quit:
+            if not self._wake.is_set():
+                self._wake.wait()
+                last = nxt = time.monotonic()
+                continue
+            now = time.monotonic()
+            self.canvas._render_step(now - last, self)
+            last = now
+            iv = self.interval_ms / 1000.0
+            nxt = nxt + iv if nxt + iv > now else now + iv   # 遅れたら追いつこうとせず刻み直す
+            time.sleep(max(0.0, nxt - time.monotonic()))
+
+
+# ----------------- デッドラインスケジューラ -----------------
+# 期限のヒープ＋次の期限に合わせて張り直す単発 QTimer  期限と期限の間はプロセスを起こさない
+# 時刻は単調時計（壁時計が飛んでも スリープ復帰でも 予定外に発火しない）
+class DeadlineScheduler:
+    def __init__(self, parent=None, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []            # (deadline, seq, key)  取り消し/張り替えは seq で無効化
+        self._entries = {}         # key -> (deadline, seq, callback)
+        self._seq = 0
+        self.timer = QTimer(parent)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.CoarseTimer)
+        self.timer.timeout.connect(self._fire)
+
+    def schedule(self, key, delay_sec: float, callback):
+        """key の予定を delay_sec 後に（既にあれば置き換え）"""
+        self._seq += 1
+        dl = self.clock() + max(0.0, float(delay_sec))
+        self._entries[key] = (dl, self._seq, callback)
+        heapq.heappush(self._heap, (dl, self._seq, key))
+        self._rearm()
+
+    def cancel(self, key):
+        if self._entries.pop(key, None) is not None:
+            self._rearm()
+
+    def deadline(self, key):
+        e = self._entries.get(key)
+        return e[0] if e else None
+
+    def remaining(self, key):
+        dl = self.deadline(key)
+        return None if dl is None else max(0.0, dl - self.clock())
+
+    def _prune(self):
+        h = self._heap
+        while h:
+            dl, seq, key = h[0]
+            e = self._entries.get(key)
+            if e is not None and e[1] == seq: break
+            heapq.heappop(h)
+
+    def _rearm(self):
+        self._prune()
+        if not self._heap:
+            self.timer.stop(); return
+        ms = max(0, math.ceil((self._heap[0][0] - self.clock()) * 1000.0))
+        self.timer.start(min(ms, 0x7FFFFFFF))
+
+    def next_deadline(self):
+        self._prune()
+        return self._heap[0][0] if self._heap else None
+
+    def run_due(self):
+        """期限が来た予定をすべて呼ぶ（時計を手で進めたときはこれを呼ぶ）"""
+        self._fire()
+
+    def _fire(self):
+        now = self.clock()
+        while True:
+            self._prune()
+            if not self._heap or self._heap[0][0] > now: break
+            _, seq, key = heapq.heappop(self._heap)
+            _, _, cb = self._entries.pop(key)
+            cb()
+        self._rearm()
+
+
+# ----------------- 仮想時計 -----------------
+# clock を受け取るもの（RainCanvas / MainWindow / DeadlineScheduler）に差すと 時間を手で進められる
+# QTimer は実時間のままなので 早送りでは期限やフレームを呼ぶ側（RAINECHO_BENCH.py soak）が回す
+class VirtualClock:
+    def __init__(self, t0: float = 0.0):
+        self.t = float(t0)
+
+    def __call__(self) -> float:
+        return self.t
+
+    def advance(self, dt: float) -> float:
+        self.t += max(0.0, float(dt))
+        return self.t
+
+    def set(self, t: float) -> float:
+        """t まで進める（戻しはしない）"""
+        self.t = max(self.t, float(t))
+        return self.t
+
+
+# ----------------- スプライトキャッシュ -----------------
+# 波紋リングと雨粒の筋を一度だけアンチエイリアス描画して QPixmap に焼き 以降は貼るだけにする
+# LRU（件数とバイト数の両方で上限）  DPR やキャンバスサイズが変わったら作り直す
+def _bucket(v: float, step: float) -> float:
+    return max(step, round(v / step) * step)
+
+def _bucket_radius(r: float) -> float:
+    if r <= 64.0:
+        return _bucket(r, SPRITE_RADIUS_STEP)
+    q = math.log1p(SPRITE_RADIUS_REL)
+    return round(math.exp(round(math.log(r) / q) * q), 2)
+
+
+class SpriteCache:
+    def __init__(self, color: QColor = COLOR_RIPPLE,
+                 max_bytes: int = SPRITE_CACHE_MAX_BYTES, max_items: int = SPRITE_CACHE_MAX_ITEMS,
+                 image: bool = False):
+        self.color = QColor(color)
+        self.image = image          # True: QImage で持つ（GUI スレッド以外で描くとき）
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.dpr = 1.0
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()   # key -> (pixmap, ox, oy, nbytes)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self): return len(self._items)
+
+    @property
+    def nbytes(self) -> int: return self._bytes
+
+    def clear(self):
+        self._items.clear()
+        self._bytes = 0
+
+    def set_dpr(self, dpr: float):
+        # 倍率はキーに含めるので切り替えても捨てない（縮小描画の出入りで作り直さない）
+        self.dpr = dpr
+
+    def _get(self, key, build):
+        it = self._items.get(key)
+        if it is not None:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return it
+        self.misses += 1
+        pm, ox, oy = build()
+        nbytes = pm.width() * pm.height() * 4
+        it = (pm, ox, oy, nbytes)
+        self._items[key] = it
+        self._bytes += nbytes
+        while len(self._items) > 1 and (self._bytes > self.max_bytes or len(self._items) > self.max_items):
+            _, old = self._items.popitem(last=False)
+            self._bytes -= old[3]
+        return it
+
+    def _canvas(self, w: float, h: float):
+        pw, ph = max(1, math.ceil(w * self.dpr)), max(1, math.ceil(h * self.dpr))
+        pm = QImage(pw, ph, QImage.Format_ARGB32_Premultiplied) if self.image else QPixmap(pw, ph)
+        pm.setDevicePixelRatio(self.dpr)
+        pm.fill(Qt.transparent)
+        p = QPainter(pm); p.setRenderHint(QPainter.Antialiasing, True)
+        return pm, p
+
+    @staticmethod
+    def alpha_bucket(alpha: int) -> int:
+        """αが属するバケットの上端（焼き込むα）"""
+        return min(255, (int(alpha) // SPRITE_ALPHA_STEP + 1) * SPRITE_ALPHA_STEP)
+
+    def ring(self, r: float, width: float, alpha: int):
+        """(pixmap, ox, oy, nbytes)  ox/oy は中心から左上までのずれ"""
+        key = ("ring", self.dpr, _bucket_radius(r), _bucket(width, SPRITE_WIDTH_STEP), self.alpha_bucket(alpha))
+        return self._get(key, lambda: self._build_ring(key[2], key[3], key[4]))
+
+    def _build_ring(self, r: float, width: float, alpha: int):
+        half = math.ceil(r + width * 0.5 + 1)
+        pm, p = self._canvas(half * 2, half * 2)
+        c = QColor(self.color); c.setAlpha(alpha)
+        p.setPen(QPen(c, width)); p.setBrush(Qt.NoBrush)
+        p.drawEllipse(QPointF(half, half), r, r)
+        p.end()
+        return pm, half, half
+
+    def streak(self, alpha: int):
+        key = ("streak", self.dpr, self.alpha_bucket(alpha))
+        return self._get(key, lambda: self._build_streak(key[2]))
+
+    def _build_streak(self, alpha: int):
+        pm, p = self._canvas(6, 12)
+        c = QColor(self.color); c.setAlpha(alpha)
+        p.setPen(QPen(c, 2))
+        p.drawLine(QPointF(3, 2), QPointF(3, 8))
+        p.end()
+        return pm, 3, 8
+
+
+# ----------------- 合成SEフォールバック -----------------
+# 生成済み PCM はパラメータから求めたハッシュ名でディスクに置き 次回以降は mmap で読むだけにする
+PCM_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                             "rainecho", "pcm")
+RAIN_SE_SEED = 20250804
+
+def _pcm_cache_path(tag: str, **params) -> str:
+    key = tag + "|" + "|".join(f"{k}={params[k]!r}" for k in sorted(params))
+    return os.path.join(PCM_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pcm")
+
+def _pcm_cache_load(path: str):
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0: return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+
+def _pcm_cache_store(path: str, data: bytes):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+def _one_pole_lowpass(x, alpha: float, y0: float = 0.0, block: int = 128):
+    """y[i] = y[i-1] + alpha*(x[i] - y[i-1]) をブロック単位の累積和で一括計算する
+    ブロック内は r^-k で割り戻した cumsum  ブロック間の持ち越しだけ逐次"""
+    x = np.asarray(x, np.float64)
+    n = len(x)
+    if n == 0: return x.copy()
+    r = 1.0 - alpha
+    nb = -(-n // block)
+    xb = np.zeros(nb * block, np.float64); xb[:n] = x
+    xb = xb.reshape(nb, block)
+    k = np.arange(block, dtype=np.float64)
+    rk = r ** k
+    z = np.cumsum(xb * (alpha / rk), axis=1) * rk           # 各ブロックを 0 から始めた応答
+    carry_gain = r ** (k + 1)                                # 直前ブロック末尾の値が及ぼす寄与
+    y = np.empty_like(z)
+    prev = y0
+    for b in range(nb):
+        y[b] = z[b] + carry_gain * prev
+        prev = y[b, -1]
+    return y.reshape(-1)[:n]
+
+def _synth_soft_hush(sr: int, ch: int, dur: float, seed: int) -> bytes:
+    rng = np.random.default_rng(seed)
+    n = int(sr*dur)
+    up = int(0.12*n); down = int(0.45*n)
+    w = rng.random(n) * 2 - 1
+    lp = _one_pole_lowpass(w, 0.12)
+    env = np.ones(n, np.float64)
+    env[:up] = np.arange(up) / max(1, up)
+    tail = np.arange(max(0, n - down + 1), n)
+    env[tail] = np.maximum(0.0, (n - tail) / max(1, down))
+    v = (np.clip(lp * 0.45 * env, -1.0, 1.0) * 32767).astype(np.int16)
+    if ch > 1:
+        v = np.repeat(v, ch)
+    return v.tobytes()
+
+def _mk_soft_hush(sr=48000, ch=2, dur=5.5, seed=RAIN_SE_SEED, use_cache=True):
+    if not use_cache:
+        return _synth_soft_hush(sr, ch, dur, seed)
+    path = _pcm_cache_path("soft_hush.v1", sr=int(sr), ch=int(ch), dur=float(dur), seed=int(seed))
+    cached = _pcm_cache_load(path)
+    if cached is not None:
+        return cached
+    data = _synth_soft_hush(sr, ch, dur, seed)
+    _pcm_cache_store(path, data)
+    return data
+
+# ----------------- プロファイラ（計測フック＋リング） -----------------
+# @profiled を付けた関数の所要時間を固定長リングに記録する 無効時は enabled を見て素通りするだけ
+# 現場のカクつき調査用に JSON で書き出せる（Ctrl+P でオーバーレイ Ctrl+Shift+P で書き出し）
+PROFILE_RING_SIZE = 2048
+PROFILE_DIR = os.path.join(os.path.dirname(PCM_CACHE_DIR), "profiles")
+PROFILE_KINDS = ("frame", "paint", "spawn", "set_state")
+
+_PROFILE_DTYPE = np.dtype([("kind", "u1"), ("t", "f8"), ("ms", "f4"),
+                           ("ripples", "i4"), ("drops", "i4"), ("dt_ms", "f4")])
+
+class Profiler:
+    def __init__(self, size: int = PROFILE_RING_SIZE):
+        self.enabled = False
+        self.buf = np.zeros(size, _PROFILE_DTYPE)
+        self.n = 0                 # 記録した総数（リング位置は n % size）
+        self.dropped_frames = 0
+
+    def clear(self):
+        self.n = 0; self.dropped_frames = 0
+
+    def record(self, kind: int, t0: float, ms: float, ripples=0, drops=0, dt_ms=0.0):
+        self.buf[self.n % len(self.buf)] = (kind, t0, ms, ripples, drops, dt_ms)
+        self.n += 1
+        if dt_ms > 1.5 * FRAME_INTERVAL_MS and kind == 0:
+            # 実際に進んだ時間から 描けなかったフレーム数を数える
+            iv = FRAME_INTERVAL_SLEEP_MS if dt_ms > 1.5 * FRAME_INTERVAL_SLEEP_MS else FRAME_INTERVAL_MS
+            self.dropped_frames += max(0, int(round(dt_ms / iv)) - 1)
+
+    def samples(self, kind: int = None):
+        """古い順に並べたコピー"""
+        size = len(self.buf)
+        if self.n <= size:
+            out = self.buf[:self.n].copy()
+        else:
+            i = self.n % size
+            out = np.concatenate((self.buf[i:], self.buf[:i]))
+        return out if kind is None else out[out["kind"] == kind]
+
+    def summary(self) -> dict:
+        out = {"recorded": self.n, "dropped_frames": self.dropped_frames}
+        for k, name in enumerate(PROFILE_KINDS):
+            ms = self.samples(k)["ms"]
+            if len(ms):
+                out[name] = {"count": int(len(ms)), "mean_ms": float(ms.mean()),
+                             "p95_ms": float(np.percentile(ms, 95)), "max_ms": float(ms.max())}
+        return out
+
+    def export_json(self, path: str = None) -> str:
+        if path is None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S.json"))
+        s = self.samples()
+        doc = {
+            "app": APP_TITLE, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": sys.platform, "frame_interval_ms": FRAME_INTERVAL_MS,
+            "summary": self.summary(),
+            "samples": [{"kind": PROFILE_KINDS[k], "t": t, "ms": round(float(ms), 4),
+                         "ripples": int(r), "drops": int(d), "dt_ms": round(float(dt), 3)}
+                        for k, t, ms, r, d, dt in s.tolist()],
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(doc, f, ensure_ascii=False)
+        return path
+
+
+PROFILER = Profiler()
+
+def profiled(kind: str, extra=None):
+    """extra(self, *args) -> (ripples, drops, dt_ms) を渡すと一緒に記録する"""
+    k = PROFILE_KINDS.index(kind)
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kw):
+            if not PROFILER.enabled:
+                return fn(*args, **kw)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kw)
+            finally:
+                ms = (time.perf_counter() - t0) * 1000.0
+                if extra is None: PROFILER.record(k, t0, ms)
+                else: PROFILER.record(k, t0, ms, *extra(*args, **kw))
+        return wrapper
+    return deco
+
+def _frame_extra(canvas, dt: float = FRAME_INTERVAL_MS / 1000.0):
+    return canvas.particles.ripple_count, canvas.particles.drop_count, dt * 1000.0
+
+
+class ProfilerOverlay(QWidget):
+    """右上に出すフレーム時間グラフ（マウスは素通し）"""
+    GRAPH_N = 120
+
+    def __init__(self, parent: QWidget):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents, True)
+        self.setAttribute(Qt.WA_NoSystemBackground, True)
+        self.setFixedSize(260, 130)
+        self.setVisible(False)
+        self.refresh = QTimer(self); self.refresh.timeout.connect(self.update)
+
+    def toggle(self):
+        on = not self.isVisible()
+        PROFILER.enabled = on
+        if on:
+            PROFILER.clear()
+            self.reposition(); self.raise_(); self.refresh.start(250)
+        else:
+            self.refresh.stop()
+        self.setVisible(on)
+
+    def reposition(self):
+        mw = self.parent()
+        header = getattr(mw, "header", None)
+        top = header.height() if header is not None else 0
+        self.move(mw.width() - self.width() - 8, top + 8)
+
+    def paintEvent(self, e):
+        p = QPainter(self)
+        p.fillRect(self.rect(), QColor(0, 0, 0, 150))
+        fr = PROFILER.samples(0)[-self.GRAPH_N:]
+        pa = PROFILER.samples(1)[-self.GRAPH_N:]
+        gx, gy, gw, gh = 8, 44, self.width() - 16, self.height() - 52
+        scale = gh / (2.0 * FRAME_INTERVAL_MS)        # 縦軸 0〜2 フレーム分
+        bw = gw / self.GRAPH_N
+        # 1本のスロットを左右に分けて 左=更新(_on_frame) 右=描画(paintEvent)
+        p.setPen(Qt.NoPen)
+        for series, color, off in ((fr["ms"], QColor("#7FD6D0"), 0.0), (pa["ms"], QColor(255, 200, 90), 0.5)):
+            p.setBrush(color)
+            for i, ms in enumerate(series.tolist()):
+                h = min(gh, ms * scale)
+                p.drawRect(QRectF(gx + (i + off) * bw, gy + gh - h, max(1.0, bw * 0.5), h))
+        p.setPen(QPen(QColor(255, 90, 90), 1))
+        yb = gy + gh - FRAME_INTERVAL_MS * scale
+        p.drawLine(QPointF(gx, yb), QPointF(gx + gw, yb))
+        p.setPen(Qt.white)
+        f = QFont(); f.setPointSize(8); p.setFont(f)
+        last = fr[-1] if len(fr) else None
+        fms = float(fr["ms"].mean()) if len(fr) else 0.0
+        pms = float(pa["ms"].mean()) if len(pa) else 0.0
+        p95 = float(np.percentile(pa["ms"], 95)) if len(pa) else 0.0
+        p.drawText(8, 14, f"update {fms:.2f}ms  paint {pms:.2f}ms (p95 {p95:.2f})")
+        p.drawText(8, 28, f"ripples {int(last['ripples']) if last is not None else 0}  "
+                          f"drops {int(last['drops']) if last is not None else 0}  "
+                          f"dropped {PROFILER.dropped_frames}")
+        q = getattr(getattr(self.parent(), "canvas", None), "quality", None)
+        tier = f"tier {q.tier.name}{'' if q.pinned is None else '(固定)'}  " if q is not None else ""
+        p.drawText(8, 40, tier + "Ctrl+Shift+P: JSON 書き出し")
+        p.end()
+
+
+# ----------------- メトリクス -----------------
+# 台数の多い現場向けに Prometheus のテキスト形式で状態を出す（既定は無効）
+#   RAINECHO_METRICS=9464 / 127.0.0.1:9464 で localhost に HTTP  file:/path/rainecho.prom で定期スナップショット
+# カウンタとヒストグラムはスレッドごとのシャードに足すだけ（ロックなし） 合計は取得時にまとめる
+# 粒子数やオーディオの遅延などはその場で読めば済むので 取得時に呼ぶゲージ関数にする
+METRICS_ADDR = os.environ.get("RAINECHO_METRICS", "")
+METRICS_FILE_INTERVAL_SEC = float(os.environ.get("RAINECHO_METRICS_INTERVAL", "15"))
+METRICS_FRAME_BUCKETS_MS = (1.0, 2.0, 4.0, 8.0, 12.0, 16.0, 24.0, 33.0, 50.0, 100.0, 250.0)
+
+
+def _metric_labels(names, values) -> str:
+    if not names: return ""
+    esc = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(names, esc)) + "}"
+
+
+class _Sharded:
+    """スレッドごとに自分の dict にだけ書く（書き手同士も読み手とも競合しない）"""
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name; self.help = help; self.labels = tuple(labels)
+        self._shards = {}
+
+    def _shard(self) -> dict:
+        d = self._shards.get(threading.get_ident())
+        if d is None:
+            d = self._shards[threading.get_ident()] = {}
+        return d
+
+    def _merged(self) -> dict:
+        out = {}
+        for d in list(self._shards.values()):
+            for k, v in list(d.items()):
+                out[k] = self._add(out.get(k), v)
+        return out
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, *labels, n: float = 1):
+        d = self._shard(); d[labels] = d.get(labels, 0) + n
+
+    @staticmethod
+    def _add(a, b): return b if a is None else a + b
+
+    def value(self, *labels) -> float:
+        return self._merged().get(labels, 0)
+
+    def render(self):
+        for k, v in sorted(self._merged().items()):
+            yield f"{self.name}{_metric_labels(self.labels, k)} {v}"
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.bounds = tuple(float(b) for b in buckets)
+
+    def observe(self, v: float, *labels):
+        d = self._shard()
+        h = d.get(labels)
+        if h is None: h = d[labels] = [0] * (len(self.bounds) + 1) + [0.0]   # 各バケット / +Inf / 合計
+        h[bisect.bisect_left(self.bounds, v)] += 1
+        h[-1] += v
+
+    @staticmethod
+    def _add(a, b): return list(b) if a is None else [x + y for x, y in zip(a, b)]
+
+    def render(self):
+        for k, h in sorted(self._merged().items()):
+            acc = 0
+            for le, c in zip(self.bounds + (math.inf,), h[:-1]):
+                acc += c
+                lab = _metric_labels(self.labels + ("le",), k + ("+Inf" if le == math.inf else f"{le:g}",))
+                yield f"{self.name}_bucket{lab} {acc}"
+            yield f"{self.name}_sum{_metric_labels(self.labels, k)} {h[-1]:.6g}"
+            yield f"{self.name}_count{_metric_labels(self.labels, k)} {acc}"
+
+
+class Gauge:
+    """取得時に fn() を呼ぶ  fn は数値か [(ラベル値タプル, 数値), ...] を返す"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn, labels=()):
+        self.name = name; self.help = help; self.fn = fn; self.labels = tuple(labels)
+
+    def render(self):
+        v = self.fn()
+        if v is None: return
+        for k, x in (v if isinstance(v, list) else [((), v)]):
+            yield f"{self.name}{_metric_labels(self.labels, k)} {x if isinstance(x, int) else f'{x:.6g}'}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.enabled = False          # 無効なら計測フックは enabled を見て素通り
+        self.metrics = {}
+        self.collectors = {}          # name -> fn  出力の直前に呼ぶ（状態の経過時間を締めるなど）
+
+    def _add(self, m):
+        self.metrics[m.name] = m; return m
+
+    def counter(self, name, help, labels=()): return self.metrics.get(name) or self._add(Counter(name, help, labels))
+    def histogram(self, name, help, buckets, labels=()):
+        return self.metrics.get(name) or self._add(Histogram(name, help, buckets, labels))
+    def gauge(self, name, help, fn, labels=()): return self._add(Gauge(name, help, fn, labels))
+    def collector(self, name, fn): self.collectors[name] = fn     # 同名は置き換え（何度登録しても1つ）
+
+    def unregister(self, *names):
+        for n in names:
+            self.metrics.pop(n, None); self.collectors.pop(n, None)
+
+    def render(self) -> str:
+        for fn in list(self.collectors.values()):
+            fn()
+        lines = []
+        for m in self.metrics.values():
+            try:
+                body = list(m.render())
+            except Exception as ex:                   # 1つ壊れても他は出す
+                lines.append(f"# {m.name} failed: {type(ex).__name__}"); continue
+            lines.append(f"# HELP {m.name} {m.help}"); lines.append(f"# TYPE {m.name} {m.kind}")
+            lines += body
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+M_FRAME_MS = METRICS.histogram("rainecho_frame_ms", "Canvas frame cost (update or paint) in ms",
+                               METRICS_FRAME_BUCKETS_MS, ("phase",))
+M_TRANSITIONS = METRICS.counter("rainecho_state_transitions_total", "State transitions by cause", ("cause", "to"))
+M_STATE_SEC = METRICS.counter("rainecho_state_seconds_total", "Time spent in each state", ("state",))
+M_UNDERRUNS = METRICS.counter("rainecho_audio_underruns_total", "Output stream underruns")
+
+
+def process_rss_bytes():
+    """常駐メモリ（Linux は /proc 他は getrusage の最大値）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+    except (ImportError, OSError):
+        return None
+
+METRICS.gauge("rainecho_process_rss_bytes", "Resident set size", process_rss_bytes)
+
+
+class MetricsExporter(QObject):
+    """addr: "9464" / "host:port" は HTTP（GUI スレッドの QTcpServer）  "file:path" は定期書き出し"""
+    def __init__(self, addr: str, registry: MetricsRegistry = METRICS, parent=None,
+                 interval_sec: float = METRICS_FILE_INTERVAL_SEC):
+        super().__init__(parent)
+        self.registry = registry
+        self.server = None; self.timer = None; self.path = None
+        self.scrapes = 0
+        registry.enabled = True
+        if addr.startswith("file:"):
+            self.path = addr[5:]
+            self.timer = QTimer(self); self.timer.timeout.connect(self.write_snapshot)
+            self.timer.start(int(interval_sec * 1000))
+            return
+        from PySide6.QtNetwork import QTcpServer, QHostAddress
+        host, _, port = addr.rpartition(":")
+        self.server = QTcpServer(self)
+        self.server.newConnection.connect(self._on_connection)
+        if not self.server.listen(QHostAddress(host or "127.0.0.1"), int(port)):
+            print(f"[metrics] {addr} で待ち受けできませんでした: {self.server.errorString()}", file=sys.stderr)
+
+    def write_snapshot(self):
+        body = self.registry.render().encode("utf-8")
+        self.scrapes += 1
+        self._store(self.path, body)
+
+    @staticmethod
+    def _store(path: str, data: bytes):
+        # 一時ファイル経由で置き換え（読み手が半端な内容を見ない）  失敗は黙らず stderr へ
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            d = os.path.dirname(path)
+            if d: os.makedirs(d, exist_ok=True)       # "metrics.prom" のような素の相対パスは makedirs しない
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as ex:
+            print(f"[metrics] {path} に書き出せませんでした: {ex}", file=sys.stderr)
+            try: os.unlink(tmp)
+            except OSError: pass
+
+    def _on_connection(self):
+        while self.server.hasPendingConnections():
+            s = self.server.nextPendingConnection()
+            s.readyRead.connect(lambda s=s: self._reply(s))
+            s.disconnected.connect(s.deleteLater)
+
+    def _reply(self, s):
+        req = bytes(s.readAll())
+        if b"\r\n\r\n" not in req and b"\n\n" not in req: return   # ヘッダの残りを待つ
+        path = req.split(b" ", 2)[1] if req.count(b" ") >= 2 else b"/"
+        if path.split(b"?")[0] in (b"/", b"/metrics"):
+            body = self.registry.render().encode("utf-8"); status = b"200 OK"
+            self.scrapes += 1
+        else:
+            body = b"not found\n"; status = b"404 Not Found"
+        s.write(b"HTTP/1.0 " + status + b"\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+        s.disconnectFromHost()
+
+    def shutdown(self):
+        if self.server is not None: self.server.close()
+        if self.timer is not None: self.timer.stop(); self.write_snapshot()
+
+
+# ----------------- PCM ストリーム出力（プル型） -----------------
+# シンクが readData で引き出す QIODevice  生産者（合成/デコード/TTS）は chunk を参照のまま積むだけでコピーしない
+# 積まれた chunk の参照を並べたリングで シンクへ渡すときに初めて1回だけ連結される
+PCM_TARGET_LATENCY_MS = 60
+PCM_STREAM_CAPACITY_SEC = 10.0
+
+class PCMStream(QIODevice):
+    def __init__(self, parent=None, sr=48000, ch=2, capacity_sec=PCM_STREAM_CAPACITY_SEC):
+        super().__init__(parent)
+        self.sr = sr; self.ch = ch
+        self.frame_bytes = 2 * ch
+        self.capacity = int(capacity_sec * sr) * self.frame_bytes
+        self._chunks: "deque[memoryview]" = deque()
+        self._queued = 0
+        self._live = False        # 生産者がまだ書き込み中（空になったらアンダーラン扱い）
+        self._lock = threading.Lock()
+        self.underruns = 0
+        self.overruns = 0
+        self.bytes_out = 0
+
+    def bytes_for_ms(self, ms: float) -> int:
+        return max(1, int(self.sr * ms / 1000.0)) * self.frame_bytes
+
+    # --- 生産者側 ---
+    def push(self, chunk) -> bool:
+        """chunk（bytes/mmap/ndarray など）を参照で積む 容量を超えていたら積まずに False"""
+        mv = memoryview(chunk).cast("B")
+        if len(mv) == 0: return True
+        with self._lock:
+            if self._queued >= self.capacity:
+                self.overruns += 1
+                return False
+            self._chunks.append(mv)
+            self._queued += len(mv)
+            self._live = True
+        self.readyRead.emit()
+        return True
+
+    def finish(self):
+        """今積んだぶんで終わり（以降 空になってもアンダーランに数えない）"""
+        with self._lock:
+            self._live = False
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self._queued = 0
+            self._live = False
+
+    def fill(self) -> int:
+        return self._queued
+
+    def fill_ms(self) -> float:
+        return 1000.0 * self._queued / (self.sr * self.frame_bytes)
+
+    # --- QIODevice（シンク側） ---
+    def isSequential(self) -> bool:
+        return True
+
+    def bytesAvailable(self) -> int:
+        return self._queued + super().bytesAvailable()
+
+    @property
+    def drained(self) -> bool:
+        """finish 済みで積んだぶんも出し切った"""
+        return not self._live and self._queued == 0
+
+    def readData(self, maxlen: int):
+        return self.pull(maxlen)
+
+    def pull(self, maxlen: int) -> bytes:
+        """先頭から最大 maxlen バイト 書き込み中に足りなければ無音で埋める"""
+        maxlen -= maxlen % self.frame_bytes
+        out = []; got = 0
+        with self._lock:
+            while self._chunks and got < maxlen:
+                mv = self._chunks[0]
+                take = min(len(mv), maxlen - got)
+                out.append(mv[:take])
+                if take == len(mv): self._chunks.popleft()
+                else: self._chunks[0] = mv[take:]
+                got += take
+            self._queued -= got
+            starving = self._live and got < maxlen
+            if starving:
+                self.underruns += 1
+                if METRICS.enabled: M_UNDERRUNS.inc()
+        if starving:
+            # 生産が追いつかない間は無音で埋めてシンクを止めない
+            out.append(bytes(maxlen - got)); got = maxlen
+        self.bytes_out += got
+        return b"".join(out)
+
+    def writeData(self, data) -> int:
+        b = bytes(data)
+        return len(b) if self.push(b) else 0
+
+
+# ----------------- オーディオデバイス一覧 -----------------
+# QMediaDevices の列挙は GUI スレッドで 起動時（初回描画の後）に1回と 抜き差しの変更通知のときだけ行う
+# 重い preferredFormat の問い合わせは専用スレッドに回す  設定画面などはキャッシュを読むだけで列挙しない
+# 抜き差しは audioInputsChanged / audioOutputsChanged を受けてその種類だけ取り直す（既知の機器は再問い合わせしない）
+DEVICE_KINDS = ("in", "out")
+
+
+def _dev_key(device_id):
+    """QAudioDevice.id()（QByteArray）/ bytes をキャッシュのキーにそろえる"""
+    if device_id is None: return None
+    if isinstance(device_id, QByteArray): return bytes(device_id.data())
+    return bytes(device_id)
+
+
+class AudioDeviceInfo:
+    __slots__ = ("kind", "key", "id", "description", "device", "sample_rate", "channels", "sample_format")
+
+    def __init__(self, kind: str, dev):
+        pf = dev.preferredFormat()
+        self.kind = kind
+        self.device = dev
+        self.id = dev.id()
+        self.key = _dev_key(self.id)
+        self.description = dev.description()
+        self.sample_rate = pf.sampleRate()
+        self.channels = pf.channelCount()
+        self.sample_format = pf.sampleFormat()
+
+    def __repr__(self):
+        return f"AudioDeviceInfo({self.kind}, {self.description!r}, {self.sample_rate}Hz/{self.channels}ch)"
+
+
+class _DeviceScanWorker(QObject):
+    scanned = Signal(str, object, object)     # kind, [AudioDeviceInfo], 既定デバイスのキー
+
+    def __init__(self):
+        super().__init__()
+        self.known = {k: {} for k in DEVICE_KINDS}
+
+    @Slot(str, object, object)
+    def probe(self, kind: str, devs, default_key):
+        # QAudioDevice は値で受け取る  一度調べた端末は使い回す
+        known = self.known[kind]; infos = []
+        for d in devs:
+            info = known.get(_dev_key(d.id()))
+            infos.append(info if info is not None else AudioDeviceInfo(kind, d))
+        self.known[kind] = {i.key: i for i in infos}
+        self.scanned.emit(kind, infos, default_key)
+
+
+class AudioDeviceRegistry(QObject):
+    changed = Signal(str)      # "in" / "out" の一覧が更新された
+    _probe_req = Signal(str, object, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.enabled = _ensure_qtmedia()
+        self._infos = {k: [] for k in DEVICE_KINDS}
+        self._default = {k: None for k in DEVICE_KINDS}
+        self._ready = {k: False for k in DEVICE_KINDS}
+        self._listed_default = {k: None for k in DEVICE_KINDS}    # 列挙した時点の既定 QAudioDevice（調べ終わる前の resolve 用）
+        self.scans = 0
+        if not self.enabled: return
+        self.thread = QThread(self)
+        self.thread.setObjectName("rainecho-devices")
+        self.worker = _DeviceScanWorker()
+        self.worker.moveToThread(self.thread)
+        self._probe_req.connect(self.worker.probe)
+        self.worker.scanned.connect(self._on_scanned)
+        self.thread.finished.connect(self.worker.deleteLater)
+        self.thread.start()
+        # QMediaDevices は GUI スレッドで持つ（変更通知もここで受ける）
+        self.media = QMediaDevices(self)
+        self.media.audioInputsChanged.connect(lambda: self.refresh("in"))
+        self.media.audioOutputsChanged.connect(lambda: self.refresh("out"))
+        for k in DEVICE_KINDS: self.refresh(k)
+
+    def refresh(self, kind: str):
+        """GUI スレッドで同期に列挙する  呼ぶのは起動時と audioInputsChanged / audioOutputsChanged だけ"""
+        if not self.enabled: return
+        if kind == "in":
+            devs = QMediaDevices.audioInputs(); dflt = QMediaDevices.defaultAudioInput()
+        else:
+            devs = QMediaDevices.audioOutputs(); dflt = QMediaDevices.defaultAudioOutput()
+        self._listed_default[kind] = dflt
+        self._probe_req.emit(kind, list(devs), None if dflt.isNull() else _dev_key(dflt.id()))
+
+    @Slot(str, object, object)
+    def _on_scanned(self, kind: str, infos, default_key):
+        self._infos[kind] = list(infos)
+        self._default[kind] = default_key
+        self._ready[kind] = True
+        self.scans += 1
+        self.changed.emit(kind)
+
+    def is_ready(self, kind: str) -> bool:
+        return self._ready[kind]
+
+    def inputs(self): return list(self._infos["in"])
+
+    def outputs(self): return list(self._infos["out"])
+
+    def find(self, kind: str, device_id):
+        key = _dev_key(device_id)
+        for info in self._infos[kind]:
+            if info.key == key: return info
+        return None
+
+    def default(self, kind: str):
+        infos = self._infos[kind]
+        for info in infos:
+            if info.key == self._default[kind]: return info
+        return infos[0] if infos else None
+
+    def resolve(self, kind: str, device_id=None):
+        """(QAudioDevice, AudioDeviceInfo | None) 見つからなければ既定デバイス"""
+        info = (self.find(kind, device_id) if device_id is not None else None) or self.default(kind)
+        if info is not None:
+            return info.device, info
+        # 形式を調べ終わる前は 列挙したときの既定デバイス（バックエンドには聞き直さない）
+        return self._listed_default[kind], None
+
+    def shutdown(self):
+        if not self.enabled: return
+        self.thread.quit(); self.thread.wait(2000)
+
+
+_DEVICE_REGISTRY = None
+
+def device_registry() -> AudioDeviceRegistry:
+    global _DEVICE_REGISTRY
+    if _DEVICE_REGISTRY is None:
+        app = QApplication.instance()
+        _DEVICE_REGISTRY = AudioDeviceRegistry(app)
+        if app is not None: app.aboutToQuit.connect(_DEVICE_REGISTRY.shutdown)
+    return _DEVICE_REGISTRY
+
+
+# ----------------- ミキサー -----------------
+# 同時に鳴る音（入場SE / TTS / 通知）を1本の QAudioSink ストリームに足し合わせる
+# ボイスは固定数のスロットに割り当て PCM は共有バッファ上のビュー（再生ごとのコピーなし）
+# 合成はブロック単位で numpy にまとめるので コストはクリップ長ではなくブロック長×発音数で決まる
+MIXER_VOICES     = 8
+MIXER_DUCK_BUSES = ("voice",)   # このバスが鳴っている間は他のバスを下げる
+MIXER_DUCK_GAIN  = 0.35
+MIXER_FADE_MS    = 8        # stop で切らずにこの長さで 0 へ寄せる（クリック防止）
+
+class _Voice:
+    __slots__ = ("gen", "active", "pcm", "pos", "stream", "gain", "cur", "bus", "loop", "started", "fade")
+
+    def __init__(self):
+        self.gen = 0; self.active = False
+        self.pcm = None; self.pos = 0; self.stream = None
+        self.gain = 1.0; self.cur = 1.0; self.bus = "se"; self.loop = False; self.started = 0
+        self.fade = 0             # フェードアウトの残りフレーム数（0 ならフェード中でない）
+
+
+class PCMMixer(QIODevice):
+    def __init__(self, parent=None, sr=48000, ch=2, voices=MIXER_VOICES):
+        super().__init__(parent)
+        self.sr = sr; self.ch = ch
+        self.frame_bytes = 2 * ch
+        self.slots = [_Voice() for _ in range(voices)]
+        self.sink = None
+        self._lock = threading.Lock()
+        self._acc = np.zeros((0, ch), np.float32)
+        self._out = np.zeros((0, ch), np.int16)
+        self._seq = 0
+        self.fade_frames = max(1, int(sr * MIXER_FADE_MS / 1000))
+        self.stolen = 0
+        self.blocks = 0
+        self.mix_ms = 0.0
+
+    def bytes_for_ms(self, ms: float) -> int:
+        return max(1, int(self.sr * ms / 1000.0)) * self.frame_bytes
+
+    # --- 発音 ---
+    def _alloc(self) -> int:
+        free = [i for i, v in enumerate(self.slots) if not v.active]
+        if free: return free[0]
+        # 空きがなければ ダッキング側でない一番古い声を奪う
+        cand = [i for i, v in enumerate(self.slots) if v.bus not in MIXER_DUCK_BUSES] or range(len(self.slots))
+        self.stolen += 1
+        return min(cand, key=lambda i: self.slots[i].started)
+
+    def _start(self, setup, gain: float, bus: str, loop: bool) -> int:
+        with self._lock:
+            i = self._alloc(); v = self.slots[i]
+            v.gen += 1; v.pos = 0; v.pcm = None; v.stream = None; v.fade = 0
+            setup(v)
+            v.gain = v.cur = float(gain); v.bus = bus; v.loop = loop
+            self._seq += 1; v.started = self._seq
+            v.active = True
+            vid = v.gen * len(self.slots) + i
+        self.readyRead.emit()
+        self._kick()
+        return vid
+
+    def play(self, pcm, gain: float = 1.0, bus: str = "se", loop: bool = False) -> int:
+        """pcm（bytes/mmap/ndarray）を参照のまま鳴らす  戻り値はボイスID"""
+        mv = memoryview(pcm).cast("B")
+        data = np.frombuffer(mv, np.int16, len(mv) // self.frame_bytes * self.ch).reshape(-1, self.ch)
+        def setup(v): v.pcm = data
+        return self._start(setup, gain, bus, loop)
+
+    def play_stream(self, stream: "PCMStream", gain: float = 1.0, bus: str = "voice") -> int:
+        """生産者が push し続ける PCMStream を鳴らす（finish して出し切ったら終わる）"""
+        def setup(v): v.stream = stream
+        return self._start(setup, gain, bus, False)
+
+    def _voice(self, vid: int):
+        v = self.slots[vid % len(self.slots)]
+        return v if v.active and not v.fade and v.gen == vid // len(self.slots) else None
+
+    def stop(self, vid: int):
+        """MIXER_FADE_MS かけて消す（スロットはフェードが終わるまで鳴り続ける）"""
+        with self._lock:
+            v = self._voice(vid)
+            if v is not None: v.fade = self.fade_frames
+
+    def set_gain(self, vid: int, gain: float):
+        with self._lock:
+            v = self._voice(vid)
+            if v is not None: v.gain = float(gain)
+
+    def is_playing(self, vid: int) -> bool:
+        return self._voice(vid) is not None
+
+    def active_count(self) -> int:
+        return sum(v.active for v in self.slots)
+
+    # --- 合成 ---
+    def mix(self, n: int):
+        """n フレームを合成して int16 (n, ch) のビューを返す（次の mix まで有効）"""
+        t0 = time.perf_counter()
+        if len(self._acc) < n:
+            self._acc = np.zeros((n, self.ch), np.float32)
+            self._out = np.zeros((n, self.ch), np.int16)
+        acc = self._acc[:n]; acc.fill(0.0)
+        with self._lock:
+            ducking = any(v.active and v.bus in MIXER_DUCK_BUSES for v in self.slots)
+            for v in self.slots:
+                if not v.active: continue
+                target = v.gain * (MIXER_DUCK_GAIN if ducking and v.bus not in MIXER_DUCK_BUSES else 1.0)
+                k = 0
+                while k < n and v.active:
+                    want = min(n - k, v.fade) if v.fade else n - k
+                    if v.stream is not None:
+                        b = v.stream.pull(want * self.frame_bytes)
+                        blk = np.frombuffer(b, np.int16).reshape(-1, self.ch)
+                        if v.stream.drained and len(blk) < want: v.active = False
+                    else:
+                        blk = v.pcm[v.pos:v.pos + want]
+                        v.pos += len(blk)
+                        if v.pos >= len(v.pcm):
+                            if v.loop and len(v.pcm): v.pos = 0
+                            else: v.active = False
+                    m = len(blk)
+                    if m == 0: break
+                    if v.fade:
+                        # 残りフェードで 0 に届く直線  届いたらスロットを空ける
+                        g = v.cur * (1.0 - np.arange(1, m + 1, dtype=np.float32) / v.fade)
+                        acc[k:k + m] += blk * g[:, None]
+                        v.cur = float(g[-1]); v.fade -= m
+                        if v.fade <= 0: v.active = False
+                    elif v.cur != target:
+                        # ゲインの変化はこの区間で直線に寄せる（クリック防止）
+                        g = np.linspace(v.cur, target, m, dtype=np.float32)[:, None]
+                        acc[k:k + m] += blk * g
+                        v.cur = target
+                    else:
+                        acc[k:k + m] += blk * np.float32(v.cur)
+                    k += m
+                if not v.active: v.pcm = None; v.stream = None
+        out = self._out[:n]
+        np.clip(acc, -32768.0, 32767.0, out=acc)
+        out[...] = acc
+        self.blocks += 1
+        self.mix_ms += (time.perf_counter() - t0) * 1000.0
+        return out
+
+    # --- QIODevice（シンク側） ---
+    def isSequential(self) -> bool:
+        return True
+
+    def bytesAvailable(self) -> int:
+        return (self.bytes_for_ms(PCM_TARGET_LATENCY_MS) if self.active_count() else 0) + super().bytesAvailable()
+
+    def readData(self, maxlen: int):
+        n = maxlen // self.frame_bytes
+        if n == 0 or not self.active_count():
+            return b""          # 何も鳴っていなければシンクは Idle で待つ（デバイスもスレッドも起こさない  次の発音で _kick）
+        return self.mix(n).tobytes()
+
+    def writeData(self, data) -> int:
+        return -1
+
+    def _kick(self):
+        # Idle に落ちたシンクは readyRead では引きに戻らないことがあるので 止まっていたら開き直す
+        if self.sink is not None and self.sink.state() in (QAudio.State.StoppedState, QAudio.State.IdleState):
+            self.sink.start(self)
+
+    def stats(self) -> dict:
+        return {"voices": self.active_count(), "slots": len(self.slots), "stolen": self.stolen,
+                "blocks": self.blocks, "mix_ms_per_block": self.mix_ms / max(1, self.blocks)}
+
+
+_MIXERS = {}
+
+def audio_mixer(sr: int = 48000, ch: int = 2, latency_ms: float = PCM_TARGET_LATENCY_MS) -> PCMMixer:
+    """フォーマットごとに1つ 共有のミキサーとシンク（QtMultimedia が無ければ None）"""
+    if not _ensure_qtmedia(): return None
+    m = _MIXERS.get((sr, ch))
+    if m is None:
+        app = QApplication.instance()
+        m = _MIXERS[(sr, ch)] = PCMMixer(app, sr=sr, ch=ch)
+        m.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+        dev, _ = device_registry().resolve("out")
+        fmt = dev.preferredFormat()
+        fmt.setSampleRate(sr); fmt.setChannelCount(ch)
+        fmt.setSampleFormat(QAudioFormat.SampleFormat.Int16)
+        m.sink = QAudioSink(dev, fmt, app)
+        m.sink.setBufferSize(m.bytes_for_ms(latency_ms))
+        m.sink.start(m)
+    return m
+
+
+class _PCMOut:
+    """共有ミキサーの上の1系統（play_bytes は自分の前の音だけを差し替え 他の系統は止めない）"""
+    def __init__(self, parent=None, sr=48000, ch=2, vol=0.5,
+                 streaming=True, latency_ms=PCM_TARGET_LATENCY_MS, bus="se"):
+        self.enabled = _ensure_qtmedia()
+        self.stream = None
+        self.mixer = None
+        self._conv = None
+        if not self.enabled: return
+        self._sr = sr; self._ch = ch
+        self.latency_ms = latency_ms
+        self.gain = vol; self.bus = bus
+        self._voice = None; self._stream_voice = None
+        self._buf = None
+        if streaming:
+            self.mixer = audio_mixer(sr, ch, latency_ms)
+            self.sink = self.mixer.sink
+            return
+        dev, _ = device_registry().resolve("out")
+        fmt = dev.preferredFormat()
+        fmt.setSampleRate(sr); fmt.setChannelCount(ch)
+        fmt.setSampleFormat(QAudioFormat.SampleFormat.Int16)
+        self.sink = QAudioSink(dev, fmt, parent)
+        self.sink.setVolume(vol)
+
+    def play_bytes(self, b: bytes):
+        if not self.enabled: return
+        if self.mixer is not None:
+            if self._voice is not None: self.mixer.stop(self._voice)
+            self._voice = self.mixer.play(b, gain=self.gain, bus=self.bus)
+            return
+        try:
+            if self._buf: self._buf.close()
+        except Exception: pass
+        self._buf = QBuffer()
+        self._buf.setData(QByteArray(b if isinstance(b, (bytes, bytearray)) else bytes(b)))
+        self._buf.open(QBuffer.ReadOnly)
+        self.sink.stop()
+        self.sink.start(self._buf)
+
+    def play_pcm(self, pcm, sr: int, ch: int):
+        """出力と違う形式（SR/CH/float）の PCM は変換してから鳴らす"""
+        if not self.enabled: return
+        a = np.frombuffer(pcm, np.int16) if isinstance(pcm, (bytes, bytearray, memoryview, mmap.mmap)) else np.asarray(pcm)
+        if a.dtype == np.int16 and (sr, ch) == (self._sr, self._ch):
+            self.play_bytes(pcm); return
+        x = a.astype(np.float32) * (1.0 / 32768.0) if a.dtype == np.int16 else a.astype(np.float32, copy=False)
+        self.play_bytes(convert_pcm(x.reshape(-1, ch), sr, self._sr, self._ch))
+
+    def set_source_format(self, sr: int, ch: int):
+        """write() に渡す PCM の形式（int16/float どちらでも）  出力と同じなら変換しない"""
+        if not self.enabled: return
+        self._conv = None if (sr, ch) == (self._sr, self._ch) else AudioConverter(sr, ch, self._sr, self._ch, np.int16)
+
+    def write(self, chunk) -> bool:
+        """ストリームへ追記（生産者用） 終わったら finish() を呼ぶ"""
+        if not self.enabled or self.mixer is None: return False
+        fresh = self.stream is None or not self.mixer.is_playing(self._stream_voice)
+        if self._conv is not None:
+            # 新しい発話は前の発話のフィルタ履歴を引き継がない（リセットしてから変換する）
+            if fresh and self.stream is not None: self._conv.reset()
+            chunk = self._conv.process(chunk).tobytes()     # 変換の出力バッファは使い回しなので写す
+        if fresh:
+            self.stream = PCMStream(None, sr=self._sr, ch=self._ch)
+            self.stream.push(chunk)
+            self._stream_voice = self.mixer.play_stream(self.stream, gain=self.gain, bus=self.bus)
+            return True
+        return self.stream.push(chunk)
+
+    def finish(self):
+        if self.stream is not None: self.stream.finish()
+
+    def stats(self) -> dict:
+        if not self.enabled or self.mixer is None:
+            return {"streaming": False}
+        in_sink = max(0, self.sink.bufferSize() - self.sink.bytesFree())
+        bps = self._sr * self._ch * 2
+        fill = self.stream.fill() if self.stream is not None else 0
+        return {
+            "streaming": True,
+            "fill_bytes": fill,
+            "fill_ms": 1000.0 * fill / bps,
+            "latency_ms": 1000.0 * (fill + in_sink) / bps,
+            "target_latency_ms": self.latency_ms,
+            "underruns": self.stream.underruns if self.stream is not None else 0,
+            "overruns": self.stream.overruns if self.stream is not None else 0,
+            "mixer": self.mixer.stats(),
+        }
+
+class GentleRainSE:
+    def __init__(self, parent=None, duration_sec=5.5):
+        self.out = _PCMOut(parent, sr=48000, ch=2, vol=0.5)
+        self.buf = _mk_soft_hush(48000, 2, dur=duration_sec)
+    def play_once(self):
+        if self.out.enabled:
+            self.out.play_bytes(self.buf)
+
+
+# ----------------- サウンド素材 -----------------
+# 録音した雨音やチャイムをディレクトリに置けば使う  起動時はヘッダだけ読んで索引を作り
+# WAV は初回使用時に mmap して data チャンクをそのままミキサーへ渡す（16bit で出力と同じ形式ならコピーなし）
+# 形式が違う WAV や圧縮形式（soundfile があれば）は一度だけ変換して 上限付きの LRU に置く
+# ファイル名の規約: <前の状態>-<次の状態>.wav / <次の状態>.wav（例 idle-listening.wav, sleeping.wav）
+#   末尾の _数字 は同じ役のバリエーション（listening_1.wav, listening_2.wav からランダム）
+SOUND_DIRS = [d for d in (os.environ.get("RAINECHO_SOUNDS"),
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), "sounds"),
+                          os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"),
+                                       "rainecho", "sounds")) if d]
+SOUND_WAV_EXTS        = (".wav", ".wave")
+SOUND_COMPRESSED_EXTS = (".flac", ".ogg", ".oga", ".mp3", ".opus")
+SOUND_DECODED_MAX_BYTES = 64 * 1024 * 1024
+SOUND_OUT_SR = 48000
+SOUND_OUT_CH = 2
+
+HAVE_SOUNDFILE = None
+soundfile = None
+
+def _ensure_soundfile() -> bool:
+    global HAVE_SOUNDFILE, soundfile
+    if HAVE_SOUNDFILE is None:
+        try:
+            import soundfile
+            HAVE_SOUNDFILE = True
+        except Exception:
+            HAVE_SOUNDFILE = False
+    return HAVE_SOUNDFILE
+
+
+class SoundAsset:
+    __slots__ = ("key", "path", "codec", "sr", "ch", "bits", "data_offset", "data_len", "frames")
+    def __init__(self, key, path, codec, sr=0, ch=0, bits=16, data_offset=0, data_len=0, frames=0):
+        self.key = key; self.path = path; self.codec = codec      # codec: pcm / float / compressed
+        self.sr = sr; self.ch = ch; self.bits = bits
+        self.data_offset = data_offset; self.data_len = data_len; self.frames = frames
+
+    @property
+    def duration(self) -> float:
+        return self.frames / self.sr if self.sr else 0.0
+
+    def matches(self, sr: int, ch: int) -> bool:
+        return self.codec == "pcm" and self.bits == 16 and self.sr == sr and self.ch == ch
+
+
+def read_wav_header(path: str):
+    """RIFF/WAVE のチャンクを辿って fmt と data の位置だけ読む（サンプルは読まない）"""
+    with open(path, "rb") as f:
+        head = f.read(12)
+        if len(head) < 12 or head[:4] != b"RIFF" or head[8:12] != b"WAVE": return None
+        fmt = None
+        while True:
+            ck = f.read(8)
+            if len(ck) < 8: return None
+            cid, size = ck[:4], int.from_bytes(ck[4:], "little")
+            if cid == b"fmt ":
+                body = f.read(size)
+                tag, ch, sr = int.from_bytes(body[0:2], "little"), int.from_bytes(body[2:4], "little"), int.from_bytes(body[4:8], "little")
+                bits = int.from_bytes(body[14:16], "little")
+                if tag == 0xFFFE and len(body) >= 26: tag = int.from_bytes(body[24:26], "little")   # EXTENSIBLE
+                fmt = (tag, ch, sr, bits)
+                if size & 1: f.seek(1, 1)
+            elif cid == b"data":
+                if fmt is None: return None
+                tag, ch, sr, bits = fmt
+                if tag not in (1, 3) or ch <= 0 or bits not in (8, 16, 24, 32): return None
+                off = f.tell()
+                size = min(size, os.fstat(f.fileno()).st_size - off)    # 書きかけで長さが壊れたもの
+                fb = ch * bits // 8
+                return dict(codec="float" if tag == 3 else "pcm", sr=sr, ch=ch, bits=bits,
+                            data_offset=off, data_len=size - size % fb, frames=size // fb)
+            else:
+                f.seek(size + (size & 1), 1)
+
+
+def _to_float(raw, asset: SoundAsset):
+    b = asset.bits
+    if asset.codec == "float":
+        a = np.frombuffer(raw, np.float32 if b == 32 else np.float64)
+    elif b == 16:
+        a = np.frombuffer(raw, np.int16).astype(np.float32) * (1.0 / 32768.0)
+    elif b == 24:
+        u = np.frombuffer(raw, np.uint8).reshape(-1, 3).astype(np.int32)
+        a = ((u[:, 0] | (u[:, 1] << 8) | (u[:, 2] << 16)) << 8 >> 8).astype(np.float32) * (1.0 / 8388608.0)
+    elif b == 32:
+        a = np.frombuffer(raw, np.int32).astype(np.float32) * (1.0 / 2147483648.0)
+    else:
+        a = (np.frombuffer(raw, np.uint8).astype(np.float32) - 128.0) * (1.0 / 128.0)
+    return a.reshape(-1, asset.ch)
+
+def convert_pcm(x, sr: int, out_sr: int, out_ch: int) -> bytes:
+    """x: (frames, ch) float  ->  out_sr/out_ch の int16 インターリーブ
+    チャンネルを減らすなら先に減らし 増やすなら SR 変換の後で複製する"""
+    x = np.asarray(x, np.float32)
+    if x.shape[1] != out_ch and x.shape[1] > 1:
+        x = x.mean(axis=1, keepdims=True)
+    if sr != out_sr and len(x):
+        x = resample(x, sr, out_sr)
+    if x.shape[1] != out_ch:
+        x = np.repeat(x, out_ch, axis=1)
+    return (np.clip(x, -1.0, 1.0) * 32767.0).astype(np.int16).tobytes()
+
+
+class SoundBank:
+    def __init__(self, dirs=None, out_sr: int = SOUND_OUT_SR, out_ch: int = SOUND_OUT_CH,
+                 decoded_max_bytes: int = SOUND_DECODED_MAX_BYTES):
+        self.dirs = list(SOUND_DIRS if dirs is None else dirs)
+        self.out_sr = out_sr; self.out_ch = out_ch
+        self.decoded_max_bytes = decoded_max_bytes
+        self.assets = {}                   # key -> [SoundAsset, ...]（バリエーション）
+        self._maps = {}                    # path -> mmap（仮想メモリに載せるだけ）
+        self._decoded = OrderedDict()      # (path, sr, ch) -> bytes
+        self._decoded_bytes = 0
+        self.decodes = 0; self.mapped_hits = 0; self.decoded_hits = 0
+        self.rescan()
+
+    # ===== 索引 =====
+    def rescan(self):
+        self.assets = {}
+        seen = set()
+        for d in self.dirs:
+            try:
+                names = sorted(os.listdir(d))
+            except OSError:
+                continue
+            for name in names:
+                stem, ext = os.path.splitext(name)
+                key = stem.lower()
+                base, _, var = key.rpartition("_")
+                if base and var.isdigit(): key = base
+                if (key, name) in seen: continue      # 先のディレクトリを優先
+                a = self._index_one(key, os.path.join(d, name), ext.lower())
+                if a is not None:
+                    seen.add((key, name)); self.assets.setdefault(key, []).append(a)
+        return self
+
+    def _index_one(self, key, path, ext):
+        try:
+            if ext in SOUND_WAV_EXTS:
+                h = read_wav_header(path)
+                return SoundAsset(key, path, **h) if h else None
+            if ext in SOUND_COMPRESSED_EXTS and _ensure_soundfile():
+                info = soundfile.info(path)
+                return SoundAsset(key, path, "compressed", info.samplerate, info.channels, 0, frames=info.frames)
+        except (OSError, RuntimeError, ValueError):
+            pass
+        return None
+
+    def __len__(self):
+        return sum(len(v) for v in self.assets.values())
+
+    def pick(self, *keys):
+        """keys を順に探し 最初に見つかった役のバリエーションから1つ"""
+        for k in keys:
+            v = self.assets.get(k)
+            if v: return random.choice(v)
+        return None
+
+    def for_transition(self, prev, st):
+        p = prev.name.lower() if prev is not None else None
+        return self.pick(*([f"{p}-{st.name.lower()}"] if p else []), st.name.lower())
+
+    # ===== 中身 =====
+    def _map(self, path: str):
+        mm = self._maps.get(path)
+        if mm is None:
+            mm = _pcm_cache_load(path)
+            if mm is not None: self._maps[path] = mm
+        return mm
+
+    def pcm(self, asset: SoundAsset):
+        """出力形式（out_sr/out_ch/int16）の PCM  同形式の WAV は mmap のスライス（コピーなし）"""
+        if asset.matches(self.out_sr, self.out_ch):
+            mm = self._map(asset.path)
+            if mm is None: return None
+            self.mapped_hits += 1
+            return memoryview(mm)[asset.data_offset:asset.data_offset + asset.data_len]
+        key = (asset.path, self.out_sr, self.out_ch)
+        data = self._decoded.get(key)
+        if data is not None:
+            self._decoded.move_to_end(key); self.decoded_hits += 1
+            return data
+        data = self._decode(asset)
+        if data is None: return None
+        self.decodes += 1
+        if len(data) <= self.decoded_max_bytes:
+            self._decoded[key] = data; self._decoded_bytes += len(data)
+            while self._decoded_bytes > self.decoded_max_bytes:
+                _, old = self._decoded.popitem(last=False); self._decoded_bytes -= len(old)
+        return data
+
+    def _decode(self, asset: SoundAsset):
+        try:
+            if asset.codec == "compressed":
+                if not _ensure_soundfile(): return None
+                x, sr = soundfile.read(asset.path, dtype="float32", always_2d=True)
+            else:
+                mm = self._map(asset.path)
+                if mm is None: return None
+                x = _to_float(memoryview(mm)[asset.data_offset:asset.data_offset + asset.data_len], asset)
+                sr = asset.sr
+        except (OSError, RuntimeError, ValueError) as ex:
+            print(f"[sound] {asset.path} を読めませんでした: {ex}", file=sys.stderr)
+            return None
+        return convert_pcm(x, sr, self.out_sr, self.out_ch)
+
+    def stats(self) -> dict:
+        return {"assets": len(self), "keys": len(self.assets), "mapped": len(self._maps),
+                "decoded_kb": self._decoded_bytes // 1024, "decodes": self.decodes,
+                "mapped_hits": self.mapped_hits, "decoded_hits": self.decoded_hits}
+
+
+class AssetSE:
+    """素材から鳴らす SE  play_once は GentleRainSE と同じ呼び方（雨入り = listening）"""
+    def __init__(self, bank: SoundBank, parent=None, vol=0.5):
+        self.bank = bank
+        self.out = _PCMOut(parent, sr=bank.out_sr, ch=bank.out_ch, vol=vol)
+
+    def play(self, asset) -> bool:
+        if asset is None or not self.out.enabled: return False
+        pcm = self.bank.pcm(asset)
+        if pcm is None: return False
+        self.out.play_bytes(pcm)
+        return True
+
+    def play_transition(self, prev, st) -> bool:
+        return self.play(self.bank.for_transition(prev, st))
+
+    def play_once(self):
+        self.play(self.bank.pick("idle-listening", "listening"))
+
+
+_SOUND_BANK = None
+
+def sound_bank() -> SoundBank:
+    global _SOUND_BANK
+    if _SOUND_BANK is None:
+        _SOUND_BANK = SoundBank()
+    return _SOUND_BANK
+
+
+# ----------------- マイク入力（ワーカースレッド＋リングバッファ） -----------------
+# QAudioSource は専用スレッドで動かし 事前確保したリングへ書くだけにする
+# 書き手は1つ（キャプチャスレッド） 読み手は RingReader ごとに自分のカーソルで好きな間隔で読む
+# 書き手はデータを書き終えてから write_pos を進めるので 読み手はロックなしで write_pos までを読める
+# 変換と検出器（VAD / ウェイク / 環境音）も書いた直後にキャプチャスレッドで回し GUI には出来事だけを送る
+CAPTURE_RING_SEC = 10.0
+CAPTURE_BUFFER_MS = 40
+
+class AudioRing:
+    def __init__(self, sr: int, ch: int, seconds: float = CAPTURE_RING_SEC):
+        self.sr = int(sr); self.ch = int(ch)
+        self.capacity = max(1, int(self.sr * seconds))          # フレーム数
+        self.buf = np.zeros((self.capacity, self.ch), np.int16)
+        self.write_pos = 0                                      # 書き込んだ総フレーム数（単調増加）
+
+    def write(self, frames):
+        frames = np.asarray(frames, np.int16).reshape(-1, self.ch)
+        n = len(frames)
+        if n == 0: return
+        cap = self.capacity
+        total = n
+        if n > cap:                               # 収まらない先頭は捨てる  書き始めは捨てた後の位置
+            frames = frames[-cap:]; n = cap
+        i = (self.write_pos + total - n) % cap
+        first = min(n, cap - i)
+        self.buf[i:i + first] = frames[:first]
+        if first < n:
+            self.buf[:n - first] = frames[first:]
+        self.write_pos += total                   # 公開はコピーの後に1回だけ（読み手が未書き込みの領域を見ない）
+
+    def reader(self, from_now: bool = True) -> "RingReader":
+        return RingReader(self, from_now)
+
+
+class RingReader:
+    def __init__(self, ring: AudioRing, from_now: bool = True):
+        self.ring = ring
+        self.pos = ring.write_pos if from_now else max(0, ring.write_pos - ring.capacity)
+        self.dropped = 0          # 追いつけずに上書きされたフレーム数
+
+    def available(self) -> int:
+        return self.ring.write_pos - self.pos
+
+    def read(self, max_frames: int = None):
+        """未読ぶんを (k, ch) int16 のビュー（コピーなし）のリストで返す 折り返しがあれば2つ"""
+        ring = self.ring
+        end = ring.write_pos
+        if end - self.pos > ring.capacity:
+            self.dropped += end - self.pos - ring.capacity
+            self.pos = end - ring.capacity
+        n = end - self.pos
+        if max_frames is not None: n = min(n, max_frames)
+        if n <= 0: return []
+        cap = ring.capacity
+        i = self.pos % cap
+        first = min(n, cap - i)
+        out = [ring.buf[i:i + first]]
+        if first < n:
+            out.append(ring.buf[:n - first])
+        self.pos += n
+        return out
+
+
+class _CaptureWorker(QObject):
+    """キャプチャスレッド側 QAudioSource の生成/破棄もこのスレッドで行う"""
+    opened = Signal(bool)
+
+    def __init__(self, pipeline=None):
+        super().__init__()
+        self.source = None
+        self.io = None
+        self.ring = None
+        self.pipeline = pipeline      # CapturePipeline  書いた直後にこのスレッドで回す
+        self._carry = b""
+
+    @Slot(object)
+    def open(self, req):
+        dev, fmt, ring = req
+        self.close()
+        self.ring = ring
+        self.source = QAudioSource(dev, fmt)
+        self.source.setBufferSize(ring.ch * 2 * max(1, ring.sr * CAPTURE_BUFFER_MS // 1000))
+        self.io = self.source.start()
+        if self.io is None:
+            self.close(); self.opened.emit(False); return
+        self.io.readyRead.connect(self._on_ready)
+        self.opened.emit(True)
+
+    @Slot()
+    def close(self):
+        if self.source is not None:
+            try: self.source.stop()
+            except Exception: pass
+            self.source.deleteLater()
+        self.source = None; self.io = None; self._carry = b""
+
+    def _on_ready(self):
+        if self.io is None or self.ring is None: return
+        data = self._carry + self.io.readAll().data()
+        fb = 2 * self.ring.ch
+        cut = len(data) - len(data) % fb
+        self._carry = data[cut:]
+        if cut:
+            self.ring.write(np.frombuffer(data, np.int16, cut // 2))
+            if self.pipeline is not None: self.pipeline.process()
+
+
+class CapturePipeline(QObject):
+    """リングを読んで DETECTOR_SR モノラルに揃え VAD / ウェイク / 環境音メーターに渡す
+    process() はキャプチャスレッドから  出来事は1回の読み出し分をまとめて events で GUI スレッドへ
+    検出器の差し替え・設定変更は lock を取って行う"""
+    events = Signal(object)       # [("speech_start",), ("speech_end",), ("wake", label, score), ("ambient", strong)]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.lock = threading.Lock()
+        self.reader = None
+        self.conv = None
+        self.vad = None; self.wake = None; self.meter = None
+        self._pending = []
+
+    def attach(self, ring):
+        with self.lock:
+            self.reader = ring.reader() if ring is not None else None
+            self.conv = None      # 入力が変わったら変換段とフィルタの持ち越しを作り直す
+
+    def swap(self, name: str, det):
+        with self.lock: setattr(self, name, det)
+
+    # 検出器のコールバック（lock の中で呼ばれる）  積むだけ
+    def post(self, *ev): self._pending.append(ev)
+    def on_speech_start(self, *_): self.post("speech_start")
+    def on_speech_end(self, *_): self.post("speech_end")
+    def on_wake(self, label, score): self.post("wake", label, float(score))
+    def on_ambient(self, t, excess_db, strong): self.post("ambient", bool(strong))
+
+    def feed(self, pcm, ch: int, sr: int):
+        """lock を持って呼ぶ"""
+        conv = self.conv
+        if conv is None or (conv.in_sr, conv.in_ch) != (sr, ch):
+            conv = self.conv = AudioConverter(sr, ch, DETECTOR_SR, 1)
+        x = conv.process(pcm)
+        if self.vad is not None: self.vad.feed(x)
+        if self.wake is not None: self.wake.feed(x)
+        if self.meter is not None: self.meter.feed(x)
+
+    def take(self):
+        ev, self._pending = self._pending, []
+        return ev
+
+    def process(self):
+        with self.lock:
+            r = self.reader
+            if r is None: return
+            for seg in r.read():
+                self.feed(seg, r.ring.ch, r.ring.sr)
+            ev = self.take()
+        if ev: self.events.emit(ev)
+
+
+class AudioCapture(QObject):
+    _open_req = Signal(object)
+    _close_req = Signal()
+
+    def __init__(self, parent=None, pipeline: CapturePipeline = None):
+        super().__init__(parent)
+        self.enabled = _ensure_qtmedia()
+        self.ring = None
+        self.active = False
+        if not self.enabled: return
+        self.thread = QThread(self)
+        self.thread.setObjectName("rainecho-capture")
+        self.worker = _CaptureWorker(pipeline)
+        self.worker.moveToThread(self.thread)
+        self._open_req.connect(self.worker.open)
+        self._close_req.connect(self.worker.close)
+        self.worker.opened.connect(self._on_opened)
+        self.thread.finished.connect(self.worker.deleteLater)
+        self.thread.start()
+
+    def _resolve(self, device_id, sr: int, ch: int):
+        dev, info = device_registry().resolve("in", device_id)
+        fmt = QAudioFormat()
+        fmt.setSampleRate(int(sr)); fmt.setChannelCount(int(ch))
+        fmt.setSampleFormat(QAudioFormat.SampleFormat.Int16)
+        if not dev.isFormatSupported(fmt):
+            if info is not None:
+                fmt.setSampleRate(info.sample_rate); fmt.setChannelCount(min(2, max(1, info.channels)))
+            else:
+                pf = dev.preferredFormat()
+                fmt.setSampleRate(pf.sampleRate()); fmt.setChannelCount(min(2, max(1, pf.channelCount())))
+        return dev, fmt
+
+    def configure(self, device_id, sr: int, ch: int):
+        """入力を (再)構成して新しいリングを返す 実際の SR/CH はリングを見る  GUI スレッドは待たない"""
+        if not self.enabled: return None
+        dev, fmt = self._resolve(device_id, sr, ch)
+        self.ring = AudioRing(fmt.sampleRate(), fmt.channelCount())
+        self._open_req.emit((dev, fmt, self.ring))
+        return self.ring
+
+    def reader(self):
+        return self.ring.reader() if self.ring is not None else None
+
+    def _on_opened(self, ok: bool):
+        self.active = ok
+
+    def stop(self):
+        if not self.enabled: return
+        self._close_req.emit()
+        self.active = False
+
+    def shutdown(self):
+        if not self.enabled: return
+        self.stop()
+        self.thread.quit()
+        self.thread.wait(2000)
+
+
+# ----------------- リサンプラ / 形式変換 -----------------
+# 有理比 L/M のポリフェーズ FIR（カイザー窓の sinc）  ブロックをまたいで入力の末尾 K-1 サンプルを持ち越す
+# 出力 n は 上げた後の位置 nM+D（D = フィルタの中心）に当たる 入力 i = (nM+D)//L までを使い 位相 p = (nM+D)%L の係数 K 本を掛ける
+# D を足しておくと出力 n は入力の時刻 nM/L にそのまま揃う（代わりに D/L 入力サンプル分は入力を待つ）
+# ブロック内は全出力を一度に: 入力の sliding window から必要な窓を集めて係数と einsum
+# 整数比の間引き（L=1）は窓を M 飛びのビューで取れるので集めずに行列積だけ
+# 出力やインデックスの配列は使い回す（戻り値は次の呼び出しまで有効なビュー）
+RESAMPLE_ZERO_CROSSINGS = 12      # sinc の片側の零交差数（多いほど遷移帯が狭い）
+RESAMPLE_ROLLOFF        = 0.92    # 遮断を低い方の Nyquist のこの割合に置く
+RESAMPLE_KAISER_BETA    = 8.6
+DETECTOR_SR             = 16000   # VAD / ウェイク / 環境音メーターはこの SR のモノラル float で受ける
+
+
+def design_polyphase(L: int, M: int):
+    """(L, K) の係数表（各行は時間を逆順にした位相フィルタ）と フィルタの中心 D（上げた後のサンプル）"""
+    fc = RESAMPLE_ROLLOFF * 0.5 / max(L, M)
+    half = int(math.ceil(RESAMPLE_ZERO_CROSSINGS / (2.0 * fc)))
+    N = 2 * half + 1
+    K = -(-N // L)
+    n = np.arange(N) - half
+    h = 2.0 * fc * np.sinc(2.0 * fc * n) * np.kaiser(N, RESAMPLE_KAISER_BETA) * L
+    hp = np.zeros(K * L); hp[:N] = h
+    table = hp.reshape(K, L).T[:, ::-1]
+    return np.ascontiguousarray(table, np.float32), half
+
+
+class PolyphaseResampler:
+    def __init__(self, in_sr: int, out_sr: int, ch: int = 1):
+        g = math.gcd(int(in_sr), int(out_sr))
+        self.in_sr = int(in_sr); self.out_sr = int(out_sr); self.ch = int(ch)
+        self.L = self.out_sr // g; self.M = self.in_sr // g
+        self.table, self.D = design_polyphase(self.L, self.M)
+        self.K = self.table.shape[1]
+        self.latency = self.D / self.L / self.in_sr      # 入力を待つ分（秒）
+        self._cap_in = 0; self._cap_out = 0
+        self.reset()
+
+    def reset(self):
+        self._in = 0      # 次に来る入力の番号（出力番号と一緒に L/M 周期で巻き戻す）
+        self._n = 0       # 次に出す出力の番号
+        self._ensure(4096)
+        self._buf[:self.K - 1] = 0.0
+
+    def _ensure(self, n_in: int):
+        if n_in > self._cap_in:
+            old = getattr(self, "_buf", None)
+            self._cap_in = max(n_in, 2 * self._cap_in)
+            self._buf = np.zeros((self.K - 1 + self._cap_in, self.ch), np.float32)
+            if old is not None: self._buf[:self.K - 1] = old[:self.K - 1]
+        n_out = n_in * self.L // self.M + 2
+        if n_out > self._cap_out:
+            c = self._cap_out = max(n_out, 2 * self._cap_out)
+            self._y = np.empty((c, self.ch), np.float32)
+            self._ar = np.arange(c, dtype=np.int64)
+            self._j = np.empty(c, np.int64); self._w = np.empty(c, np.int64); self._p = np.empty(c, np.int64)
+            if self.L > 1:
+                self._X = np.empty((c, self.ch, self.K), np.float32)
+                self._C = np.empty((c, self.K), np.float32)
+
+    def process(self, x):
+        """x: (n, ch) か (n,) の float  ->  (m, ch) の float32 ビュー"""
+        x = np.asarray(x, np.float32).reshape(-1, self.ch)
+        n = len(x); K = self.K; L = self.L; M = self.M
+        self._ensure(n)
+        buf = self._buf
+        buf[K - 1:K - 1 + n] = x
+        in_new = self._in + n
+        D = self.D
+        n_end = max(0, (in_new * L - 1 - D) // M + 1)
+        cnt = max(0, n_end - self._n)
+        y = self._y[:cnt]
+        if cnt:
+            win = np.lib.stride_tricks.sliding_window_view(buf[:K - 1 + n], K, axis=0)   # (n, ch, K)
+            if L == 1:
+                w0 = self._n * M + D - self._in
+                np.matmul(win[w0:w0 + (cnt - 1) * M + 1:M], self.table[0], out=y)
+            else:
+                j = np.add(self._ar[:cnt], self._n, out=self._j[:cnt])
+                np.multiply(j, M, out=j); np.add(j, D, out=j)
+                p = np.remainder(j, L, out=self._p[:cnt])
+                w = np.floor_divide(j, L, out=self._w[:cnt]); np.subtract(w, self._in, out=w)
+                X = np.take(win, w, axis=0, out=self._X[:cnt])
+                C = np.take(self.table, p, axis=0, out=self._C[:cnt])
+                np.einsum("nck,nk->nc", X, C, out=y)
+        buf[:K - 1] = buf[n:n + K - 1]
+        self._in = in_new; self._n = max(self._n, n_end)
+        c = self._n // L
+        self._n -= c * L; self._in -= c * M
+        return y
+
+
+def resample(x, in_sr: int, out_sr: int):
+    """一括変換（末尾を無音で押し出し 長さを in→out の比に合わせたコピーを返す）"""
+    x = np.asarray(x, np.float32)
+    mono = x.ndim == 1
+    x2 = x.reshape(len(x), -1)
+    if in_sr == out_sr: return x.copy()
+    r = PolyphaseResampler(in_sr, out_sr, x2.shape[1])
+    want = int(round(len(x2) * out_sr / in_sr))
+    head = r.process(x2).copy()
+    tail = r.process(np.zeros((r.D // r.L + 2, x2.shape[1]), np.float32))
+    y = np.concatenate((head, tail))[:want]
+    return y[:, 0].copy() if mono else y
+
+
+class AudioConverter:
+    """int16/float・チャンネル数・SR をまとめて変換するストリーム段（状態はブロックをまたいで持つ）
+    out_dtype が int16 ならインターリーブした int16 の (m, ch)  モノラル出力は (m,)"""
+    def __init__(self, in_sr: int, in_ch: int, out_sr: int, out_ch: int, out_dtype=np.float32):
+        self.in_sr = int(in_sr); self.in_ch = int(in_ch)
+        self.out_sr = int(out_sr); self.out_ch = int(out_ch)
+        self.out_dtype = np.dtype(out_dtype)
+        self.work_ch = 1 if self.out_ch == 1 else self.in_ch     # 先に減らせるなら減らしてから SR 変換
+        self.rs = PolyphaseResampler(self.in_sr, self.out_sr, self.work_ch) if self.in_sr != self.out_sr else None
+        self._f = np.empty((0, self.work_ch), np.float32)
+        self._o = np.empty((0, self.out_ch), self.out_dtype)
+        self._t = np.empty((0, self.out_ch), np.float32)
+
+    def reset(self):
+        if self.rs is not None: self.rs.reset()
+
+    def process(self, pcm):
+        a = np.frombuffer(pcm, np.int16) if isinstance(pcm, (bytes, bytearray, memoryview, mmap.mmap)) else np.asarray(pcm)
+        scale = 1.0 / 32768.0 if a.dtype == np.int16 else 1.0
+        a = a.reshape(-1, self.in_ch) if a.ndim == 1 else a
+        n = len(a)
+        if len(self._f) < n: self._f = np.empty((max(n, 2 * len(self._f)), self.work_ch), np.float32)
+        f = self._f[:n]
+        if self.work_ch == 1 and self.in_ch > 1:
+            np.sum(a, axis=1, dtype=np.float32, out=f[:, 0]); f *= scale / self.in_ch
+        else:
+            np.multiply(a, scale, out=f, casting="unsafe")
+        y = self.rs.process(f) if self.rs is not None else f
+        m = len(y)
+        if self.work_ch == self.out_ch and self.out_dtype == np.float32:
+            out = y
+        else:
+            if len(self._o) < m:
+                c = max(m, 2 * len(self._o))
+                self._o = np.empty((c, self.out_ch), self.out_dtype); self._t = np.empty((c, self.out_ch), np.float32)
+            out = self._o[:m]
+            if self.out_dtype == np.int16:
+                t = self._t[:m]
+                np.multiply(y, 32767.0, out=t)                    # (m,1) は out_ch 列に広がる
+                np.clip(t, -32768.0, 32767.0, out=t)
+                np.copyto(out, t, casting="unsafe")
+            else:
+                np.copyto(out, y)
+        return out[:, 0] if self.out_ch == 1 else out
+
+
+# ----------------- VAD（ストリーミング） -----------------
+# 任意長の PCM を受け取り 設定のフレーム長に切ってまとめて特徴量（エネルギー/ZCR/スペクトル平坦度）を計算する
+# 判定と開始/終了のヒステリシスだけフレーム順に回す（1秒あたり 33〜100 回のスカラー処理）
+VAD_MARGIN_DB   = (6.0, 9.0, 12.0, 15.0)    # 厳しさ 0〜3: ノイズフロアからの必要マージン
+VAD_FLATNESS_MAX = (0.60, 0.50, 0.42, 0.35) # これより平坦（=ノイズっぽい）なら無声
+VAD_ZCR_MAX     = 0.35
+VAD_ABS_MIN_DB  = -55.0
+VAD_FLOOR_UP    = 0.02    # ノイズフロアは上がるときはゆっくり 下がるときは速く追う
+VAD_FLOOR_DOWN  = 0.30
+
+def pcm_to_float_mono(pcm, ch: int = 1):
+    """int16/float の PCM（インターリーブ可）を float32 モノラルにする"""
+    a = np.frombuffer(pcm, np.int16) if isinstance(pcm, (bytes, bytearray, memoryview, mmap.mmap)) else np.asarray(pcm)
+    if a.dtype == np.int16:
+        a = a.astype(np.float32) * (1.0 / 32768.0)
+    else:
+        a = a.astype(np.float32, copy=False)
+    if a.ndim == 2:
+        return a.mean(axis=1)
+    if ch > 1:
+        return a[:len(a) - len(a) % ch].reshape(-1, ch).mean(axis=1)
+    return a
+
+
+def frame_features(frames):
+    """frames: (n, L) float32  ->  (energy_db, zcr, flatness) 各 (n,)"""
+    energy_db = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-12)
+    sgn = np.signbit(frames)
+    zcr = np.count_nonzero(sgn[:, 1:] != sgn[:, :-1], axis=1) / max(1, frames.shape[1] - 1)
+    win = np.hanning(frames.shape[1]).astype(np.float32)
+    power = np.abs(np.fft.rfft(frames * win, axis=1))[:, 1:] ** 2 + 1e-12
+    flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    return energy_db, zcr, flatness
+
+
+class StreamingVAD:
+    def __init__(self, sr=16000, frame_ms=20, aggressiveness=0, stop_silence_ms=500, min_voiced_ms=200,
+                 on_start=None, on_end=None):
+        self.sr = int(sr)
+        self.frame_ms = int(frame_ms)
+        self.frame_len = max(1, self.sr * self.frame_ms // 1000)
+        aggr = min(3, max(0, int(aggressiveness)))
+        self.margin_db = VAD_MARGIN_DB[aggr]
+        self.flat_max = VAD_FLATNESS_MAX[aggr]
+        self.start_frames = max(1, -(-int(min_voiced_ms) // self.frame_ms))
+        self.stop_frames = max(1, -(-int(stop_silence_ms) // self.frame_ms))
+        self.on_start = on_start
+        self.on_end = on_end
+        self.reset()
+
+    @classmethod
+    def from_config(cls, vad_cfg: dict, sr: int, **kw):
+        return cls(sr=sr, frame_ms=vad_cfg["frame_ms"], aggressiveness=vad_cfg["aggressiveness"],
+                   stop_silence_ms=vad_cfg["stop_silence_ms"], min_voiced_ms=vad_cfg["min_voiced_ms"], **kw)
+
+    def reset(self):
+        self._pending = np.zeros(0, np.float32)
+        self.floor_db = None
+        self.in_speech = False
+        self._voiced_run = 0
+        self._silence_run = 0
+        self.frames_seen = 0
+
+    def feed(self, pcm, ch: int = 1):
+        """PCM を流し込み この呼び出しで確定したイベント [("start"|"end", 秒)] を返す"""
+        x = pcm_to_float_mono(pcm, ch)
+        if len(self._pending):
+            x = np.concatenate((self._pending, x))
+        L = self.frame_len
+        nf = len(x) // L
+        self._pending = x[nf * L:].copy()
+        if nf == 0: return []
+        e_db, zcr, flat = frame_features(x[:nf * L].reshape(nf, L))
+        return self._decide(e_db.tolist(), zcr.tolist(), flat.tolist())
+
+    def _decide(self, e_db, zcr, flat):
+        events = []
+        floor = self.floor_db if self.floor_db is not None else e_db[0]
+        for e, z, f in zip(e_db, zcr, flat):
+            voiced = (e > floor + self.margin_db and e > VAD_ABS_MIN_DB
+                      and f < self.flat_max and z < VAD_ZCR_MAX)
+            if not voiced:
+                floor += (VAD_FLOOR_DOWN if e < floor else VAD_FLOOR_UP) * (e - floor)
+            self.frames_seen += 1
+            t = self.frames_seen * self.frame_ms / 1000.0
+            if self.in_speech:
+                self._silence_run = 0 if voiced else self._silence_run + 1
+                if self._silence_run >= self.stop_frames:
+                    self.in_speech = False; self._voiced_run = 0
+                    events.append(("end", t))
+                    if self.on_end: self.on_end()
+            else:
+                self._voiced_run = self._voiced_run + 1 if voiced else 0
+                if self._voiced_run >= self.start_frames:
+                    self.in_speech = True; self._silence_run = 0
+                    events.append(("start", t - self._voiced_run * self.frame_ms / 1000.0))
+                    if self.on_start: self.on_start()
+        self.floor_db = floor
+        return events
+
+
+# ----------------- 環境音メーター -----------------
+# 100ms ブロックごとに K 特性（BS.1770 の高域シェルフ+低域カット）で重み付けしたパワーを FFT で求め
+# 直近 400ms の平均で momentary ラウドネスにする  ノイズフロアは静かな間だけ追う
+# フロアからの超過が AMBIENT_MARGIN_DB を超えたら環境音  立ち上がりで1回 続く間は AMBIENT_REPEAT_SEC ごと
+# 発火は AMBIENT_MIN_INTERVAL_SEC より密にならないよう まとめて（最大の超過で）1回にする
+AMBIENT_BLOCK_MS         = 100
+AMBIENT_WINDOW_BLOCKS    = 4
+AMBIENT_MARGIN_DB        = 8.0
+AMBIENT_STRONG_DB        = 18.0     # フロア+これ以上なら strong
+AMBIENT_MIN_INTERVAL_SEC = 0.8
+AMBIENT_REPEAT_SEC       = 2.5
+AMBIENT_FLOOR_UP         = 0.01     # ブロックあたりの追従率（上がるときはゆっくり）
+AMBIENT_FLOOR_DOWN       = 0.25
+AMBIENT_FLOOR_MIN_DB     = -70.0
+
+def _biquad_power(b, a, w):
+    z1 = np.exp(-1j * w); z2 = z1 * z1
+    return np.abs((b[0] + b[1] * z1 + b[2] * z2) / (a[0] + a[1] * z1 + a[2] * z2)) ** 2
+
+def k_weighting(sr: int, n: int):
+    """長さ n の rfft 各ビンに掛ける K 特性のパワー重み"""
+    w = 2.0 * np.pi * np.fft.rfftfreq(n, 1.0 / sr) / sr
+    A = 10 ** (4.0 / 40.0); w0 = 2.0 * np.pi * 1500.0 / sr; c = math.cos(w0)
+    al = math.sin(w0) / (2.0 * (1.0 / math.sqrt(2.0))); sa = 2.0 * math.sqrt(A) * al
+    shelf = _biquad_power((A * ((A + 1) + (A - 1) * c + sa), -2 * A * ((A - 1) + (A + 1) * c), A * ((A + 1) + (A - 1) * c - sa)),
+                          ((A + 1) - (A - 1) * c + sa, 2 * ((A - 1) - (A + 1) * c), (A + 1) - (A - 1) * c - sa), w)
+    w0 = 2.0 * np.pi * 38.0 / sr; c = math.cos(w0); al = math.sin(w0) / (2.0 * 0.5)
+    hp = _biquad_power(((1 + c) / 2, -(1 + c), (1 + c) / 2), (1 + al, -2 * c, 1 - al), w)
+    return (shelf * hp).astype(np.float32)
+
+
+class AmbientMeter:
+    def __init__(self, sr=16000, on_event=None):
+        self.sr = int(sr)
+        self.block = max(1, self.sr * AMBIENT_BLOCK_MS // 1000)
+        # 片側スペクトルのパワーを平均二乗に戻す係数（DC と Nyquist 以外は2倍）
+        wk = k_weighting(self.sr, self.block)
+        wk[1:(self.block + 1) // 2] *= 2.0
+        self.weight = wk / float(self.block * self.block)
+        self.on_event = on_event        # on_event(t, excess_db, strong)
+        self.reset()
+
+    def reset(self):
+        self._pending = np.zeros(0, np.float32)
+        self._hist = np.zeros(0, np.float32)      # 直近ブロックの平均二乗
+        self.level_db = None                      # momentary ラウドネス（LUFS 相当）
+        self.floor_db = None
+        self.blocks_seen = 0
+        self._above = False
+        self._sustain_t = 0.0
+        self._last_emit = -1e9
+        self._pend = None
+        self.emitted = 0
+        self.coalesced = 0
+
+    def feed(self, pcm, ch: int = 1):
+        """PCM を流し込み この呼び出しで確定したイベント [(秒, 超過dB, strong)] を返す"""
+        x = pcm_to_float_mono(pcm, ch)
+        if len(self._pending):
+            x = np.concatenate((self._pending, x))
+        L = self.block
+        nb = len(x) // L
+        self._pending = x[nb * L:].copy()
+        if nb == 0: return []
+        spec = np.fft.rfft(x[:nb * L].reshape(nb, L), axis=1)
+        ms = (spec.real ** 2 + spec.imag ** 2) @ self.weight
+        h = np.concatenate((self._hist, ms.astype(np.float32)))
+        W = AMBIENT_WINDOW_BLOCKS
+        cs = np.concatenate(([0.0], np.cumsum(h, dtype=np.float64)))
+        idx = np.arange(len(h) - nb, len(h))
+        lo = np.maximum(0, idx + 1 - W)
+        mom = (cs[idx + 1] - cs[lo]) / (idx + 1 - lo)
+        self._hist = h[-(W - 1):] if W > 1 else h[:0]
+        return self._decide((-0.691 + 10.0 * np.log10(mom + 1e-12)).tolist())
+
+    def _decide(self, levels):
+        events = []
+        floor = self.floor_db if self.floor_db is not None else max(AMBIENT_FLOOR_MIN_DB, levels[0])
+        for lv in levels:
+            self.blocks_seen += 1
+            t = self.blocks_seen * AMBIENT_BLOCK_MS / 1000.0
+            ex = lv - floor
+            if ex >= AMBIENT_MARGIN_DB:
+                if not self._above or t - self._sustain_t >= AMBIENT_REPEAT_SEC:
+                    if self._pend is not None: self.coalesced += 1
+                    self._pend = ex if self._pend is None else max(self._pend, ex)
+                    self._sustain_t = t
+                elif self._pend is not None:
+                    self._pend = max(self._pend, ex)
+                self._above = True
+            else:
+                self._above = False
+                floor += (AMBIENT_FLOOR_DOWN if lv < floor else AMBIENT_FLOOR_UP) * (lv - floor)
+                floor = max(AMBIENT_FLOOR_MIN_DB, floor)
+            if self._pend is not None and t - self._last_emit >= AMBIENT_MIN_INTERVAL_SEC:
+                ev = (t, self._pend, self._pend >= AMBIENT_STRONG_DB)
+                self._pend = None; self._last_emit = t; self.emitted += 1
+                events.append(ev)
+                if self.on_event: self.on_event(*ev)
+            self.level_db = lv
+        self.floor_db = floor
+        return events
+
+
+# ----------------- ウェイクワード検出（ストリーミング DTW） -----------------
+# 10ms ホップで MFCC を逐次計算し 登録済みテンプレートと部分系列 DTW で照合する
+# DTW は 1フレーム入るたびにテンプレート方向の1列をベクトル演算で更新するだけ（O(テンプレ長)）
+WAKE_TEMPLATE_DIR = os.path.join(os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"),
+                                 "rainecho", "wake")
+WAKE_LABEL_START    = "start"
+WAKE_LABEL_SETTINGS = "settings"
+WAKE_WIN_MS   = 25
+WAKE_HOP_MS   = 10
+WAKE_N_MELS   = 26
+WAKE_N_CEPS   = 13       # c1〜c12 を距離に使う（c0=音量は除く）
+WAKE_N_CEPS_SIMILAR = 7  # 類似音素を許容するときは粗いスペクトル包絡（低次ケプストラム）だけで比べる
+WAKE_DIST_SCALE = 18.0   # 平均フレーム距離 d → 類似度 1/(1+(d/scale)^2)
+WAKE_PARTIAL_FRAC = 0.6  # 短縮形: テンプレートの先頭 60% 以上で一致すれば候補
+WAKE_PARTIAL_PENALTY = 0.5
+WAKE_REFRACTORY_SEC = 1.5
 
 
-# ----------------- 雨粒/波紋 -----------------
-class Ripple:
-    def __init__(self, x: float, y: float, color: QColor,
-                 max_radius: float, grow: float, fade: float, width: float):
-        self.x = x; self.y = y
-        self.r = 1.0
-        self.max_r = max_radius
-        self.grow = grow
-        self.alpha = 200.0
-        self.fade = fade
-        self.width = width
-        self.base_color = QColor(color)
-
-    def update(self):
-        self.r += self.grow
-        self.alpha -= self.fade
-        return self.alpha > 0 and self.r < self.max_r
-
-    def paint(self, p: QPainter):
-        c = QColor(self.base_color); c.setAlpha(int(max(0, min(255, self.alpha))))
-        p.setPen(QPen(c, self.width))
-        p.setBrush(Qt.NoBrush)
-        p.drawEllipse(QPointF(self.x, self.y), self.r, self.r)
+def _mel_filterbank(sr: int, n_fft: int, n_mels: int):
+    def hz2mel(f): return 2595.0 * np.log10(1.0 + f / 700.0)
+    def mel2hz(m): return 700.0 * (10 ** (m / 2595.0) - 1.0)
+    mels = np.linspace(hz2mel(60.0), hz2mel(min(7600.0, sr / 2)), n_mels + 2)
+    bins = np.floor((n_fft + 1) * mel2hz(mels) / sr).astype(int)
+    fb = np.zeros((n_mels, n_fft // 2 + 1), np.float32)
+    for m in range(1, n_mels + 1):
+        l, c, r = bins[m - 1], bins[m], bins[m + 1]
+        if c > l: fb[m - 1, l:c] = (np.arange(l, c) - l) / (c - l)
+        if r > c: fb[m - 1, c:r] = (r - np.arange(c, r)) / (r - c)
+    return fb
 
 
-class Raindrop:
-    def __init__(self, x: float, y0: float, y1: float, speed: float, color: QColor):
-        self.x = x; self.y = y0; self.y1 = y1; self.v = speed
-        self.color = QColor(color)
-        self.alive = True
+class MFCCStream:
+    """任意長の入力から 確定したフレームぶんの MFCC を返す（音量差は c0 にだけ乗る）"""
+    def __init__(self, sr: int = 16000):
+        self.sr = int(sr)
+        self.win = self.sr * WAKE_WIN_MS // 1000
+        self.hop = self.sr * WAKE_HOP_MS // 1000
+        self.n_fft = 1 << (self.win - 1).bit_length()
+        self.window = np.hamming(self.win).astype(np.float32)
+        self.fb = _mel_filterbank(self.sr, self.n_fft, WAKE_N_MELS)
+        k = np.arange(WAKE_N_MELS)
+        self.dct = np.cos(np.pi / WAKE_N_MELS * (k + 0.5)[None, :] * np.arange(WAKE_N_CEPS)[:, None]).astype(np.float32)
+        self.reset()
 
-    def update(self):
-        self.y += self.v
-        if self.y >= self.y1:
-            self.alive = False
-        return self.alive
+    def reset(self):
+        self._pending = np.zeros(0, np.float32)
 
-    def paint(self, p: QPainter):
-        p.setPen(QPen(self.color, 2))
-        p.drawLine(QPointF(self.x, self.y - 6), QPointF(self.x, self.y))
+    def frames(self, x):
+        """x（float モノラル）を一括で MFCC にする 端数は持ち越さない"""
+        if len(x) < self.win:
+            return np.zeros((0, WAKE_N_CEPS), np.float32)
+        frames = np.lib.stride_tricks.sliding_window_view(x, self.win)[::self.hop]
+        spec = np.abs(np.fft.rfft(frames * self.window, n=self.n_fft, axis=1)) ** 2
+        logmel = np.log(spec @ self.fb.T + 1e-10)
+        return logmel @ self.dct.T
 
+    def feed(self, x):
+        if len(self._pending):
+            x = np.concatenate((self._pending, x))
+        if len(x) < self.win:
+            self._pending = x.copy(); return np.zeros((0, WAKE_N_CEPS), np.float32)
+        nf = 1 + (len(x) - self.win) // self.hop
+        c = self.frames(x[:(nf - 1) * self.hop + self.win])
+        self._pending = x[nf * self.hop:].copy()
+        return c
 
-# ----------------- 合成SEフォールバック -----------------
-def _mk_soft_hush(sr=48000, ch=2, dur=5.5):
-    import array
-    rnd = random.random
-    alpha = 0.12
-    prev = 0.0
-    n = int(sr*dur)
-    up = int(0.12*n); down = int(0.45*n)
-    out = array.array('h')
-    for i in range(n):
-        w = rnd()*2-1
-        prev = prev + alpha*(w - prev)
-        if i < up:
-            env = i/max(1,up)
-        elif i > n - down:
-            env = max(0.0, (n - i)/max(1,down))
-        else:
-            env = 1.0
-        s = max(-1.0, min(1.0, prev*0.45*env))
-        v = int(s*32767)
-        if ch == 1:
-            out.append(v)
-        else:
-            out.append(v); out.append(v)
-    return out.tobytes()
 
-class _PCMOut:
-    def __init__(self, parent=None, sr=48000, ch=2, vol=0.5):
-        self.enabled = HAVE_QTMEDIA
-        if not self.enabled: return
-        dev = QMediaDevices.defaultAudioOutput()
-        fmt = dev.preferredFormat()
-        fmt.setSampleRate(sr); fmt.setChannelCount(ch)
-        fmt.setSampleFormat(QAudioFormat.SampleFormat.Int16)
-        self.sink = QAudioSink(dev, fmt, parent)
-        self.sink.setVolume(vol)
-        self._buf = None
-        self._sr = sr; self._ch = ch
-    def play_bytes(self, b: bytes):
-        if not self.enabled: return
+class WakeSpotter:
+    def __init__(self, sr=16000, threshold=0.60, allow_short=True, allow_similar=True, on_detect=None):
+        self.sr = int(sr)
+        self.threshold = float(threshold)
+        self.allow_short = bool(allow_short)
+        self.allow_similar = bool(allow_similar)
+        self.on_detect = on_detect          # on_detect(label, score)
+        self.mfcc = MFCCStream(self.sr)
+        self.templates: "dict[str, list]" = {}
+        self._states = []                   # [label, tpl, D, L]
+        self._t = 0.0
+        self._quiet_until = 0.0
+        self.last_scores: "dict[str, float]" = {}
+
+    @classmethod
+    def from_config(cls, wake_cfg: dict, sr: int, **kw):
+        return cls(sr=sr, threshold=wake_cfg["threshold"], allow_short=wake_cfg["allow_short"],
+                   allow_similar=wake_cfg["allow_similar"], **kw)
+
+    def configure(self, threshold: float, allow_short: bool, allow_similar: bool):
+        self.threshold = float(threshold)
+        self.allow_short = bool(allow_short)
+        self.allow_similar = bool(allow_similar)
+        self._reset_dtw()
+
+    # --- テンプレート ---
+    def _ceps_slice(self):
+        return slice(1, WAKE_N_CEPS_SIMILAR if self.allow_similar else WAKE_N_CEPS)
+
+    def enroll(self, label: str, pcm, ch: int = 1):
+        """発話例からテンプレートを登録する（前後の無音は落とす）"""
+        x = pcm_to_float_mono(pcm, ch)
+        c = self.mfcc.frames(x)
+        if len(c) == 0: return None
+        e = c[:, 0]                                   # c0 = 帯域ごとの対数エネルギーの和
+        keep = np.nonzero(e > e.max() - WAKE_N_MELS * 3.5)[0]   # 最大から約 15dB 以内
+        c = c[keep[0]:keep[-1] + 1]
+        tpl = c.astype(np.float32)
+        self.add_template(label, tpl)
+        return tpl
+
+    def add_template(self, label: str, feats):
+        tpl = np.asarray(feats, np.float32)
+        self.templates.setdefault(label, []).append(tpl)
+        self._states.append([label, tpl, None, None])
+        self._reset_dtw()
+
+    def load_templates(self, directory: str = WAKE_TEMPLATE_DIR) -> int:
+        """<label>_*.npy を読み込む  label は start / settings"""
+        n = 0
         try:
-            if self._buf: self._buf.close()
-        except Exception: pass
-        self._buf = QBuffer()
-        self._buf.setData(QByteArray(b))
-        self._buf.open(QBuffer.ReadOnly)
-        self.sink.stop()
-        self.sink.start(self._buf)
+            names = sorted(os.listdir(directory))
+        except OSError:
+            return 0
+        for name in names:
+            if not name.endswith(".npy"): continue
+            label = name[:-4].split("_", 1)[0]
+            try:
+                self.add_template(label, np.load(os.path.join(directory, name)))
+                n += 1
+            except (OSError, ValueError):
+                pass
+        return n
 
-class GentleRainSE:
-    def __init__(self, parent=None, duration_sec=5.5):
-        self.out = _PCMOut(parent, sr=48000, ch=2, vol=0.5)
-        self.buf = _mk_soft_hush(48000, 2, dur=duration_sec)
-    def play_once(self):
-        if HAVE_QTMEDIA:
-            self.out.play_bytes(self.buf)
+    def save_templates(self, directory: str = WAKE_TEMPLATE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        for label, tpls in self.templates.items():
+            for i, tpl in enumerate(tpls):
+                np.save(os.path.join(directory, f"{label}_{i}.npy"), tpl)
+
+    def _reset_dtw(self):
+        for st in self._states:
+            J = len(st[1])
+            st[2] = np.full(J, np.inf, np.float32)
+            st[3] = np.ones(J, np.float32)
+
+    # --- ストリーム ---
+    def feed(self, pcm, ch: int = 1):
+        """PCM を流し込み この呼び出しで検出した [(label, score, 秒)] を返す"""
+        x = pcm_to_float_mono(pcm, ch)
+        feats = self.mfcc.feed(x)
+        if not self._states or len(feats) == 0:
+            self._t += len(feats) * WAKE_HOP_MS / 1000.0
+            return []
+        cs = self._ceps_slice()
+        hits = []
+        for f in feats[:, cs]:
+            self._t += WAKE_HOP_MS / 1000.0
+            hit = self._step(f, cs)
+            if hit is not None:
+                hits.append((hit[0], hit[1], self._t))
+                if self.on_detect: self.on_detect(hit[0], hit[1])
+        return hits
+
+    def _step(self, f, cs):
+        best = None
+        scores = {}
+        for st in self._states:
+            label, tpl, D, L = st
+            d = np.sqrt(((tpl[:, cs] - f) ** 2).sum(axis=1))
+            # 入力1フレームぶん: テンプレ位置を 0/1/2 進める（傾き制約つき部分系列 DTW）
+            c0, l0 = D, L
+            c1 = np.concatenate(([np.inf], D[:-1])); l1 = np.concatenate(([0.0], L[:-1]))
+            c2 = np.concatenate(([np.inf, np.inf], D[:-2])); l2 = np.concatenate(([0.0, 0.0], L[:-2]))
+            cand = np.stack((c0, c1, c2)); lens = np.stack((l0, l1, l2))
+            k = np.argmin(cand, axis=0)
+            idx = np.arange(len(d))
+            Dn = d + cand[k, idx]; Ln = lens[k, idx] + 1.0
+            Dn[0] = d[0]; Ln[0] = 1.0                   # どこからでも始められる
+            st[2] = Dn.astype(np.float32); st[3] = Ln.astype(np.float32)
+            J = len(d)
+            avg = Dn[-1] / Ln[-1]
+            if self.allow_short:
+                j0 = max(0, int(np.ceil(WAKE_PARTIAL_FRAC * J)) - 1)
+                frac = (np.arange(j0, J) + 1.0) / J
+                part = Dn[j0:] / Ln[j0:] * (1.0 + WAKE_PARTIAL_PENALTY * (1.0 - frac))
+                avg = min(avg, float(part.min()))
+            score = float(1.0 / (1.0 + (avg / WAKE_DIST_SCALE) ** 2))
+            if score > scores.get(label, 0.0):
+                scores[label] = score
+            if best is None or score > best[1]:
+                best = (label, score)
+        self.last_scores = scores
+        if best is None or self._t < self._quiet_until or best[1] < self.threshold:
+            return None
+        self._quiet_until = self._t + WAKE_REFRACTORY_SEC
+        self._reset_dtw()
+        return best
 
 
 # ----------------- キャンバス -----------------
 class RainCanvas(QWidget):
-    def __init__(self):
+    def __init__(self, clock=time.monotonic):
         super().__init__()
+        self.clock = clock              # 背景フェードと入場演出の時刻（VirtualClock で早送りできる）
         self.setMinimumSize(460, 320)
         self.state = LinoState.IDLE
 
@@ -274,23 +2743,150 @@ class RainCanvas(QWidget):
         self._bg_dur  = 0.0
         self._bg_fading = False
 
-        self.ripples: list[Ripple] = []
-        self.drops: list[Raindrop] = []
+        self.particles = ParticleEngine(LISTEN_MAX_DROPS, LISTEN_MAX_RIPPLES)
+        self.quality = QualityController(on_change=self._on_quality_change)
+        self.on_quality_change = None   # on_quality_change(tier, auto)  GUI スレッドで呼ぶ
+        self._apply_tier(self.quality.tier)
+        self._lowres = None             # 縮小描画用の QImage
+        self.sprites = SpriteCache()
+        self.use_sprites = True
+        self._dirty_prev = QRegion()   # 前回 update した時点で粒子が占めていた領域
+        self.last_dirty = None         # 直近に要求した再描画領域（None = 全面）
 
         self.spawn_timer = QTimer(self); self.spawn_timer.timeout.connect(self._spawn_during_listen)
-        self.frame = QTimer(self); self.frame.timeout.connect(self._on_frame); self.frame.start(16)
+        self.frame = FrameScheduler(self, self._on_frame, clock)
 
         self._entry_t0 = 0.0
         self._entry_phase = 0
         self._entry_phase_t0 = 0.0
         self._allow_spawns = False
 
+        self.on_first_paint = None     # 初回 paintEvent の後に一度だけ呼ぶ（遅延初期化の起点）
+
+        # 描画スレッドモード（set_threaded） 粒子と背景の状態は _sim_lock で守る
+        self._sim_lock = threading.RLock()
+        self._render = None
+        self._buf_lock = threading.Lock()
+        self._front = None; self._back = None
+        self._sim_size = (self.width(), self.height()); self._sim_dpr = 1.0
+        self._spawn_acc = 0.0
+        self._gui_call.connect(self._run_gui_call)
+
+    _gui_call = Signal(object)
+
+    @Slot(object)
+    def _run_gui_call(self, fn):
+        fn()
+
+    def _post(self, fn):
+        """GUI スレッドで fn を呼ぶ（描画スレッドからはキュー経由）"""
+        if QThread.currentThread() is not self.thread():
+            self._gui_call.emit(fn)
+        else:
+            fn()
+
     def sizeHint(self): return QSize(520, 360)
 
+    # ===== 品質ティア =====
+    def _apply_tier(self, t: QualityTier):
+        self.antialias = t.antialias
+        self.max_drops = t.max_drops; self.max_ripples = t.max_ripples
+        self.spawn_interval_ms = t.spawn_interval_ms
+        self.render_scale = t.scale
+
+    def _on_quality_change(self, t: QualityTier):
+        with self._sim_lock:
+            self._apply_tier(t)
+            self.particles.trim(self.max_drops, self.max_ripples)
+            self._lowres = None
+        if not self.threaded and self.spawn_timer.isActive():
+            self.spawn_timer.setInterval(self.spawn_interval_ms)
+        self._post(self.update)
+        if self.on_quality_change is not None:
+            cb = self.on_quality_change; auto = self.quality.pinned is None
+            self._post(lambda: cb(t, auto))
+
+    def set_quality_pin(self, name):
+        """name のティアに固定（None / "auto" で自動）"""
+        with self._sim_lock:
+            n = self.quality.changes
+            self.quality.pin(None if name in (None, "auto") else QualityController.level_of(name))
+        if self.on_quality_change is not None and self.quality.changes == n:
+            self.on_quality_change(self.quality.tier, self.quality.pinned is None)
+
+    def resizeEvent(self, e):
+        super().resizeEvent(e)
+        with self._sim_lock:
+            self._sim_size = (self.width(), self.height())
+            self._sim_dpr = self.devicePixelRatioF()
+            self.sprites.clear()
+
+    # ===== 描画スレッド =====
+    @property
+    def threaded(self) -> bool:
+        return self._render is not None
+
+    def set_threaded(self, on: bool):
+        if on == self.threaded: return
+        if on:
+            self.frame.stop(); self.spawn_timer.stop()
+            with self._sim_lock:
+                self._sim_size = (self.width(), self.height())
+                self._sim_dpr = self.devicePixelRatioF()
+                self.sprites = SpriteCache(image=True)    # QPixmap は GUI スレッド専用
+                self._spawn_acc = 0.0; self._lowres = None
+            self._render = _RenderThread(self)
+            self._render.frame_ready.connect(self.update)
+            self._render.start()
+        else:
+            r = self._render
+            r.stop()                    # 止まってから外す（描きかけの _render_step が None を踏まない）
+            self._render = None
+            with self._sim_lock:
+                self.sprites = SpriteCache()
+            with self._buf_lock:
+                self._front = self._back = None
+            if self.state == LinoState.LISTENING and self._allow_spawns:
+                self.spawn_timer.start(self.spawn_interval_ms)
+        self._wake_frames()
+        self.update()
+
+    @profiled("frame", _frame_extra)
+    def _render_step(self, dt: float, rt: "_RenderThread"):
+        """描画スレッド rt の 1 フレーム 進めて裏バッファに描き 表と入れ替える"""
+        t0 = time.perf_counter()
+        with self._sim_lock:
+            w, h = self._sim_size; dpr = self._sim_dpr * self.render_scale
+            self._step_sim(dt, w, h)
+            if self.state == LinoState.LISTENING and self._allow_spawns:
+                self._spawn_acc += dt * 1000.0
+                while self._spawn_acc >= self.spawn_interval_ms:
+                    self._spawn_acc -= self.spawn_interval_ms
+                    self._spawn_one(w, h)
+            else:
+                self._spawn_acc = 0.0
+            if not (self._is_animating() or (self.state == LinoState.LISTENING and self._allow_spawns)):
+                rt.idle()
+            img = self._back
+            pw, ph = max(1, int(w * dpr)), max(1, int(h * dpr))
+            if img is None or img.width() != pw or img.height() != ph:
+                img = QImage(pw, ph, QImage.Format_ARGB32_Premultiplied)
+                img.setDevicePixelRatio(dpr)
+            p = QPainter(img)
+            self.paint_scene(p, dpr, QRect(0, 0, w, h))
+            p.end()
+            ms = (time.perf_counter() - t0) * 1000.0
+            self.quality.observe(ms)
+            if METRICS.enabled: M_FRAME_MS.observe(ms, "render")
+            self.quality.end_frame()
+        with self._buf_lock:
+            self._back, self._front = self._front, img
+        rt.frame_ready.emit()
+
     def _start_bg_fade(self, to_color: QColor, dur_sec: float):
         self._bg_from = QColor(self.bg_color)
         self._bg_to   = QColor(to_color)
-        self._bg_t0   = time.time()
+        self._bg_t0   = self.clock()
         self._bg_dur  = max(0.01, float(dur_sec))
         self._bg_fading = True
 
@@ -306,44 +2902,51 @@ class RainCanvas(QWidget):
     def ping_center(self, strong=False):
         w, h = self.width(), self.height()
         cx, cy = w*0.5, h*0.56
-        self.drops.append(Raindrop(cx, cy-14, cy+6, speed=6.8,
-                                   color=QColor(COLOR_RIPPLE.red(), COLOR_RIPPLE.green(), COLOR_RIPPLE.blue(), 220)))
-        self.ripples.append(Ripple(cx, cy, COLOR_RIPPLE,
-                                   max_radius=min(w, h)*0.75,
-                                   grow=2.5 if strong else 2.1,
-                                   fade=2.0 if strong else 1.8,
-                                   width=3.2 if strong else 2.6))
-        if len(self.drops) > LISTEN_MAX_DROPS: self.drops = self.drops[-LISTEN_MAX_DROPS:]
-        if len(self.ripples) > LISTEN_MAX_RIPPLES: self.ripples = self.ripples[-LISTEN_MAX_RIPPLES:]
-        self.update()
+        pe = self.particles
+        with self._sim_lock:
+            pe.reserve(self.max_drops, self.max_ripples)
+            pe.add_drop(cx, cy-14, cy+6, speed=6.8, alpha=220)
+            pe.add_ripple(cx, cy,
+                          max_radius=min(w, h)*0.75,
+                          grow=2.5 if strong else 2.1,
+                          fade=2.0 if strong else 1.8,
+                          width=3.2 if strong else 2.6)
+            pe.trim(self.max_drops, self.max_ripples)
+        self._wake_frames()
+        self._update_dirty()
 
     def finish_drops_to_ripples(self):
-        if not self.drops: return
-        w, h = self.width(), self.height()
-        for d in self.drops:
-            y_floor = min(max(d.y, h*0.55), h*0.85)
-            self.ripples.append(Ripple(d.x, y_floor, COLOR_RIPPLE,
-                                       max_radius=min(w, h)*0.88, grow=2.8, fade=2.0, width=3.0))
-        self.drops.clear()
-        self.update()
+        pe = self.particles
+        with self._sim_lock:
+            if pe.drop_count == 0: return
+            w, h = self.width(), self.height()
+            d = pe.drops_view()
+            y_floor = np.clip(d[_DR_Y], h*0.55, h*0.85)
+            pe.add_ripples(d[_DR_X].copy(), y_floor,
+                           max_radius=min(w, h)*0.88, grow=2.8, fade=2.0, width=3.0)
+            pe.clear_drops()
+        self._wake_frames()
+        self._update_dirty()
 
     def set_state(self, st: LinoState):
-        prev = self.state
-        self.state = st
+        with self._sim_lock:
+            prev = self.state
+            self.state = st
 
-        if st == LinoState.IDLE:
-            if prev == LinoState.LISTENING: self.finish_drops_to_ripples()
-            self._start_bg_fade(COLOR_IDLE_BG, FADE_GENERIC_SEC)
-            self.spawn_timer.stop()
+            if st == LinoState.IDLE:
+                if prev == LinoState.LISTENING: self.finish_drops_to_ripples()
+                self._start_bg_fade(COLOR_IDLE_BG, FADE_GENERIC_SEC)
+                self.spawn_timer.stop()
 
-        elif st == LinoState.LISTENING:
-            self._start_entry()
+            elif st == LinoState.LISTENING:
+                self._start_entry()
 
-        elif st == LinoState.SLEEPING:
-            if prev == LinoState.LISTENING: self.finish_drops_to_ripples()
-            self._start_bg_fade(COLOR_SLEEP_BG, FADE_GENERIC_SEC)
-            self.spawn_timer.stop()
+            elif st == LinoState.SLEEPING:
+                if prev == LinoState.LISTENING: self.finish_drops_to_ripples()
+                self._start_bg_fade(COLOR_SLEEP_BG, FADE_GENERIC_SEC)
+                self.spawn_timer.stop()
 
+        self._wake_frames()
         self.update()
 
     def _reset_entry(self):
@@ -353,14 +2956,14 @@ class RainCanvas(QWidget):
 
     def _start_entry(self):
         self._reset_entry()
-        self._entry_t0 = time.time()
+        self._entry_t0 = self.clock()
         self._start_bg_fade(COLOR_LISTEN_BG, LISTENING_ENTRY_BG_FADE_SEC)
         w, h = self.width(), self.height()
         cx = random.uniform(w*0.45, w*0.55)
         cy = random.uniform(h*0.50, h*0.62)
-        self.ripples.append(Ripple(cx, cy, COLOR_RIPPLE,
-                                   max_radius=min(w,h)*0.85, grow=2.3, fade=1.8, width=2.8))
+        self.particles.add_ripple(cx, cy, max_radius=min(w,h)*0.85, grow=2.3, fade=1.8, width=2.8)
         self._entry_phase = 1
+        self._wake_frames()
 
     def _progress_entry(self, now: float):
         if self._entry_phase == 0: return
@@ -368,60 +2971,204 @@ class RainCanvas(QWidget):
         if self._entry_phase == 1 and t >= 0.8:
             mw = self.parent()
             if mw and hasattr(mw, "play_entry_se"):
-                mw.play_entry_se()
+                self._post(mw.play_entry_se)
             self._entry_phase = 2
             self._entry_phase_t0 = now
         elif self._entry_phase == 2 and (now - self._entry_phase_t0) >= 0.5:
             self._allow_spawns = True
-            if not self.spawn_timer.isActive():
-                self.spawn_timer.start(LISTEN_SPAWN_INTERVAL_MS)
+            if not self.threaded and not self.spawn_timer.isActive():
+                self.spawn_timer.start(self.spawn_interval_ms)
             self._entry_phase = 3
 
+    @profiled("spawn")
     def _spawn_during_listen(self):
         if self.state != LinoState.LISTENING or not self._allow_spawns:
             return
-        w, h = self.width(), self.height()
+        with self._sim_lock:
+            self._spawn_one(self.width(), self.height())
+        self._wake_frames()
+
+    def _spawn_one(self, w: int, h: int):
         x = random.uniform(w*0.18, w*0.82)
         y0 = random.uniform(h*-0.1, h*0.15)
         y1 = random.uniform(h*0.55, h*0.78)
         speed = random.uniform(6.0, 8.0)
-        self.drops.append(Raindrop(x, y0, y1, speed,
-                                   QColor(COLOR_RIPPLE.red(), COLOR_RIPPLE.green(), COLOR_RIPPLE.blue(), 200)))
-        if len(self.drops) > LISTEN_MAX_DROPS:
-            self.drops = self.drops[-LISTEN_MAX_DROPS:]
+        pe = self.particles
+        pe.reserve(self.max_drops, self.max_ripples)
+        pe.add_drop(x, y0, y1, speed, alpha=200)
         rx = x + random.uniform(-3, 3)
         ry = y1 + random.uniform(-2, 2)
-        self.ripples.append(Ripple(rx, ry, COLOR_RIPPLE,
-                                   max_radius=min(w, h)*0.82, grow=2.6, fade=1.9, width=3.0))
-        if len(self.ripples) > LISTEN_MAX_RIPPLES:
-            self.ripples = self.ripples[-LISTEN_MAX_RIPPLES:]
+        pe.add_ripple(rx, ry, max_radius=min(w, h)*0.82, grow=2.6, fade=1.9, width=3.0)
+        pe.trim(self.max_drops, self.max_ripples)
 
-    def _on_frame(self):
-        now = time.time()
+    # ===== フレーム駆動 =====
+    def _is_animating(self) -> bool:
+        if self._bg_fading or self.particles.ripple_count > 0:
+            return True
+        if self.state == LinoState.LISTENING:
+            if self._entry_phase in (1, 2):
+                return True
+            if self._allow_spawns and self.particles.drop_count > 0:
+                return True
+        return False
+
+    def _wake_frames(self):
+        iv = FRAME_INTERVAL_SLEEP_MS if self.state == LinoState.SLEEPING else FRAME_INTERVAL_MS
+        if self._render is not None: self._render.wake(iv)
+        else:
+            if not self.frame.isActive(): self.quality.discard()
+            self.frame.wake(iv)
+
+    @profiled("frame", _frame_extra)
+    def _on_frame(self, dt: float = FRAME_INTERVAL_MS / 1000.0):
+        t0 = time.perf_counter()
+        self.quality.end_frame()        # 前フレームの更新+描画で判定
+        was_fading = self._step_sim(dt, self.width(), self.height())
+        self._update_dirty(full=was_fading)
+        if not self._is_animating():
+            self.frame.stop()
+        ms = (time.perf_counter() - t0) * 1000.0
+        self.quality.observe(ms)
+        if METRICS.enabled: M_FRAME_MS.observe(ms, "update")
+
+    def _step_sim(self, dt: float, w: int, h: int) -> bool:
+        """背景フェード/入場演出/粒子を dt 秒進める  フェード中だったかを返す"""
+        steps = min(FRAME_MAX_STEPS, max(0.0, dt * 1000.0 / FRAME_INTERVAL_MS))
+        now = self.clock()
+        was_fading = self._bg_fading
         self._update_bg_fade(now)
         if self.state == LinoState.LISTENING:
             self._progress_entry(now)
             if self._allow_spawns:
-                next_drops = []
-                for d in self.drops:
-                    if d.update():
-                        next_drops.append(d)
-                    else:
-                        self.ripples.append(Ripple(d.x, d.y1, COLOR_RIPPLE,
-                                                   max_radius=min(self.width(), self.height())*0.88,
-                                                   grow=2.9, fade=2.1, width=3.2))
-                self.drops = next_drops
-        self.ripples = [r for r in self.ripples if r.update()]
-        self.update()
+                landed = self.particles.step_drops(steps)
+                if landed is not None:
+                    self.particles.add_ripples(landed[0], landed[1],
+                                               max_radius=min(w, h)*0.88,
+                                               grow=2.9, fade=2.1, width=3.2)
+        self.particles.step_ripples(steps)
+        return was_fading
+
+    # ===== 部分再描画 =====
+    def _particle_region(self):
+        rects = self.particles.dirty_rects()
+        if len(rects) == 0:
+            return QRegion(), 0
+        area = int((rects[:, 2] * rects[:, 3]).sum())
+        if len(rects) > DIRTY_MAX_RECTS:
+            x0, y0 = rects[:, 0].min(), rects[:, 1].min()
+            x1 = (rects[:, 0] + rects[:, 2]).max(); y1 = (rects[:, 1] + rects[:, 3]).max()
+            return QRegion(int(x0), int(y0), int(x1 - x0), int(y1 - y0)), int((x1 - x0) * (y1 - y0))
+        reg = QRegion()
+        for x, y, w, h in rects.tolist():
+            reg = reg.united(QRect(x, y, w, h))
+        return reg, area
+
+    def _update_dirty(self, full: bool = False):
+        """前回と今回の粒子領域の和だけ再描画する 背景フェード中（終了フレーム含む）は全面"""
+        if self._render is not None: return     # 描画スレッドが出来た絵ごとに update する
+        if not self.isVisible():
+            # トレイに隠れている間は領域計算もしない（表示時に全面が描かれる）
+            self._dirty_prev = QRegion(); self.last_dirty = None
+            return
+        now, area = self._particle_region()
+        prev = self._dirty_prev
+        self._dirty_prev = now
+        if full or self._bg_fading or area > DIRTY_FULL_RATIO * self.width() * self.height():
+            self.last_dirty = None
+            self.update(); return
+        dirty = now.united(prev)
+        self.last_dirty = dirty
+        if not dirty.isEmpty():
+            self.update(dirty)
 
+    @profiled("paint")
     def paintEvent(self, e):
         p = QPainter(self)
-        p.setRenderHint(QPainter.Antialiasing, True)
-        p.fillRect(self.rect(), QBrush(self.bg_color))
+        if self._render is not None:
+            with self._buf_lock:
+                if self._front is not None:
+                    p.setRenderHint(QPainter.SmoothPixmapTransform, True)
+                    p.drawImage(QRectF(self.rect()), self._front)
+                else: p.fillRect(self.rect(), QBrush(self.bg_color))
+            p.end()
+        else:
+            t0 = time.perf_counter()
+            if self.render_scale < 1.0:
+                self._paint_lowres(p)
+            else:
+                self.paint_scene(p, self.devicePixelRatioF())
+            p.end()
+            ms = (time.perf_counter() - t0) * 1000.0
+            self.quality.observe(ms)
+            if METRICS.enabled: M_FRAME_MS.observe(ms, "paint")
+        if self.on_first_paint is not None:
+            cb, self.on_first_paint = self.on_first_paint, None
+            cb()
+
+    def _paint_lowres(self, p: QPainter):
+        # 縮小した QImage に描いて拡大して貼る
+        w, h = self.width(), self.height()
+        dpr = self.devicePixelRatioF() * self.render_scale
+        pw, ph = max(1, int(w * dpr)), max(1, int(h * dpr))
+        img = self._lowres
+        if img is None or img.width() != pw or img.height() != ph:
+            img = self._lowres = QImage(pw, ph, QImage.Format_ARGB32_Premultiplied)
+            img.setDevicePixelRatio(dpr)
+        ip = QPainter(img)
+        self.paint_scene(ip, dpr, QRect(0, 0, w, h))
+        ip.end()
+        p.setRenderHint(QPainter.SmoothPixmapTransform, True)
+        p.drawImage(QRectF(self.rect()), img)
+
+    def paint_scene(self, p: QPainter, dpr: float = 1.0, rect: QRect = None):
+        """背景と粒子を p に描く（ウィジェット以外の QImage などにも使う）"""
+        p.setRenderHint(QPainter.Antialiasing, self.antialias)
+        p.fillRect(rect if rect is not None else self.rect(), QBrush(self.bg_color))
+        if self.use_sprites:
+            self.sprites.set_dpr(dpr)
         if self.state == LinoState.LISTENING or self._entry_phase > 0:
-            for d in self.drops: d.paint(p)
-        for r in self.ripples: r.paint(p)
-        p.end()
+            self._paint_drops(p)
+        self._paint_ripples(p)
+
+    def _paint_drops(self, p: QPainter):
+        d = self.particles.drops_view()
+        if d.shape[1] == 0: return
+        if self.use_sprites:
+            streak = self.sprites.streak; ab = SpriteCache.alpha_bucket
+            blit = p.drawImage if self.sprites.image else p.drawPixmap
+            for x, y, a in zip(d[_DR_X].tolist(), d[_DR_Y].tolist(), d[_DR_ALPHA].astype(np.int32).tolist()):
+                pm, ox, oy, _ = streak(a)
+                p.setOpacity(a / ab(a))
+                blit(QPointF(x - ox, y - oy), pm)
+            p.setOpacity(1.0)
+            return
+        c = QColor(COLOR_RIPPLE)
+        pen = QPen(c, 2)
+        for x, y, a in zip(d[_DR_X].tolist(), d[_DR_Y].tolist(), d[_DR_ALPHA].astype(np.int32).tolist()):
+            c.setAlpha(a); pen.setColor(c); p.setPen(pen)
+            p.drawLine(QPointF(x, y - 6), QPointF(x, y))
+
+    def _paint_ripples(self, p: QPainter):
+        r = self.particles.ripples_view()
+        if r.shape[1] == 0: return
+        alphas = np.clip(r[_RP_ALPHA], 0, 255).astype(np.int32).tolist()
+        c = QColor(COLOR_RIPPLE)
+        pen = QPen(c, 1.0)
+        p.setBrush(Qt.NoBrush)
+        ring = self.sprites.ring if self.use_sprites else None
+        blit = p.drawImage if self.sprites.image else p.drawPixmap
+        ab = SpriteCache.alpha_bucket
+        for x, y, rad, a, wd in zip(r[_RP_X].tolist(), r[_RP_Y].tolist(), r[_RP_R].tolist(),
+                                    alphas, r[_RP_W].tolist()):
+            if ring is not None and rad <= SPRITE_MAX_RADIUS:
+                pm, ox, oy, _ = ring(rad, wd, a)
+                p.setOpacity(a / ab(a))
+                blit(QPointF(x - ox, y - oy), pm)
+                continue
+            p.setOpacity(1.0)
+            c.setAlpha(a); pen.setColor(c); pen.setWidthF(wd); p.setPen(pen)
+            p.drawEllipse(QPointF(x, y), rad, rad)
+        p.setOpacity(1.0)
 
 
 # ----------------- 設定オーバーレイ（メイン内 子ウィジェット） -----------------
@@ -515,13 +3262,14 @@ class SettingsOverlay(QWidget):
 
         # --- Wake ---
         g_wake = QWidget(); lay_w = QFormLayout(g_wake); lay_w.setLabelAlignment(Qt.AlignLeft)
-        self.sl_th = QSlider(Qt.Horizontal); self.sl_th.setMinimum(40); self.sl_th.setMaximum(90); self.sl_th.setValue(60)
-        self.ck_short = QCheckBox("短縮形/部分一致を許容"); self.ck_short.setChecked(True)
-        self.ck_sim   = QCheckBox("類似音素を許容"); self.ck_sim.setChecked(True)
+        self.sl_th = QSlider(Qt.Horizontal); self.sl_th.setMinimum(40); self.sl_th.setMaximum(90)
+        self.sl_th.setValue(int(round(DEFAULT_CONFIG["wake"]["threshold"] * 100)))
+        self.ck_short = QCheckBox("短縮形/部分一致を許容"); self.ck_short.setChecked(DEFAULT_CONFIG["wake"]["allow_short"])
+        self.ck_sim   = QCheckBox("類似音素を許容"); self.ck_sim.setChecked(DEFAULT_CONFIG["wake"]["allow_similar"])
         lay_w.addRow("しきい値 (0.40〜0.90)", self.sl_th); lay_w.addRow(self.ck_short); lay_w.addRow(self.ck_sim)
         add_section("ウェイク設定", g_wake)
 
-        # --- API / Realtime（ダミー表示） ---
+        # --- API / Realtime（モデル・感情・プロンプトは応答キャッシュのキーと履歴に使う） ---
         g_api = QWidget(); lay_a = QFormLayout(g_api); lay_a.setLabelAlignment(Qt.AlignLeft)
         self.cb_model = QComboBox(); self.cb_model.addItems(
             ["gpt-4o-realtime-preview", "gpt-4o-realtime-mini", "gpt-5", "gpt-5-mini", "gpt-5-nano"])
@@ -530,13 +3278,13 @@ class SettingsOverlay(QWidget):
         self.ed_sys = QPlainTextEdit(); self.ed_sys.setPlainText(DEFAULT_SYSTEM_PROMPT); self.ed_sys.setMinimumHeight(90)
         lay_a.addRow("モデル名", self.cb_model); lay_a.addRow(self.ck_realtime_only)
         lay_a.addRow("TTS感情プリセット", self.cb_emotion); lay_a.addRow("システムプロンプト", self.ed_sys)
-        add_section("API / Realtime（ダミー）", g_api)
+        add_section("API / Realtime", g_api)
 
         # --- Audio I/O ---
         g_audio = QWidget(); lay_o = QFormLayout(g_audio); lay_o.setLabelAlignment(Qt.AlignLeft)
         self.cb_in_dev = QComboBox()
-        self.cb_sr = QComboBox(); self.cb_sr.addItems(["48000","44100","32000","16000"]); self.cb_sr.setCurrentText("48000")
-        self.cb_ch = QComboBox(); self.cb_ch.addItems(["1","2"]); self.cb_ch.setCurrentText("1")
+        self.cb_sr = QComboBox(); self.cb_sr.addItems(["48000","44100","32000","16000"]); self.cb_sr.setCurrentText(str(DEFAULT_CONFIG["audio"]["samplerate"]))
+        self.cb_ch = QComboBox(); self.cb_ch.addItems(["1","2"]); self.cb_ch.setCurrentText(str(DEFAULT_CONFIG["audio"]["channels"]))
         self.btn_apply_audio = QPushButton("適用")
         lay_o.addRow("入力デバイス", self.cb_in_dev)
         lay_o.addRow("サンプルレート(Hz)", self.cb_sr)
@@ -544,15 +3292,24 @@ class SettingsOverlay(QWidget):
         lay_o.addRow(self.btn_apply_audio)
         add_section("オーディオ設定", g_audio)
 
-        # --- VAD（ダミー表示） ---
+        # --- VAD ---
         g_vad = QWidget(); lay_v = QFormLayout(g_vad); lay_v.setLabelAlignment(Qt.AlignLeft)
-        self.cb_frame = QComboBox(); self.cb_frame.addItems(["10","20","30"]); self.cb_frame.setCurrentText("20")
-        self.cb_aggr  = QComboBox(); self.cb_aggr.addItems(["0(寛容)","1","2","3(厳格)"]); self.cb_aggr.setCurrentIndex(0)
-        self.sp_stop  = QComboBox(); self.sp_stop.addItems(["300","400","500","600","800","1000"]); self.sp_stop.setCurrentText("500")
-        self.sp_minvo = QComboBox(); self.sp_minvo.addItems(["100","150","200","250","300"]); self.sp_minvo.setCurrentText("200")
+        self.cb_frame = QComboBox(); self.cb_frame.addItems(["10","20","30"]); self.cb_frame.setCurrentText(str(DEFAULT_CONFIG["vad"]["frame_ms"]))
+        self.cb_aggr  = QComboBox(); self.cb_aggr.addItems(["0(寛容)","1","2","3(厳格)"]); self.cb_aggr.setCurrentIndex(DEFAULT_CONFIG["vad"]["aggressiveness"])
+        self.sp_stop  = QComboBox(); self.sp_stop.addItems(["300","400","500","600","800","1000"]); self.sp_stop.setCurrentText(str(DEFAULT_CONFIG["vad"]["stop_silence_ms"]))
+        self.sp_minvo = QComboBox(); self.sp_minvo.addItems(["100","150","200","250","300"]); self.sp_minvo.setCurrentText(str(DEFAULT_CONFIG["vad"]["min_voiced_ms"]))
         lay_v.addRow("フレーム(ms)", self.cb_frame); lay_v.addRow("厳しさ", self.cb_aggr)
         lay_v.addRow("停止無音(ms)", self.sp_stop); lay_v.addRow("開始最小voiced(ms)", self.sp_minvo)
-        add_section("VAD（ダミー）", g_vad)
+        add_section("VAD", g_vad)
+
+        # --- 描画品質 ---
+        g_rq = QWidget(); lay_q = QFormLayout(g_rq); lay_q.setLabelAlignment(Qt.AlignLeft)
+        self.cb_quality = QComboBox(); self.cb_quality.addItem("自動", "auto")
+        for t in QUALITY_TIERS: self.cb_quality.addItem(t.name, t.name)
+        self.cb_quality.setCurrentIndex(max(0, self.cb_quality.findData(DEFAULT_CONFIG["render"]["quality"])))
+        self.lb_quality = QLabel("")
+        lay_q.addRow("品質", self.cb_quality); lay_q.addRow("現在", self.lb_quality)
+        add_section("描画", g_rq)
 
         row.addWidget(self.panel, 0, Qt.AlignTop)
         row.addStretch(1)
@@ -598,13 +3355,31 @@ class SettingsOverlay(QWidget):
         self.host_lay.setContentsMargins(0, top, 0, bot)
 
     def _fill_audio_inputs(self):
+        # 一覧はデバイスレジストリのキャッシュから（抜き差しで changed が来たら選択を保って作り直す）
+        reg = device_registry()
+        if not getattr(self, "_dev_watch", False):
+            reg.changed.connect(self._on_devices_changed)
+            self._dev_watch = True
+        prev = _dev_key(self.cb_in_dev.currentData())
+        self.cb_in_dev.blockSignals(True)
         self.cb_in_dev.clear()
-        if not HAVE_QTMEDIA:
-            self.cb_in_dev.addItem("QtMultimediaなし", None); return
-        for dev in QMediaDevices.audioInputs():
-            self.cb_in_dev.addItem(dev.description(), dev.id())
-        if self.cb_in_dev.count() == 0:
-            self.cb_in_dev.addItem("入力デバイスなし", None)
+        if not reg.enabled:
+            self.cb_in_dev.addItem("QtMultimediaなし", None)
+        elif not reg.is_ready("in"):
+            self.cb_in_dev.addItem("デバイスを検索中…", None)
+        else:
+            for info in reg.inputs():
+                self.cb_in_dev.addItem(info.description, info.id)
+                if info.key == prev: self.cb_in_dev.setCurrentIndex(self.cb_in_dev.count() - 1)
+            if self.cb_in_dev.count() == 0:
+                self.cb_in_dev.addItem("入力デバイスなし", None)
+        self.cb_in_dev.blockSignals(False)
+
+    def set_quality_status(self, tier, auto: bool):
+        self.lb_quality.setText(f"{tier.name}（{'自動' if auto else '固定'}）")
+
+    def _on_devices_changed(self, kind: str):
+        if kind == "in": self._fill_audio_inputs()
 
     def current_config(self):
         return {
@@ -629,13 +3404,661 @@ class SettingsOverlay(QWidget):
                 "aggressiveness": int(self.cb_aggr.currentText()[0]),
                 "stop_silence_ms": int(self.sp_stop.currentText()),
                 "min_voiced_ms": int(self.sp_minvo.currentText()),
+            },
+            "render": {
+                "quality": self.cb_quality.currentData(),
             }
         }
 
 
+# ----------------- 外部検出プロセス連携 -----------------
+# 重い検出器（ウェイク / VAD / ASR）を別プロセスで動かし GUI とは共有メモリのリングでつなぐ
+# 1プロセス1リング（書き手1つ）  レコードは固定長 32 バイトで pickle しない
+# 書き手はレコードの seq を 0 にしてから本体 seq の順に書き 最後にヘッダの seq を公開し 読み手が待っている（armed）ときだけドアベルに1バイト送る
+# GUI はドアベルで即座に まとめて読み 取りこぼしに備えてキャプチャの読み出し周期でも読む
+DETECTOR_RING_RECORDS = 1024
+DETECTOR_MAGIC        = 0x31424452        # "RDB1"
+DETECTOR_HDR_BYTES    = 64
+DETECTOR_REC_DTYPE = np.dtype([("seq", "<u8"), ("t", "<f8"), ("kind", "u1"), ("label", "u1"),
+                               ("arg", "<i2"), ("value", "<f4"), ("_pad", "<u8")])
+DETECTOR_REC_FMT = "<dBBhf"               # seq 以外（seq は最後に書く）
+DETECTOR_WORKERS = [w for w in os.environ.get("RAINECHO_DETECTORS", "").split(",") if w.strip()]
+
+DET_AMBIENT, DET_WAKE, DET_SPEECH_START, DET_SPEECH_END, DET_LEVEL = 1, 2, 3, 4, 5
+DET_WAKE_LABELS = (WAKE_LABEL_START, WAKE_LABEL_SETTINGS)
+
+# ヘッダ: magic u32 / records u32 / write_seq u64 @8 / armed u32 @16
+_DET_OFF_SEQ = 8
+_DET_OFF_ARMED = 16
+
+
+class DetectorRingWriter:
+    """検出器プロセス側  emit はロックもシステムコールも無し（ドアベルは読み手が待つときだけ）"""
+    def __init__(self, shm_name: str, doorbell: str = None):
+        from multiprocessing import shared_memory
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.buf = self.shm.buf
+        magic, self.records = struct.unpack_from("<II", self.buf, 0)
+        if magic != DETECTOR_MAGIC: raise ValueError(f"not a detector ring: {shm_name}")
+        self.seq = struct.unpack_from("<Q", self.buf, _DET_OFF_SEQ)[0]
+        self._bell = None
+        self._bell_addr = doorbell
+
+    def emit(self, kind: int, label: int = 0, arg: int = 0, value: float = 0.0, t: float = None):
+        seq = self.seq + 1
+        off = DETECTOR_HDR_BYTES + (seq % self.records) * DETECTOR_REC_DTYPE.itemsize
+        struct.pack_into("<Q", self.buf, off, 0)          # 書き換え中の印（読み手は seq の前後一致で判定）
+        struct.pack_into(DETECTOR_REC_FMT, self.buf, off + 8, time.monotonic() if t is None else t,
+                         kind, label, arg, value)
+        struct.pack_into("<Q", self.buf, off, seq)
+        struct.pack_into("<Q", self.buf, _DET_OFF_SEQ, seq)
+        self.seq = seq
+        if self.buf[_DET_OFF_ARMED]:
+            self.buf[_DET_OFF_ARMED] = 0
+            self._ring()
+
+    # よく使う形
+    def ambient(self, strong: bool = False): self.emit(DET_AMBIENT, arg=int(bool(strong)))
+    def wake(self, label: str = WAKE_LABEL_START, score: float = 1.0):
+        self.emit(DET_WAKE, DET_WAKE_LABELS.index(label), value=score)
+    def speech(self, start: bool): self.emit(DET_SPEECH_START if start else DET_SPEECH_END)
+    def level(self, db: float): self.emit(DET_LEVEL, value=db)
+
+    def _ring(self):
+        if self._bell_addr is None: return
+        try:
+            if self._bell is None:
+                if sys.platform == "win32":
+                    self._bell = open(self._bell_addr, "wb", buffering=0)
+                else:
+                    import socket
+                    self._bell = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self._bell.connect(self._bell_addr); self._bell.setblocking(False)
+            (self._bell.write if sys.platform == "win32" else self._bell.send)(b"\x01")
+        except BlockingIOError:
+            pass                                   # 未読のベルが溜まっている = 読み手は起きる
+        except OSError:
+            self._bell = None
+
+    def close(self):
+        if self._bell is not None:
+            try: self._bell.close()
+            except OSError: pass
+        self.buf = None
+        self.shm.close()
+
+
+class _DetectorRing:
+    def __init__(self, records: int):
+        from multiprocessing import shared_memory
+        size = DETECTOR_HDR_BYTES + records * DETECTOR_REC_DTYPE.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.shm.buf[:size] = bytes(size)
+        struct.pack_into("<II", self.shm.buf, 0, DETECTOR_MAGIC, records)
+        self.records = records
+        self.recs = np.ndarray((records,), DETECTOR_REC_DTYPE, buffer=self.shm.buf, offset=DETECTOR_HDR_BYTES)
+        self.read_seq = 0
+        self.dropped = 0
+        self.proc = None
+        self.arm()
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def write_seq(self) -> int:
+        return struct.unpack_from("<Q", self.shm.buf, _DET_OFF_SEQ)[0]
+
+    def arm(self):
+        self.shm.buf[_DET_OFF_ARMED] = 1
+
+    def read(self):
+        """未読のレコードを seq 順の構造化配列で返す（追い越された分と書きかけは捨てる）"""
+        w = self.write_seq()
+        if w == self.read_seq: return None
+        start = max(self.read_seq + 1, w - self.records + 1)
+        seqs = np.arange(start, w + 1, dtype=np.uint64)
+        slots = seqs % self.records
+        batch = self.recs[slots]
+        # 写した後も seq が変わっていなければ 写している間に書き換えられていない
+        ok = (batch["seq"] == seqs) & (self.recs["seq"][slots] == seqs)
+        self.dropped += int(start - self.read_seq - 1) + int(len(ok) - np.count_nonzero(ok))
+        self.read_seq = w
+        return batch[ok]
+
+    def close(self):
+        self.recs = None
+        self.shm.close()
+        try: self.shm.unlink()
+        except FileNotFoundError: pass
+
+
+def _detector_main(target, shm_name: str, doorbell: str, args):
+    """検出器プロセスの入口  target(writer, *args) を呼ぶ（"module:function" でも可）"""
+    if isinstance(target, str):
+        import importlib
+        mod, _, fn = target.partition(":")
+        target = getattr(importlib.import_module(mod), fn)
+    w = DetectorRingWriter(shm_name, doorbell)
+    try:
+        target(w, *args)
+    finally:
+        w.close()
+
+
+class DetectorBridge(QObject):
+    def __init__(self, on_events=None, parent=None, records: int = DETECTOR_RING_RECORDS):
+        super().__init__(parent)
+        from PySide6.QtNetwork import QLocalServer
+        self.on_events = on_events          # on_events(structured array)  1回の読み出しで1回
+        self.records = records
+        self.rings = []
+        self._peers = []
+        self.delivered = 0; self.drains = 0; self.bells = 0
+        self.server = QLocalServer(self)
+        name = f"rainecho-det-{os.getpid()}"
+        QLocalServer.removeServer(name)
+        self.server.listen(name)
+        self.server.newConnection.connect(self._on_connection)
+
+    @property
+    def doorbell(self) -> str:
+        return self.server.fullServerName()
+
+    def add_ring(self) -> _DetectorRing:
+        r = _DetectorRing(self.records); self.rings.append(r)
+        return r
+
+    def spawn(self, target, *args):
+        """新しいリングを作って検出器プロセスを起動する"""
+        import multiprocessing
+        r = self.add_ring()
+        ctx = multiprocessing.get_context("spawn")
+        r.proc = ctx.Process(target=_detector_main, args=(target, r.name, self.doorbell, args),
+                             name=f"rainecho-detector-{len(self.rings)}", daemon=True)
+        r.proc.start()
+        return r
+
+    def _on_connection(self):
+        while self.server.hasPendingConnections():
+            s = self.server.nextPendingConnection()
+            s.readyRead.connect(lambda s=s: self._on_bell(s))
+            s.disconnected.connect(lambda s=s: self._on_disconnected(s))
+            self._peers.append(s)
+
+    def _on_disconnected(self, s):
+        if s in self._peers: self._peers.remove(s)
+        s.deleteLater()
+
+    def _on_bell(self, s):
+        s.readAll(); self.bells += 1
+        self.drain()
+
+    def drain(self) -> int:
+        n = 0
+        for r in self.rings:
+            while True:
+                batch = r.read()
+                if batch is not None and len(batch):
+                    n += len(batch)
+                    if self.on_events: self.on_events(batch)
+                # 待ちに入ってから もう一度だけ確かめる（その間に書かれた分をベル無しで拾う）
+                r.arm()
+                if r.write_seq() == r.read_seq: break
+        if n: self.delivered += n; self.drains += 1
+        return n
+
+    def stats(self) -> dict:
+        return {"rings": len(self.rings), "delivered": self.delivered, "drains": self.drains,
+                "bells": self.bells, "dropped": sum(r.dropped for r in self.rings)}
+
+    def shutdown(self):
+        for r in self.rings:
+            if r.proc is not None and r.proc.is_alive():
+                r.proc.terminate(); r.proc.join(1.0)
+            r.close()
+        self.rings = []
+        self.server.close()
+
+
+# ----------------- 会話・イベント記録 -----------------
+# 会話ターンと状態遷移などを SQLite に残す  GUI は deque に積むだけで 書き込みは専用スレッドが
+# STORE_FLUSH_MS ごとにまとめて1トランザクションで行う（WAL なので読み出しは書き込みを待たない）
+# 本文は FTS5 の外部コンテンツ索引に入れる  日本語は単語区切りが無いので trigram で部分一致させる
+STORE_ENABLED        = os.environ.get("RAINECHO_HISTORY", "1") not in ("", "0")
+STORE_PATH           = os.environ.get("RAINECHO_HISTORY_DB") or os.path.join(
+    os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"), "rainecho", "history.sqlite3")
+STORE_FLUSH_MS       = 250
+STORE_BATCH_MAX      = 512      # これだけ溜まったら待たずに書く
+STORE_RETENTION_DAYS = 180      # これより古い行は掃除で消す（0 = 無期限）
+STORE_MAX_ROWS       = 1_000_000
+STORE_COMPACT_SEC    = 6 * 3600
+STORE_DELETE_CHUNK   = 5000     # 掃除の1トランザクションで消す行数（新しい書き込みを長く待たせない）
+
+_STORE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, ts REAL NOT NULL, kind TEXT NOT NULL,"
+    " role TEXT NOT NULL DEFAULT '', text TEXT NOT NULL DEFAULT '', meta TEXT)",
+    "CREATE INDEX IF NOT EXISTS events_ts ON events(ts)",
+    "CREATE INDEX IF NOT EXISTS events_kind ON events(kind, id)",
+)
+_STORE_FTS = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(text, content='events', content_rowid='id', tokenize='{tok}')",
+    "CREATE TRIGGER IF NOT EXISTS events_ai AFTER INSERT ON events WHEN new.text != '' BEGIN"
+    " INSERT INTO events_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS events_ad AFTER DELETE ON events WHEN old.text != '' BEGIN"
+    " INSERT INTO events_fts(events_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+)
+_STORE_COLS = "id, ts, kind, role, text, meta"
+
+
+def _store_row(r) -> dict:
+    return {"id": r[0], "ts": r[1], "kind": r[2], "role": r[3], "text": r[4],
+            "meta": json.loads(r[5]) if r[5] else {}}
+
+
+class EventStore:
+    def __init__(self, path: str = STORE_PATH, retention_days: float = STORE_RETENTION_DAYS,
+                 max_rows: int = STORE_MAX_ROWS, clock=time.time):
+        self.path = path
+        self.retention_days = retention_days
+        self.max_rows = max_rows
+        self.clock = clock                # 記録時刻は壁時計（日をまたいで残るので）
+        self.fts = None                   # 使えた FTS5 のトークナイザ名（None = LIKE 検索）
+        self.enabled = True
+        self.written = 0; self.batches = 0; self.write_ms = 0.0; self.compactions = 0; self.deleted = 0
+        self._q = deque()
+        self._kick = threading.Event()
+        self._ready = threading.Event()
+        self._local = threading.local()   # 読み出し用の接続はスレッドごと
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="rainecho-store", daemon=True)
+        self._thread.start()
+
+    # ===== 書き込み（どのスレッドからでも 待たない） =====
+    def log(self, kind: str, text: str = "", role: str = "", **meta):
+        if not self.enabled or self._closed: return
+        self._q.append((self.clock(), kind, role, text or "", json.dumps(meta, ensure_ascii=False) if meta else None))
+        if len(self._q) >= STORE_BATCH_MAX: self._kick.set()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """ここまでに積んだ分が書き終わるまで待つ"""
+        if not self.enabled or self._closed: return False
+        done = threading.Event(); self._q.append(done); self._kick.set()
+        return done.wait(timeout) and self.enabled      # 書き込みに失敗して止まったら False
+
+    def compact(self):
+        """保持期間と行数上限の掃除 索引の最適化を次の書き込みの後に行う"""
+        self._q.append("compact"); self._kick.set()
+
+    def close(self, timeout: float = 5.0):
+        if self._closed: return
+        self._closed = True
+        self._q.append(None); self._kick.set()
+        self._thread.join(timeout)
+        con = getattr(self._local, "con", None)
+        if con is not None: con.close(); self._local.con = None
+
+    # ===== 読み出し =====
+    def _reader(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            self._ready.wait(5.0)
+            con = self._local.con = sqlite3.connect(self.path, timeout=1.0)
+        return con
+
+    def recent(self, n: int = 20, kind: str = None):
+        """新しい順に n 件"""
+        if not self.enabled: return []
+        if kind is None:
+            cur = self._reader().execute(f"SELECT {_STORE_COLS} FROM events ORDER BY id DESC LIMIT ?", (int(n),))
+        else:
+            cur = self._reader().execute(f"SELECT {_STORE_COLS} FROM events WHERE kind = ? ORDER BY id DESC LIMIT ?",
+                                         (kind, int(n)))
+        return [_store_row(r) for r in cur]
+
+    def search(self, query: str, limit: int = 20, kind: str = None):
+        """本文の部分一致で新しい順に limit 件  trigram は3文字未満を引けないので短い語は LIKE で探す"""
+        if not self.enabled or not query.strip(): return []
+        q = query.strip()
+        if self.fts and (self.fts != "trigram" or len(q) >= 3):
+            sql = (f"SELECT {', '.join('e.' + c.strip() for c in _STORE_COLS.split(','))} FROM events_fts f"
+                   " JOIN events e ON e.id = f.rowid WHERE events_fts MATCH ?")
+            args = ['"' + q.replace('"', '""') + '"']
+            if kind is not None: sql += " AND e.kind = ?"; args.append(kind)
+            sql += " ORDER BY f.rowid DESC LIMIT ?"
+        else:
+            sql = f"SELECT {_STORE_COLS} FROM events WHERE text LIKE ? ESCAPE '\\'"
+            args = ["%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"]
+            if kind is not None: sql += " AND kind = ?"; args.append(kind)
+            sql += " ORDER BY id DESC LIMIT ?"
+        return [_store_row(r) for r in self._reader().execute(sql, (*args, int(limit)))]
+
+    def count(self) -> int:
+        if not self.enabled: return 0
+        return self._reader().execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {"written": self.written, "batches": self.batches, "pending": len(self._q),
+                "write_ms_per_batch": round(self.write_ms / max(1, self.batches), 3),
+                "compactions": self.compactions, "deleted": self.deleted, "fts": self.fts}
+
+    # ===== 書き込みスレッド =====
+    def _open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        con = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")     # 新規ファイルのときだけ効く
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute("PRAGMA synchronous = NORMAL")
+        for sql in _STORE_SCHEMA: con.execute(sql)
+        for tok in ("trigram", "unicode61"):
+            try:
+                for sql in _STORE_FTS: con.execute(sql.format(tok=tok))
+            except sqlite3.OperationalError:
+                continue
+            # 既存ファイルは作成時のトークナイザのまま
+            row = con.execute("SELECT sql FROM sqlite_master WHERE name = 'events_fts'").fetchone()
+            self.fts = "trigram" if row and "trigram" in row[0] else "unicode61"
+            break
+        return con
+
+    def _run(self):
+        try:
+            con = self._open()
+        except (OSError, sqlite3.Error) as ex:
+            print(f"[store] 履歴 DB を開けませんでした: {ex}", file=sys.stderr)
+            self.enabled = False; self._ready.set()
+            self._release_waiters()
+            return
+        self._ready.set()
+        next_compact = time.monotonic() + STORE_COMPACT_SEC
+        try:
+            while True:
+                self._kick.wait(STORE_FLUSH_MS / 1000.0)
+                self._kick.clear()
+                rows, waiters, compact, stop = [], [], False, False
+                while self._q:
+                    item = self._q.popleft()
+                    if isinstance(item, tuple): rows.append(item)
+                    elif isinstance(item, threading.Event): waiters.append(item)
+                    elif item == "compact": compact = True
+                    else: stop = True
+                try:
+                    if rows: self._write(con, rows)
+                    if compact or time.monotonic() >= next_compact:
+                        self._compact(con); next_compact = time.monotonic() + STORE_COMPACT_SEC
+                finally:
+                    for ev in waiters: ev.set()         # 失敗しても flush を待つ側は必ず起こす
+                if stop: break
+        except sqlite3.Error as ex:
+            print(f"[store] 履歴の書き込みに失敗しました: {ex}", file=sys.stderr)
+            self.enabled = False
+        finally:
+            con.close()
+            self._release_waiters()                     # 止まった後に積まれた flush も待たせない
+
+    def _release_waiters(self):
+        while self._q:
+            item = self._q.popleft()
+            if isinstance(item, threading.Event): item.set()
+
+    def _write(self, con, rows):
+        t0 = time.perf_counter()
+        con.execute("BEGIN")
+        con.executemany("INSERT INTO events (ts, kind, role, text, meta) VALUES (?, ?, ?, ?, ?)", rows)
+        con.execute("COMMIT")
+        self.write_ms += (time.perf_counter() - t0) * 1000.0
+        self.written += len(rows); self.batches += 1
+
+    def _delete_chunks(self, con, where: str, args) -> int:
+        total = 0
+        while True:
+            con.execute("BEGIN")
+            n = con.execute(f"DELETE FROM events WHERE id IN (SELECT id FROM events WHERE {where} ORDER BY id LIMIT ?)",
+                            (*args, STORE_DELETE_CHUNK)).rowcount
+            con.execute("COMMIT")
+            total += n
+            if n < STORE_DELETE_CHUNK: return total
+            # 掃除の途中でも溜まった書き込みは先に流す
+            rows = []
+            while self._q and isinstance(self._q[0], tuple): rows.append(self._q.popleft())
+            if rows: self._write(con, rows)
+
+    def _compact(self, con):
+        n = 0
+        if self.retention_days and self.retention_days > 0:
+            n += self._delete_chunks(con, "ts < ?", (self.clock() - self.retention_days * 86400.0,))
+        if self.max_rows:
+            row = con.execute("SELECT id FROM events ORDER BY id DESC LIMIT 1 OFFSET ?", (int(self.max_rows),)).fetchone()
+            if row is not None: n += self._delete_chunks(con, "id <= ?", (row[0],))
+        if self.fts: con.execute("INSERT INTO events_fts(events_fts) VALUES ('optimize')")
+        con.execute("PRAGMA incremental_vacuum")
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.deleted += n; self.compactions += 1
+
+
+_EVENT_STORE = None
+
+def event_store():
+    """アプリ共通の履歴ストア（RAINECHO_HISTORY=0 なら None）"""
+    global _EVENT_STORE
+    if _EVENT_STORE is None and STORE_ENABLED:
+        _EVENT_STORE = EventStore()
+        app = QApplication.instance()
+        if app is not None: app.aboutToQuit.connect(_EVENT_STORE.close)
+    return _EVENT_STORE
+
+
+# ----------------- 応答キャッシュ -----------------
+# 挨拶やウェイク応答のような決まった返事は 文面と合成済み PCM を取っておいて次から通信せずに鳴らす
+# キーは正規化したプロンプト・モデル・感情プリセット・システムプロンプトのハッシュ
+# メモリ上の LRU の下にディスク（<key>.json + <key>.pcm）を置き PCM は mmap のままミキサーに渡す
+RESP_CACHE_DIR          = os.path.join(os.path.dirname(PCM_CACHE_DIR), "responses")
+RESP_CACHE_MEM_BYTES    = 32 * 1024 * 1024
+RESP_CACHE_DISK_BYTES   = 256 * 1024 * 1024
+RESP_CACHE_MAX_AGE_DAYS = 60        # 最後に使ってからこれだけ経ったら捨てる
+RESP_CACHE_MAX_PROMPT   = 120       # これより長いプロンプトは一期一会とみなして入れない
+WAKE_ACK_PROMPT         = "<wake>"  # ウェイク応答のキャッシュ用プロンプト
+
+_PROMPT_TRAIL = " 。．.、，,!！?？～〜ー…"
+
+def normalize_prompt(text: str) -> str:
+    """全角半角・大小文字・空白・末尾の記号の違いを吸収する"""
+    t = unicodedata.normalize("NFKC", text or "").casefold()
+    return " ".join(t.split()).rstrip(_PROMPT_TRAIL)
+
+def response_key(prompt: str, model: str, emotion: str, system_prompt: str) -> str:
+    sp = hashlib.sha1((system_prompt or "").encode("utf-8")).hexdigest()
+    return hashlib.sha1("\x1f".join((normalize_prompt(prompt), model or "", emotion or "", sp)).encode("utf-8")).hexdigest()
+
+
+class CachedResponse:
+    __slots__ = ("key", "text", "pcm", "sr", "ch")
+    def __init__(self, key, text, pcm=None, sr=48000, ch=2):
+        self.key = key; self.text = text; self.pcm = pcm; self.sr = sr; self.ch = ch
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.text.encode("utf-8")) + (len(self.pcm) if self.pcm is not None else 0)
+
+
+class ResponseCache:
+    def __init__(self, root: str = RESP_CACHE_DIR, mem_bytes: int = RESP_CACHE_MEM_BYTES,
+                 disk_bytes: int = RESP_CACHE_DISK_BYTES, max_age_days: float = RESP_CACHE_MAX_AGE_DAYS):
+        self.root = root
+        self.mem_bytes = mem_bytes; self.disk_bytes = disk_bytes
+        self.max_age = max_age_days * 86400.0
+        self._mem = OrderedDict()           # key -> CachedResponse（末尾が最近）
+        self._mem_used = 0
+        self._disk = None                   # key -> [bytes, 最終使用時刻, pcm ファイル名]  初回アクセスで一度だけ走査
+        self._disk_used = 0
+        self._lock = threading.Lock()       # 生成側（通信/合成スレッド）と GUI の両方から触る
+        self.hits_mem = 0; self.hits_disk = 0; self.misses = 0; self.evicted = 0
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.root, key + ext)
+
+    # ===== 参照 =====
+    def get(self, prompt: str, model: str, emotion: str, system_prompt: str):
+        if len(prompt or "") > RESP_CACHE_MAX_PROMPT: return None
+        return self.get_key(response_key(prompt, model, emotion, system_prompt))
+
+    def get_key(self, key: str):
+        with self._lock:
+            e = self._mem.get(key)
+            if e is not None:
+                self._mem.move_to_end(key); self.hits_mem += 1
+                self._touch(key)
+                return e
+            e = self._load(key)
+            if e is None:
+                self.misses += 1; return None
+            self.hits_disk += 1
+            self._remember(e)
+            return e
+
+    def _touch(self, key: str):
+        d = self._scan().get(key)
+        if d is None: return
+        now = time.time()
+        if now - d[1] < 60.0: return        # 使用時刻の更新は分単位で十分
+        d[1] = now
+        try: os.utime(self._path(key, ".json"))
+        except OSError: pass
+
+    def _load(self, key: str):
+        if key not in self._scan(): return None
+        try:
+            with open(self._path(key, ".json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            self._drop_disk(key); return None
+        pcm = None
+        name = meta.get("pcm")
+        if name:
+            # 旧形式は True で <key>.pcm  今は中身で名前が決まる版付きのファイル名
+            name = os.path.basename(name) if isinstance(name, str) else key + ".pcm"
+            pcm = _pcm_cache_load(os.path.join(self.root, name))
+            if pcm is None:
+                self._drop_disk(key); return None
+        self._disk[key][1] = time.time()
+        try: os.utime(self._path(key, ".json"))
+        except OSError: pass
+        return CachedResponse(key, meta.get("text", ""), pcm, int(meta.get("sr", 48000)), int(meta.get("ch", 2)))
+
+    # ===== 登録 =====
+    def put(self, prompt: str, model: str, emotion: str, system_prompt: str,
+            text: str, pcm=None, sr: int = 48000, ch: int = 2):
+        if len(prompt or "") > RESP_CACHE_MAX_PROMPT: return None
+        key = response_key(prompt, model, emotion, system_prompt)
+        data = bytes(pcm) if pcm is not None else None
+        # PCM は中身のハッシュ付きの名前で書く  mmap で読まれているファイルを置き換え/上書きしない
+        name = f"{key}.{hashlib.sha1(data).hexdigest()[:12]}.pcm" if data is not None else None
+        meta = {"text": text, "pcm": name, "sr": int(sr), "ch": int(ch),
+                "model": model, "emotion": emotion, "prompt": normalize_prompt(prompt)}
+        with self._lock:
+            self._scan()
+            size = 0
+            if data is not None:
+                path = os.path.join(self.root, name)
+                try: same = os.path.getsize(path) == len(data)
+                except OSError: same = False
+                if not same: _pcm_cache_store(path, data)      # 同じ中身がもうあれば書かない
+                else:
+                    try: os.utime(path)                          # 走査で現役の版と分かるように
+                    except OSError: pass
+                size += len(data)
+            _pcm_cache_store(self._path(key, ".json"), json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+            size += len(text.encode("utf-8"))
+            old = self._disk.pop(key, None)
+            if old is not None:
+                self._disk_used -= old[0]
+                # 前の版は json が指さなくなってから消す（消せなければ次回の走査で片付く）
+                self._unlink(key, [n for n in old[2] if n != name], json_too=False)
+            self._disk[key] = [size, time.time(), [name] if name else []]; self._disk_used += size
+            old = self._mem.pop(key, None)
+            if old is not None: self._mem_used -= old.nbytes
+            e = CachedResponse(key, text, data, int(sr), int(ch))
+            self._remember(e)
+            self._evict_disk()
+            return e
+
+    def _remember(self, e: CachedResponse):
+        if e.nbytes > self.mem_bytes: return
+        self._mem[e.key] = e; self._mem_used += e.nbytes
+        while self._mem_used > self.mem_bytes:
+            _, old = self._mem.popitem(last=False); self._mem_used -= old.nbytes
+
+    # ===== ディスク =====
+    def _scan(self) -> dict:
+        if self._disk is not None: return self._disk
+        self._disk = {}; self._disk_used = 0
+        try:
+            it = list(os.scandir(self.root))
+        except OSError:
+            return self._disk
+        found = {}
+        for de in it:
+            ext = os.path.splitext(de.name)[1]
+            if ext not in (".json", ".pcm"): continue
+            key = de.name.split(".", 1)[0]
+            try: st = de.stat()
+            except OSError: continue
+            d = found.setdefault(key, [0.0, None, []])          # [最終使用時刻, json の大きさ, PCM の版]
+            if ext == ".json": d[0] = st.st_mtime; d[1] = st.st_size
+            else: d[2].append((st.st_mtime, st.st_size, de.name))
+        for key, (used, jsize, pcms) in found.items():
+            if jsize is None:
+                self._unlink(key, [n for _, _, n in pcms], json_too=False); continue   # 書きかけの残骸
+            pcms.sort()
+            if len(pcms) > 1:                # 消しそびれた前の版  書くのは PCM→json の順なので一番新しいのが現役
+                self._unlink(key, [n for _, _, n in pcms[:-1]], json_too=False); pcms = pcms[-1:]
+            size = jsize + sum(sz for _, sz, _ in pcms)
+            self._disk[key] = [size, used, [n for _, _, n in pcms]]; self._disk_used += size
+        self._evict_disk()
+        return self._disk
+
+    def _unlink(self, key: str, pcm_names=(), json_too: bool = True):
+        names = list(pcm_names) + ([key + ".json"] if json_too else [])
+        for n in names:
+            try: os.remove(os.path.join(self.root, n))
+            except OSError: pass
+
+    def _drop_disk(self, key: str):
+        d = self._disk.pop(key, None) if self._disk is not None else None
+        if d is not None: self._disk_used -= d[0]
+        self._unlink(key, d[2] if d is not None else ())
+
+    def _evict_disk(self):
+        """古すぎるものを捨ててから 容量を超えた分を使われていない順に捨てる"""
+        if not self._disk: return
+        cut = time.time() - self.max_age
+        order = sorted(self._disk.items(), key=lambda kv: kv[1][1])
+        for key, (size, used, _) in order:
+            if used >= cut and self._disk_used <= self.disk_bytes: break
+            self._drop_disk(key); self.evicted += 1
+            old = self._mem.pop(key, None)
+            if old is not None: self._mem_used -= old.nbytes
+
+    def stats(self) -> dict:
+        n = self.hits_mem + self.hits_disk + self.misses
+        return {"hits_mem": self.hits_mem, "hits_disk": self.hits_disk, "misses": self.misses,
+                "hit_rate": round((self.hits_mem + self.hits_disk) / n, 3) if n else 0.0,
+                "mem_entries": len(self._mem), "mem_kb": self._mem_used // 1024,
+                "disk_entries": len(self._disk or ()), "disk_kb": self._disk_used // 1024, "evicted": self.evicted}
+
+
+_RESPONSE_CACHE = None
+
+def response_cache() -> ResponseCache:
+    global _RESPONSE_CACHE
+    if _RESPONSE_CACHE is None:
+        _RESPONSE_CACHE = ResponseCache()
+    return _RESPONSE_CACHE
+
+
 # ----------------- メイン -----------------
 class MainWindow(QWidget):
-    def __init__(self):
+    def __init__(self, clock=time.monotonic):
         super().__init__()
         self.setWindowTitle(APP_TITLE)
 
@@ -645,8 +4068,12 @@ class MainWindow(QWidget):
         self.setPalette(pal)
 
         self.header = CloudHeader(self)
-        self.canvas = RainCanvas()
+        self.canvas = RainCanvas(clock)
         self.canvas.setParent(self)
+        self.canvas.on_quality_change = self._on_quality_change
+        if RENDER_THREADED:
+            self.canvas.set_threaded(True)
+            QApplication.instance().aboutToQuit.connect(lambda: self.canvas.set_threaded(False))
 
         root = QVBoxLayout(self)
         root.setContentsMargins(0,0,0,0)
@@ -676,31 +4103,154 @@ class MainWindow(QWidget):
         self._update_tray_icon(LinoState.IDLE)
         self.tray.show()
 
-        # 設定はメイン内オーバーレイ
-        self.settings_overlay = SettingsOverlay(self)
-        self.settings_overlay.btn_apply_audio.clicked.connect(self._apply_audio_settings)
+        # 設定オーバーレイ・マイク入力・検出器・雨入りSE は重いので
+        # LAZY_STARTUP のときは初回描画の後に一つずつ作る（_deferred_init）
+        self.settings_overlay = None
+        self.profiler_overlay = ProfilerOverlay(self)
+
+        self.audio_cfg_cache = dict(DEFAULT_CONFIG["audio"])
 
-        self.audio_cfg_cache = {"device_id": None, "samplerate": 48000, "channels": 1}
+        # マイク入力（キャプチャと検出器は別スレッド GUI は出来事を受け取るだけでリングを読みに行かない）
+        # VAD / ウェイクワードは _start_capture が実際の SR で組み直す
+        self.capture = None
+        self.pipe = CapturePipeline(self)
+        self.pipe.events.connect(self._on_capture_events)
+        self._ambient_batch = None      # 1回の配送の最後に出す ping（True = strong）
 
-        # 雨入り用SE（既存ShowerSE優先 無ければGentleRainSE）
+        # 雨入り・状態遷移の SE（サウンド素材があればそれ 無ければ雨入りだけ GentleRainSE）
         self._gentle_shower = None
-        self._init_gentle_shower()
+        self._se = None
+
+        # 会話・状態遷移の履歴（書き込みは別スレッド）
+        self.store = None
+
+        # 決まった返事の文面と音声（当たればミキサーの voice バスで即再生）
+        self.voice_out = None
+
+        # 別プロセスの検出器（RAINECHO_DETECTORS="module:function,..." のときだけ）
+        self.detectors = None
+        self.detector_level_db = None
+
+        # メトリクス（RAINECHO_METRICS のときだけ出力する ゲージは取得時に読む）
+        self.metrics = None
+        self._state_since = None
+        self._register_metrics()
+
+        self._deferred_done = False
+        self.canvas.on_first_paint = self._deferred_init
+        if LAZY_STARTUP:
+            QTimer.singleShot(STARTUP_IDLE_MS, self._deferred_init)
+        else:
+            self._start_capture(); STARTUP.mark("capture")
+            self._init_gentle_shower(); STARTUP.mark("rain_se")
+            self._open_store(); STARTUP.mark("store")
+            if DETECTOR_WORKERS: self._start_detectors(); STARTUP.mark("detectors")
+            if METRICS_ADDR: self._start_metrics(); STARTUP.mark("metrics")
+            self._ensure_settings_overlay()
+
+        # 時間で起きる処理はすべてデッドラインスケジューラに載せる（毎秒のポーリングはしない）
+        self.scheduler = DeadlineScheduler(self, clock)
 
         # 昼↔夜 自動サイクル
-        self.cycle_timer = QTimer(self); self.cycle_timer.timeout.connect(self._cycle_idle_sleep)
-        self.cycle_timer.start(1000); self._cycle_next_ts = time.time() + IDLE_SLEEP_CYCLE_SEC
+        self._schedule_cycle()
 
         # 無操作タイムアウト
-        self.last_activity_ts = time.time()
-        self.timeout_timer = QTimer(self); self.timeout_timer.timeout.connect(self._check_timeout); self.timeout_timer.start(1000)
+        self.last_activity_ts = 0.0
+        self._touch_activity()
 
         self.set_state(LinoState.IDLE)
+        self._state_since = self.scheduler.clock()
+
+    # ===== 遅延初期化 =====
+    def _deferred_init(self):
+        # 初回描画の後 イベントループに返しながら未作成のものを一段ずつ作る
+        if self._deferred_done: return
+        self._deferred_done = True
+        self.canvas.on_first_paint = None
+        STARTUP.mark("first_paint")
+        steps = [("devices", lambda: _DEVICE_REGISTRY is None, device_registry),   # 列挙は起動時のここで1回
+                 ("capture", lambda: self.capture is None, self._start_capture),
+                 ("rain_se", lambda: self._gentle_shower is None, self._init_gentle_shower),
+                 ("store", lambda: self.store is None, self._open_store),
+                 ("detectors", lambda: self.detectors is None and DETECTOR_WORKERS, self._start_detectors),
+                 ("metrics", lambda: self.metrics is None and METRICS_ADDR, self._start_metrics),
+                 ("settings_overlay", lambda: self.settings_overlay is None, self._ensure_settings_overlay)]
+        steps = [st for st in steps if st[1]()]
+
+        def run_next():
+            if not steps:
+                if STARTUP_REPORT: print(STARTUP.format(), file=sys.stderr)
+                return
+            name, pending, fn = steps.pop(0)
+            if pending():
+                fn()
+                if name != "settings_overlay": STARTUP.mark(name)
+            QTimer.singleShot(0, run_next)
+        QTimer.singleShot(0, run_next)
+
+    def _ensure_settings_overlay(self):
+        if self.settings_overlay is not None:
+            return self.settings_overlay
+        so = self.settings_overlay = SettingsOverlay(self)
+        so.btn_apply_audio.clicked.connect(self._apply_audio_settings)
+        for cb in (so.cb_frame, so.cb_aggr, so.sp_stop, so.sp_minvo):
+            cb.currentIndexChanged.connect(self._apply_vad_settings)
+        so.sl_th.valueChanged.connect(self._apply_wake_settings)
+        so.ck_short.toggled.connect(self._apply_wake_settings)
+        so.ck_sim.toggled.connect(self._apply_wake_settings)
+        so.cb_quality.currentIndexChanged.connect(self._apply_render_settings)
+        so.set_quality_status(self.canvas.quality.tier, self.canvas.quality.pinned is None)
+        STARTUP.mark("settings_overlay")
+        return so
+
+    def current_config(self) -> dict:
+        # オーバーレイが未作成なら既定値（適用済みのオーディオ設定は audio_cfg_cache）
+        if self.settings_overlay is not None:
+            return self.settings_overlay.current_config()
+        cfg = {k: dict(v) for k, v in DEFAULT_CONFIG.items()}
+        cfg["audio"] = dict(self.audio_cfg_cache)
+        return cfg
+
+    # ===== 履歴 =====
+    def _open_store(self):
+        self.store = event_store()
+
+    def _log(self, kind: str, text: str = "", role: str = "", **meta):
+        if self.store is not None:
+            self.store.log(kind, text, role, **meta)
+
+    def log_turn(self, role: str, text: str):
+        """会話1ターンを記録する（role は "user" / "assistant"）  その時の API 設定も添える"""
+        api = self.current_config()["api"]
+        sp = hashlib.sha1(api.get("system_prompt", "").encode("utf-8")).hexdigest()[:12]
+        self._log("turn", text, role, model=api.get("model"), emotion=api.get("tts_emotion"), system=sp)
+
+    # ===== 応答キャッシュ =====
+    def _api_key_parts(self):
+        api = self.current_config()["api"]
+        return api.get("model", ""), api.get("tts_emotion", ""), api.get("system_prompt", "")
+
+    def play_cached_reply(self, prompt: str):
+        """キャッシュに返事があればすぐ鳴らして文面を返す（無ければ None 呼び出し側が生成する）"""
+        e = response_cache().get(prompt, *self._api_key_parts())
+        if e is None: return None
+        if e.pcm is not None:
+            if self.voice_out is None:
+                self.voice_out = _PCMOut(self, sr=48000, ch=2, vol=0.8, bus="voice")
+            self.voice_out.play_pcm(e.pcm, e.sr, e.ch)
+        if prompt != WAKE_ACK_PROMPT: self.log_turn("assistant", e.text)
+        return e.text
+
+    def cache_reply(self, prompt: str, text: str, pcm=None, sr: int = 48000, ch: int = 2):
+        """生成した返事（と合成 PCM）を今の API 設定のキーで登録する"""
+        return response_cache().put(prompt, *self._api_key_parts(), text, pcm, sr, ch)
 
     # ===== センタリング追従 =====
     def resizeEvent(self, e):
         super().resizeEvent(e)
         if self.settings_overlay:
             self.settings_overlay.parent_resized_or_moved()
+        self.profiler_overlay.reposition()
 
     def moveEvent(self, e):
         super().moveEvent(e)
@@ -715,75 +4265,202 @@ class MainWindow(QWidget):
 
     # ===== 既存ロジック =====
     def _init_gentle_shower(self):
-        if hasattr(self, "se") and hasattr(self.se, "play_once"):
-            try:
-                if hasattr(self.se, "sink"):
-                    self.se.sink.setVolume(0.5)
-                self._gentle_shower = self.se
-                return
-            except Exception:
-                pass
-        try:
-            from __main__ import ShowerSE
-            self._gentle_shower = ShowerSE(self, duration_sec=5.5)
-            try:
-                if hasattr(self._gentle_shower, "sink"):
-                    self._gentle_shower.sink.setVolume(0.5)
-            except Exception:
-                pass
-            return
-        except Exception:
-            pass
-        self._gentle_shower = GentleRainSE(self, duration_sec=5.5)
+        bank = sound_bank()
+        if len(bank):
+            self._se = AssetSE(bank, self)
+        if self._se is not None and bank.pick("idle-listening", "listening") is not None:
+            self._gentle_shower = self._se
+        else:
+            self._gentle_shower = GentleRainSE(self, duration_sec=5.5)
 
     def play_entry_se(self):
+        if self._gentle_shower is None:
+            self._init_gentle_shower()
         if self._gentle_shower and hasattr(self._gentle_shower, "play_once"):
             self._gentle_shower.play_once()
 
-    def on_ambient_detected(self):
+    def on_ambient_detected(self, strong: bool = False):
         if self.canvas.state != LinoState.LISTENING:
-            self.canvas.ping_center(strong=False)
-            self.last_activity_ts = time.time()
+            self.canvas.ping_center(strong=strong)
+            self._touch_activity()
+
+    def on_speech_start(self):
+        if self.canvas.state == LinoState.SLEEPING:
+            self.set_state(LinoState.IDLE, "speech")
+        self.on_ambient_detected()
+        self._touch_activity()
+
+    def on_speech_end(self):
+        self._touch_activity()
+
+    # 検出器はキャプチャスレッドの CapturePipeline が持つ（差し替えは lock の中）
+    vad   = property(lambda self: self.pipe.vad,   lambda self, d: self.pipe.swap("vad", d))
+    wake  = property(lambda self: self.pipe.wake,  lambda self, d: self.pipe.swap("wake", d))
+    meter = property(lambda self: self.pipe.meter, lambda self, d: self.pipe.swap("meter", d))
+
+    def feed_audio(self, pcm, ch: int = None, sr: int = None):
+        """キャプチャを通さずに PCM を検出器へ入れる（GUI スレッドで同期に配る）"""
+        r = self.pipe.reader
+        ch = ch or self.audio_cfg_cache["channels"]
+        sr = sr or (r.ring.sr if r is not None else self.audio_cfg_cache["samplerate"])
+        with self.pipe.lock:
+            self.pipe.feed(pcm, ch, sr)
+            ev = self.pipe.take()
+        if ev: self._on_capture_events(ev)
+
+    def _start_capture(self):
+        if self.capture is None:
+            self.capture = AudioCapture(self, self.pipe)
+            QApplication.instance().aboutToQuit.connect(self.capture.shutdown)
+        c = self.audio_cfg_cache
+        self.pipe.attach(self.capture.configure(c["device_id"], c["samplerate"], c["channels"]))
+        self._apply_vad_settings()
+        self._apply_wake_settings()
+        self.meter = AmbientMeter(self._detector_sr(), on_event=self.pipe.on_ambient)
+
+    def _on_capture_events(self, events):
+        for ev in events:
+            if ev[0] == "speech_start": self.on_speech_start()
+            elif ev[0] == "speech_end": self.on_speech_end()
+            elif ev[0] == "wake": self._on_wake_detected(ev[1], ev[2])
+            elif ev[0] == "ambient": self._ambient_batch = ev[1] or bool(self._ambient_batch)
+        self._flush_ambient()
+
+    def _flush_ambient(self):
+        # 1回の配送で溜まった環境音イベントは1回の ping にまとめる
+        if self._ambient_batch is not None:
+            strong, self._ambient_batch = self._ambient_batch, None
+            self.on_ambient_detected(strong)
+            self._log("ambient", strong=strong)
+
+    def _start_detectors(self):
+        # 読み出しはベル（QLocalSocket）で起きる  drain は待ちに入ってから見直すのでポーリングは要らない
+        self.detectors = DetectorBridge(self._on_detector_events, self)
+        QApplication.instance().aboutToQuit.connect(self.detectors.shutdown)
+        for target in DETECTOR_WORKERS:
+            self.detectors.spawn(target.strip())
+
+    def _on_detector_events(self, batch):
+        # 1回の読み出し分をまとめて配る  レベルは最新だけ 環境音は1回の ping にまとめる
+        kinds = batch["kind"]
+        lv = batch["value"][kinds == DET_LEVEL]
+        if len(lv): self.detector_level_db = float(lv[-1])
+        amb = kinds == DET_AMBIENT
+        if amb.any():
+            self._ambient_batch = bool(batch["arg"][amb].any()) or bool(self._ambient_batch)
+        for k, label, val in zip(kinds.tolist(), batch["label"].tolist(), batch["value"].tolist()):
+            if k == DET_WAKE:
+                self._on_wake_detected(DET_WAKE_LABELS[min(label, len(DET_WAKE_LABELS) - 1)], val)
+            elif k == DET_SPEECH_START:
+                self.on_speech_start()
+            elif k == DET_SPEECH_END:
+                self.on_speech_end()
+        self._flush_ambient()
+
+    # ===== メトリクス =====
+    _METRIC_NAMES = ("rainecho_particles", "rainecho_quality_level", "rainecho_state",
+                     "rainecho_audio_latency_ms", "rainecho_audio_voices", "rainecho_state_time")
+
+    def _register_metrics(self):
+        # 名前で登録するので 作り直しても増えず 最新のウィンドウを指す  破棄時は _unregister_metrics で外す
+        c = self.canvas
+        METRICS.gauge("rainecho_particles", "Live particles",
+                      lambda: [(("drop",), c.particles.drop_count), (("ripple",), c.particles.ripple_count)], ("type",))
+        METRICS.gauge("rainecho_quality_level", "Render quality tier (0 = high)", lambda: c.quality.level)
+        METRICS.gauge("rainecho_state", "Current state (1 for the active one)",
+                      lambda: [((st.name.lower(),), int(c.state == st)) for st in LinoState], ("state",))
+        METRICS.gauge("rainecho_audio_latency_ms", "Queued output audio in the sink", self._audio_latency_ms, ("sr",))
+        METRICS.gauge("rainecho_audio_voices", "Active mixer voices",
+                      lambda: [((str(sr),), m.active_count()) for (sr, ch), m in _MIXERS.items()], ("sr",))
+        fn = self._account_state_time
+        METRICS.collector("rainecho_state_time", fn)
+        self.destroyed.connect(lambda *_: MainWindow._unregister_metrics(fn))
+
+    @staticmethod
+    def _unregister_metrics(owner):
+        if METRICS.collectors.get("rainecho_state_time") == owner:   # 後から作られた窓の登録は外さない
+            METRICS.unregister(*MainWindow._METRIC_NAMES)
+
+    @staticmethod
+    def _audio_latency_ms():
+        out = []
+        for (sr, ch), m in _MIXERS.items():
+            if m.sink is None: continue
+            in_sink = max(0, m.sink.bufferSize() - m.sink.bytesFree())
+            out.append(((str(sr),), 1000.0 * in_sink / (sr * ch * 2)))
+        return out
+
+    def _account_state_time(self):
+        now = self.scheduler.clock()
+        if self._state_since is not None and self.canvas.state is not None:
+            M_STATE_SEC.inc(self.canvas.state.name.lower(), n=now - self._state_since)
+        self._state_since = now
+
+    def _start_metrics(self):
+        self.metrics = MetricsExporter(METRICS_ADDR, METRICS, self)
+        QApplication.instance().aboutToQuit.connect(self.metrics.shutdown)
+
+    def _detector_sr(self) -> int:
+        # 入力の SR はデバイス次第で変わるが 検出器は feed_audio で DETECTOR_SR に揃えてから受ける
+        return DETECTOR_SR
+
+    def _on_wake_detected(self, label: str, score: float):
+        self._log("wake", role=label, score=round(float(score), 3))
+        if label == WAKE_LABEL_SETTINGS:
+            self.on_wake_settings_detected()
+        else:
+            self.on_wake_start_detected()
 
     def on_wake_start_detected(self):
         if self.canvas.state == LinoState.LISTENING:
             return
         self.canvas.ping_center(strong=True)
         self.play_entry_se()
-        self.set_state(LinoState.LISTENING)
-        self.last_activity_ts = time.time()
+        self.play_cached_reply(WAKE_ACK_PROMPT)
+        self.set_state(LinoState.LISTENING, "wake")
+        self._touch_activity()
 
     def on_wake_settings_detected(self):
         self.toggle_settings_overlay()
-        self.last_activity_ts = time.time()
+        self._touch_activity()
 
-    def set_state(self, st: LinoState):
+    @profiled("set_state")
+    def set_state(self, st: LinoState, cause: str = "user"):
         if self.canvas.state == st:
             return
         prev = self.canvas.state
+        if METRICS.enabled:
+            self._account_state_time()
+            M_TRANSITIONS.inc(cause, st.name.lower())
         if prev == LinoState.LISTENING and st != LinoState.LISTENING:
             self.canvas.finish_drops_to_ripples()
         self.canvas.set_state(st)
+        if self._se is not None and st != LinoState.LISTENING:
+            self._se.play_transition(prev, st)      # 雨入りは play_entry_se（ウェイク時だけ）
+        self._log("state", role=st.name.lower(), prev=prev.name.lower() if prev is not None else None, cause=cause)
         self._update_tray_icon(st)
-        self._cycle_next_ts = time.time() + IDLE_SLEEP_CYCLE_SEC
-        self.last_activity_ts = time.time()
+        self._schedule_cycle()
+        self._touch_activity()
+
+    def _schedule_cycle(self):
+        self.scheduler.schedule("cycle", IDLE_SLEEP_CYCLE_SEC, self._cycle_idle_sleep)
+
+    def _touch_activity(self):
+        self.last_activity_ts = self.scheduler.clock()
+        self.scheduler.schedule("timeout", GLOBAL_TIMEOUT_SEC, self._check_timeout)
 
     def _cycle_idle_sleep(self):
+        self._schedule_cycle()
         if self.canvas.state == LinoState.LISTENING:
-            self._cycle_next_ts = time.time() + IDLE_SLEEP_CYCLE_SEC
             return
-        now = time.time()
-        if now >= self._cycle_next_ts:
-            self._cycle_next_ts = now + IDLE_SLEEP_CYCLE_SEC
-            self.set_state(LinoState.SLEEPING if self.canvas.state == LinoState.IDLE else LinoState.IDLE)
+        self.set_state(LinoState.SLEEPING if self.canvas.state == LinoState.IDLE else LinoState.IDLE, "cycle")
 
     def _check_timeout(self):
-        if time.time() - self.last_activity_ts >= GLOBAL_TIMEOUT_SEC:
-            if self.canvas.state == LinoState.LISTENING:
-                self.set_state(LinoState.SLEEPING)
-            else:
-                self.set_state(LinoState.SLEEPING if self.canvas.state == LinoState.IDLE else LinoState.IDLE)
-            self.last_activity_ts = time.time()
+        if self.canvas.state == LinoState.LISTENING:
+            self.set_state(LinoState.SLEEPING, "timeout")
+        else:
+            self.set_state(LinoState.SLEEPING if self.canvas.state == LinoState.IDLE else LinoState.IDLE, "timeout")
+        self._touch_activity()
 
     def _update_tray_icon(self, st: LinoState):
         if st == LinoState.LISTENING:
@@ -795,12 +4472,18 @@ class MainWindow(QWidget):
         self.tray.setIcon(icon)
         self.tray.setToolTip(tip)
 
-    # Ctrl + / で設定オーバーレイ開閉
+    # Ctrl + / で設定オーバーレイ開閉  Ctrl + P でプロファイラ（Shift 付きで JSON 書き出し）
     def keyPressEvent(self, e):
         if (e.key() == Qt.Key_Slash) and (e.modifiers() & (Qt.ControlModifier | Qt.MetaModifier)):
             self.toggle_settings_overlay(); return
+        if (e.key() == Qt.Key_P) and (e.modifiers() & (Qt.ControlModifier | Qt.MetaModifier)):
+            if e.modifiers() & Qt.ShiftModifier:
+                self.export_profile()
+            else:
+                self.profiler_overlay.toggle()
+            return
         if e.key() == Qt.Key_Escape:
-            if self.settings_overlay.isVisible():
+            if self.settings_overlay is not None and self.settings_overlay.isVisible():
                 self.settings_overlay.close_overlay()
             else:
                 self.set_state(LinoState.IDLE)
@@ -811,11 +4494,20 @@ class MainWindow(QWidget):
             self.set_state(LinoState.SLEEPING); return
         super().keyPressEvent(e)
 
+    def export_profile(self):
+        try:
+            path = PROFILER.export_json()
+        except OSError as ex:
+            self.tray.showMessage("RainEcho", f"プロファイルを書き出せませんでした: {ex}", QSystemTrayIcon.Warning, 2500)
+            return
+        self.tray.showMessage("RainEcho", f"プロファイルを書き出しました\n{path}", QSystemTrayIcon.Information, 2500)
+
     def toggle_settings_overlay(self):
-        if self.settings_overlay.isVisible():
-            self.settings_overlay.close_overlay()
+        so = self._ensure_settings_overlay()
+        if so.isVisible():
+            so.close_overlay()
         else:
-            self.settings_overlay.open()
+            so.open()
 
     def closeEvent(self, e):
         self.hide()
@@ -827,11 +4519,39 @@ class MainWindow(QWidget):
         else: self.showNormal(); self.activateWindow()
 
     def _apply_audio_settings(self):
-        cfg = self.settings_overlay.current_config()
+        cfg = self.current_config()
         self.audio_cfg_cache = cfg["audio"]
+        self._start_capture()
         QMessageBox.information(self, "RainEcho",
             f"オーディオ設定を適用しました\nデバイスID: {self.audio_cfg_cache['device_id']}\nSR: {self.audio_cfg_cache['samplerate']}\nCH: {self.audio_cfg_cache['channels']}")
 
+    def _apply_vad_settings(self, *_):
+        cfg = self.current_config()
+        self.vad = StreamingVAD.from_config(cfg["vad"], sr=self._detector_sr(),
+                                            on_start=self.pipe.on_speech_start, on_end=self.pipe.on_speech_end)
+
+    def _apply_wake_settings(self, *_):
+        wcfg = self.current_config()["wake"]
+        sr = self._detector_sr()
+        if self.wake is not None and self.wake.sr == sr:
+            with self.pipe.lock: self.wake.configure(**wcfg)
+            return
+        old = self.wake
+        wake = WakeSpotter.from_config(wcfg, sr=sr, on_detect=self.pipe.on_wake)
+        if old is not None:
+            for label, tpls in old.templates.items():
+                for tpl in tpls: wake.add_template(label, tpl)
+        else:
+            wake.load_templates()
+        self.wake = wake                # 組み上げてから差し替える
+
+    def _apply_render_settings(self, *_):
+        self.canvas.set_quality_pin(self.current_config()["render"]["quality"])
+
+    def _on_quality_change(self, tier, auto: bool):
+        if self.settings_overlay is not None:
+            self.settings_overlay.set_quality_status(tier, auto)
+
     def get_audio_settings(self):
         return dict(self.audio_cfg_cache)
 
@@ -839,9 +4559,12 @@ class MainWindow(QWidget):
 def main():
     app = QApplication(sys.argv)
     app.setQuitOnLastWindowClosed(False)
+    STARTUP.mark("qapp")
     w = MainWindow()
+    STARTUP.mark("mainwindow")
     w.resize(760, 500)
     w.show()
+    STARTUP.mark("show")
     sys.exit(app.exec())
 
 